@@ -0,0 +1,141 @@
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from typing import Deque, Optional
+
+from .metrics import GENERATION_ADMISSION_REJECTED, GENERATION_ADMISSION_WAIT_SECONDS, GENERATION_QUEUE_DEPTH
+
+# 拒绝原因 -> HTTP 状态码：队列已满说明请求过多（429），排队超时说明服务端处理不过来（503）
+QUEUE_FULL, QUEUE_TIMEOUT = "queue_full", "queue_timeout"
+_STATUS_CODES = {QUEUE_FULL: 429, QUEUE_TIMEOUT: 503}
+
+
+class AdmissionRejected(Exception):
+    """生成名额已满，请求被拒绝"""
+
+    def __init__(self, reason: str, retry_after: int, active: int, queued: int):
+        super().__init__(f"当前生成任务过多（进行中 {active}，排队 {queued}），请 {retry_after} 秒后重试")
+        self.reason = reason
+        self.status_code = _STATUS_CODES[reason]
+        self.retry_after = retry_after
+        self.active = active
+        self.queued = queued
+
+
+class AdmissionTicket:
+    """一次生成占用的名额，release() 可重复调用"""
+
+    def __init__(self, controller: "AdmissionController", waited: float):
+        self.controller = controller
+        self.waited = waited
+        self.started = time.monotonic()
+        self.released = False
+
+    def release(self) -> None:
+        if self.released:
+            return
+        self.released = True
+        self.controller._release(time.monotonic() - self.started)
+
+
+class AdmissionController:
+    """
+    补全接口的准入控制：同时进行的生成不超过 max_active，其余按到达顺序进入短等待队列。
+
+    队列已满时立即拒绝（429），排队超过 queue_timeout 秒仍未获得名额时拒绝（503），
+    Retry-After 按最近生成耗时的滑动平均估算。计数仅对本 worker 有效。
+    """
+
+    def __init__(self, max_active: Optional[int] = None, max_queue: Optional[int] = None,
+                 queue_timeout: Optional[float] = None):
+        self.max_active = max_active if max_active is not None else int(os.getenv("MAX_ACTIVE_GENERATIONS", "16"))
+        self.max_queue = max_queue if max_queue is not None else int(os.getenv("MAX_QUEUED_GENERATIONS", "16"))
+        self.queue_timeout = queue_timeout if queue_timeout is not None else float(
+            os.getenv("GENERATION_QUEUE_TIMEOUT", "10"))
+        # 还没有完成的生成可参考时使用的单次生成耗时估计（秒）
+        self.avg_duration = float(os.getenv("GENERATION_RETRY_AFTER", "5"))
+        self.active = 0
+        self.admitted = 0
+        self.rejected = {QUEUE_FULL: 0, QUEUE_TIMEOUT: 0}
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def _update_depth(self) -> None:
+        GENERATION_QUEUE_DEPTH.set(self.queued)
+
+    def retry_after(self) -> int:
+        """估算排在队尾的请求需要等待的秒数"""
+        if self.max_active <= 0:
+            return 1
+        estimate = self.avg_duration * (self.queued + 1) / self.max_active
+        return max(1, min(60, math.ceil(estimate)))
+
+    def _reject(self, reason: str) -> AdmissionRejected:
+        self.rejected[reason] += 1
+        GENERATION_ADMISSION_REJECTED.inc(reason=reason)
+        return AdmissionRejected(reason, self.retry_after(), self.active, self.queued)
+
+    async def acquire(self) -> AdmissionTicket:
+        """获取生成名额，名额与队列都已满或排队超时时抛出 AdmissionRejected"""
+        if self.max_active <= 0 or (self.active < self.max_active and not self._waiters):
+            self.active += 1
+            self.admitted += 1
+            GENERATION_ADMISSION_WAIT_SECONDS.observe(0)
+            return AdmissionTicket(self, 0.0)
+        if self.queued >= self.max_queue:
+            raise self._reject(QUEUE_FULL)
+        started = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        self._update_depth()
+        try:
+            await asyncio.wait_for(future, timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._remove(future)
+            raise self._reject(QUEUE_TIMEOUT) from None
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已分配到名额后客户端断开，归还名额
+                self._release(None)
+            else:
+                self._remove(future)
+            raise
+        waited = time.perf_counter() - started
+        self.admitted += 1
+        GENERATION_ADMISSION_WAIT_SECONDS.observe(waited)
+        return AdmissionTicket(self, waited)
+
+    def _remove(self, future: asyncio.Future) -> None:
+        try:
+            self._waiters.remove(future)
+        except ValueError:
+            return
+        self._update_depth()
+
+    def _release(self, duration: Optional[float]) -> None:
+        if duration is not None:
+            self.avg_duration = 0.8 * self.avg_duration + 0.2 * duration
+        self.active -= 1
+        while self._waiters and (self.max_active <= 0 or self.active < self.max_active):
+            future = self._waiters.popleft()
+            if future.done():
+                continue
+            self.active += 1
+            future.set_result(None)
+        self._update_depth()
+
+    def snapshot(self) -> dict:
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "max_active": self.max_active,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "retry_after": self.retry_after()
+        }
@@ -1,98 +1,365 @@
+import asyncio
+import hashlib
 import json
 import logging
-from typing import Any, Optional, Dict
-from datetime import datetime, timedelta
 import os
-import pickle
+import sys
+import time
+import uuid
+import zlib
+from collections import OrderedDict
 from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
+
+def stable_key(*parts: Any) -> str:
+    """由任意可 JSON 序列化的内容生成跨进程稳定的 key（不依赖 hash() 的随机化）"""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _estimate_size(value: Any, depth: int = 0) -> int:
+    """估算对象占用的内存字节数，用于按字节限制内存层"""
+    size = sys.getsizeof(value)
+    if depth > 4:
+        return size
+    if isinstance(value, dict):
+        size += sum(_estimate_size(k, depth + 1) + _estimate_size(v, depth + 1) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        if value and all(isinstance(v, float) for v in value):
+            # 嵌入向量等纯浮点列表：每个 float 对象 24 字节
+            size += 24 * len(value)
+        else:
+            size += sum(_estimate_size(v, depth + 1) for v in value)
+    elif hasattr(value, "__dict__"):
+        size += _estimate_size(vars(value), depth + 1)
+    return size
+
+
+class _Entry:
+    __slots__ = ("value", "expires_at", "size")
+
+    def __init__(self, value: Any, expires_at: Optional[float], size: int):
+        self.value = value
+        self.expires_at = expires_at
+        self.size = size
+
+    def expired(self, now: float) -> bool:
+        return self.expires_at is not None and self.expires_at <= now
+
+
+class NamespaceStats:
+    __slots__ = ("hits", "misses", "disk_hits", "evictions", "expirations", "entries", "bytes")
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.entries = 0
+        self.bytes = 0
+
+    def to_dict(self) -> Dict[str, int]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
 class Cache:
-    def __init__(self, cache_dir: str = ".cache"):
-        self.cache_dir = Path(cache_dir)
-        self.memory_cache: Dict[str, Dict[str, Any]] = {}
-        self.cache_dir.mkdir(parents=True, exist_ok=True)
-        
-    def _get_cache_file(self, key: str) -> Path:
-        """获取缓存文件路径"""
-        return self.cache_dir / f"{key}.pickle"
-        
-    def get(self, key: str, ttl: int = 3600) -> Optional[Any]:
-        """获取缓存值"""
+    """
+    分层缓存：内存层 + 磁盘层，按命名空间（tool_results、tool_catalog 等）隔离统计。
+
+    - 内存层按 LRU 淘汰，总条目数与估算字节数均有上限（CACHE_MAX_ENTRIES / CACHE_MAX_BYTES）
+    - 条目可设置 TTL（秒），过期条目由后台任务定期清理，读取时也会惰性剔除
+    - persist=True 的条目同时写入磁盘层：zlib 压缩的 JSON，读写在线程池中执行，不阻塞事件循环
+    - key 建议使用 stable_key() 生成，重启后磁盘层仍可命中
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, max_entries: Optional[int] = None,
+                 max_bytes: Optional[int] = None, expiry_interval: Optional[float] = None):
+        self.cache_dir = Path(cache_dir or os.getenv("CACHE_DIR", ".cache"))
+        self.max_entries = max_entries or int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+        self.max_bytes = max_bytes or int(os.getenv("CACHE_MAX_BYTES", str(128 * 1024 * 1024)))
+        self.expiry_interval = expiry_interval or float(os.getenv("CACHE_EXPIRY_INTERVAL", "60"))
+        self.disk_max_bytes = int(os.getenv("CACHE_DISK_MAX_BYTES", str(1024 * 1024 * 1024)))
+        self.disk_sweep_interval = float(os.getenv("CACHE_DISK_SWEEP_INTERVAL", "3600"))
+        self._entries: "OrderedDict[Tuple[str, str], _Entry]" = OrderedDict()
+        self._stats: Dict[str, NamespaceStats] = {}
+        self._bytes = 0
+        self._expiry_task: Optional[asyncio.Task] = None
+        self._disk_writes: set = set()
+        self._last_disk_sweep = time.time()
+
+    # ---------- 内存层 ----------
+
+    def _ns(self, namespace: str) -> NamespaceStats:
+        stats = self._stats.get(namespace)
+        if stats is None:
+            stats = self._stats[namespace] = NamespaceStats()
+        return stats
+
+    def _remove(self, key: Tuple[str, str], expired: bool = False, evicted: bool = False) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        stats = self._ns(key[0])
+        stats.entries -= 1
+        stats.bytes -= entry.size
+        self._bytes -= entry.size
+        if expired:
+            stats.expirations += 1
+        if evicted:
+            stats.evictions += 1
+
+    def _store(self, namespace: str, key: str, value: Any, expires_at: Optional[float]) -> None:
+        full_key = (namespace, key)
+        self._remove(full_key)
+        size = _estimate_size(value)
+        self._entries[full_key] = _Entry(value, expires_at, size)
+        stats = self._ns(namespace)
+        stats.entries += 1
+        stats.bytes += size
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest = next(iter(self._entries))
+            if oldest == full_key:
+                break
+            self._remove(oldest, evicted=True)
+        self._ensure_expiry()
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        """只查内存层"""
+        full_key = (namespace, key)
+        entry = self._entries.get(full_key)
+        stats = self._ns(namespace)
+        if entry is not None:
+            if not entry.expired(time.time()):
+                self._entries.move_to_end(full_key)
+                stats.hits += 1
+                return entry.value
+            self._remove(full_key, expired=True)
+        stats.misses += 1
+        return None
+
+    def set(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None, persist: bool = False) -> None:
+        """写入内存层；persist=True 时在后台线程写入磁盘层"""
+        expires_at = time.time() + ttl if ttl else None
+        self._store(namespace, key, value, expires_at)
+        if persist:
+            self._schedule_disk_write(namespace, key, value, expires_at)
+
+    async def aget(self, namespace: str, key: str) -> Optional[Any]:
+        """先查内存层，未命中时在线程池中查磁盘层并回填内存"""
+        value = self.get(namespace, key)
+        if value is not None:
+            return value
+        item = await asyncio.to_thread(self._disk_read, namespace, key)
+        if item is None:
+            return None
+        value, expires_at = item
+        stats = self._ns(namespace)
+        stats.disk_hits += 1
+        # get() 已记为 miss，磁盘命中后改记为 hit
+        stats.misses -= 1
+        stats.hits += 1
+        self._store(namespace, key, value, expires_at)
+        return value
+
+    async def aset(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None,
+                   persist: bool = False) -> None:
+        """与 set 相同，但等待磁盘写入完成"""
+        expires_at = time.time() + ttl if ttl else None
+        self._store(namespace, key, value, expires_at)
+        if persist:
+            await asyncio.to_thread(self._disk_write, namespace, key, value, expires_at)
+
+    def peek(self, namespace: str, key: str) -> Optional[Any]:
+        """读取内存层但不计入统计、不调整 LRU 顺序，过期条目也会返回"""
+        entry = self._entries.get((namespace, key))
+        return entry.value if entry is not None else None
+
+    def discard(self, namespace: str, key: str) -> bool:
+        """只移除内存层条目，返回条目是否存在"""
+        full_key = (namespace, key)
+        existed = full_key in self._entries
+        self._remove(full_key)
+        return existed
+
+    async def delete(self, namespace: str, key: str) -> None:
+        """同时删除内存层与磁盘层条目；磁盘层在已排队的写入完成后于线程池中删除"""
+        self._remove((namespace, key))
+        await self._wait_disk_writes()
+        await asyncio.to_thread(self._disk_delete, namespace, key)
+
+    def invalidate(self, namespace: str, prefix: str = "") -> int:
+        """清除命名空间内（key 以 prefix 开头的）内存条目，返回清除数量"""
+        keys = [k for k in self._entries if k[0] == namespace and k[1].startswith(prefix)]
+        for key in keys:
+            self._remove(key)
+        return len(keys)
+
+    async def clear(self, namespace: Optional[str] = None) -> None:
+        """清空内存层与磁盘层（可只清空某个命名空间），磁盘文件在线程池中删除"""
+        if namespace is None:
+            for key in list(self._entries):
+                self._remove(key)
+        else:
+            self.invalidate(namespace)
+        await self._wait_disk_writes()
+        await asyncio.to_thread(self._disk_clear, namespace)
+
+    def stats(self, namespace: Optional[str] = None) -> Dict[str, Any]:
+        if namespace is not None:
+            return self._ns(namespace).to_dict()
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "namespaces": {name: s.to_dict() for name, s in self._stats.items()}
+        }
+
+    # ---------- 磁盘层 ----------
+
+    def _disk_path(self, namespace: str, key: str) -> Path:
+        safe_key = key if len(key) <= 128 and key.isalnum() else stable_key(key)
+        return self.cache_dir / namespace / safe_key[:2] / f"{safe_key}.zjson"
+
+    def _disk_write(self, namespace: str, key: str, value: Any, expires_at: Optional[float]) -> None:
+        path = self._disk_path(namespace, key)
         try:
-            # 1. 先查内存缓存
-            if key in self.memory_cache:
-                cache_data = self.memory_cache[key]
-                if datetime.now().timestamp() - cache_data["timestamp"] < ttl:
-                    return cache_data["value"]
-                else:
-                    del self.memory_cache[key]
-            
-            # 2. 查文件缓存
-            cache_file = self._get_cache_file(key)
-            if cache_file.exists():
-                with open(cache_file, "rb") as f:
-                    cache_data = pickle.load(f)
-                if datetime.now().timestamp() - cache_data["timestamp"] < ttl:
-                    # 加载到内存缓存
-                    self.memory_cache[key] = cache_data
-                    return cache_data["value"]
-                else:
-                    cache_file.unlink()  # 删除过期缓存
-            
+            path.parent.mkdir(parents=True, exist_ok=True)
+            payload = json.dumps({"e": expires_at, "v": value}, ensure_ascii=False, separators=(",", ":"))
+            # 同一进程内同一 key 的并发写入各用各的临时文件
+            tmp = path.with_suffix(f".{os.getpid()}.{uuid.uuid4().hex}.tmp")
+            try:
+                tmp.write_bytes(zlib.compress(payload.encode("utf-8"), 6))
+                os.replace(tmp, path)
+            finally:
+                tmp.unlink(missing_ok=True)
+        except Exception as e:
+            logger.error(f"写入缓存文件失败: {e}")
+
+    def _disk_delete(self, namespace: str, key: str) -> None:
+        try:
+            self._disk_path(namespace, key).unlink(missing_ok=True)
+        except OSError as e:
+            logger.error(f"删除缓存文件失败: {e}")
+
+    def _disk_clear(self, namespace: Optional[str]) -> None:
+        root = self.cache_dir / namespace if namespace else self.cache_dir
+        for path in root.rglob("*.zjson") if root.exists() else ():
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    async def _wait_disk_writes(self) -> None:
+        """等待已排队的磁盘写入，避免删除后被旧的写入重新写回"""
+        if self._disk_writes:
+            await asyncio.gather(*list(self._disk_writes), return_exceptions=True)
+
+    def _disk_read(self, namespace: str, key: str) -> Optional[Tuple[Any, Optional[float]]]:
+        path = self._disk_path(namespace, key)
+        try:
+            data = json.loads(zlib.decompress(path.read_bytes()))
+        except FileNotFoundError:
             return None
         except Exception as e:
-            logger.error(f"获取缓存失败: {e}")
+            logger.error(f"读取缓存文件失败: {e}")
+            return None
+        expires_at = data.get("e")
+        if expires_at is not None and expires_at <= time.time():
+            try:
+                path.unlink()
+            except OSError:
+                pass
             return None
-            
-    def set(self, key: str, value: Any, persist: bool = False):
-        """设置缓存值"""
+        return data.get("v"), expires_at
+
+    def _schedule_disk_write(self, namespace: str, key: str, value: Any, expires_at: Optional[float]) -> None:
         try:
-            cache_data = {
-                "value": value,
-                "timestamp": datetime.now().timestamp()
-            }
-            
-            # 1. 设置内存缓存
-            self.memory_cache[key] = cache_data
-            
-            # 2. 如果需要持久化，写入文件
-            if persist:
-                cache_file = self._get_cache_file(key)
-                with open(cache_file, "wb") as f:
-                    pickle.dump(cache_data, f)
-                    
-        except Exception as e:
-            logger.error(f"设置缓存失败: {e}")
-    
-    def delete(self, key: str):
-        """删除缓存"""
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._disk_write(namespace, key, value, expires_at)
+            return
+        future = loop.run_in_executor(None, self._disk_write, namespace, key, value, expires_at)
+        self._disk_writes.add(future)
+        future.add_done_callback(self._disk_writes.discard)
+
+    def _sweep_disk(self) -> int:
+        """删除过期文件；总大小超过 CACHE_DISK_MAX_BYTES 时按修改时间删除最旧的文件"""
+        if not self.cache_dir.exists():
+            return 0
+        now = time.time()
+        removed = 0
+        files = []
+        for path in self.cache_dir.rglob("*.zjson"):
+            try:
+                data = json.loads(zlib.decompress(path.read_bytes()))
+                expires_at = data.get("e")
+                if expires_at is not None and expires_at <= now:
+                    path.unlink()
+                    removed += 1
+                    continue
+                stat = path.stat()
+                files.append((stat.st_mtime, stat.st_size, path))
+            except Exception:
+                continue
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                path.unlink()
+                total -= size
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+    # ---------- 后台过期清理 ----------
+
+    def _ensure_expiry(self) -> None:
+        if self._expiry_task is not None and not self._expiry_task.done():
+            return
         try:
-            # 1. 删除内存缓存
-            if key in self.memory_cache:
-                del self.memory_cache[key]
-            
-            # 2. 删除文件缓存
-            cache_file = self._get_cache_file(key)
-            if cache_file.exists():
-                cache_file.unlink()
-                
-        except Exception as e:
-            logger.error(f"删除缓存失败: {e}")
-    
-    def clear(self):
-        """清空所有缓存"""
+            self._expiry_task = asyncio.get_running_loop().create_task(self._expiry_loop())
+        except RuntimeError:
+            pass
+
+    def expire(self) -> int:
+        """清理内存层中已过期的条目"""
+        now = time.time()
+        expired = [k for k, e in self._entries.items() if e.expired(now)]
+        for key in expired:
+            self._remove(key, expired=True)
+        return len(expired)
+
+    async def _expiry_loop(self) -> None:
         try:
-            # 1. 清空内存缓存
-            self.memory_cache.clear()
-            
-            # 2. 清空文件缓存
-            for cache_file in self.cache_dir.glob("*.pickle"):
-                cache_file.unlink()
-                
+            while True:
+                await asyncio.sleep(self.expiry_interval)
+                removed = self.expire()
+                if removed:
+                    logger.info(f"[Cache] 清理过期条目 {removed} 个")
+                if time.time() - self._last_disk_sweep >= self.disk_sweep_interval:
+                    self._last_disk_sweep = time.time()
+                    removed = await asyncio.to_thread(self._sweep_disk)
+                    if removed:
+                        logger.info(f"[Cache] 清理缓存文件 {removed} 个")
+        except asyncio.CancelledError:
+            pass
         except Exception as e:
-            logger.error(f"清空缓存失败: {e}")
+            logger.error(f"[Cache] 过期清理失败: {e}")
+
+    async def close(self) -> None:
+        """停止后台清理并等待未完成的磁盘写入"""
+        if self._expiry_task:
+            self._expiry_task.cancel()
+            self._expiry_task = None
+        if self._disk_writes:
+            await asyncio.gather(*self._disk_writes, return_exceptions=True)
+
 
 # 全局缓存实例
-cache = Cache() 
\ No newline at end of file
+cache = Cache()
@@ -0,0 +1,109 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Dict, List, Optional
+
+from .deadline import turn_budget
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:  # tiktoken 未安装或无法加载编码表时使用估算
+    _encoding = None
+
+SUMMARY_PREFIX = "以下是之前对话的摘要，请结合摘要与后续消息继续对话：\n"
+
+
+def count_tokens(text: str) -> int:
+    """统计文本 token 数；无 tiktoken 时按 CJK 字符 1 token、其他字符 4 个 1 token 估算"""
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    cjk = sum(1 for ch in text if '⺀' <= ch <= '鿿' or '가' <= ch <= '힯')
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def message_tokens(message: dict) -> int:
+    tokens = 4 + count_tokens(message.get("content") if isinstance(message.get("content"), str) else
+                              json.dumps(message.get("content"), ensure_ascii=False))
+    if message.get("tool_calls"):
+        tokens += count_tokens(json.dumps(message["tool_calls"], ensure_ascii=False))
+    return tokens
+
+
+def group_units(messages: List[dict]) -> List[List[dict]]:
+    """按不可拆分的单元分组：带 tool_calls 的 assistant 消息与其后的 tool 结果属于同一单元"""
+    units: List[List[dict]] = []
+    for message in messages:
+        if message.get("role") == "tool" and units:
+            units[-1].append(message)
+        else:
+            units.append([message])
+    return units
+
+
+class ContextBuilder:
+    """
+    在 get_messages 与 async_generate_response 之间组装上下文。
+
+    未超出 CONTEXT_MAX_TOKENS 时原样返回；超出时保留最近 CONTEXT_RECENT_TOKENS 的消息，
+    更早的消息增量合并进会话上的滚动摘要（sessions.summary），只对新滑出窗口的部分调用 LLM。
+    生成摘要受本轮剩余预算限制，失败或超时时沿用已有摘要，只保留最近窗口内的消息。
+    """
+
+    def __init__(self, llm_service, session_manager, max_tokens: Optional[int] = None,
+                 recent_tokens: Optional[int] = None):
+        self.llm_service = llm_service
+        self.session_manager = session_manager
+        self.max_tokens = max_tokens or int(os.getenv("CONTEXT_MAX_TOKENS", "8000"))
+        self.recent_tokens = recent_tokens or int(os.getenv("CONTEXT_RECENT_TOKENS", "4000"))
+
+    async def build(self, session_id: str, messages: List[dict], summary: Optional[Dict] = None) -> List[dict]:
+        """返回发送给 LLM 的消息列表，必要时更新并持久化会话摘要"""
+        summarized_until = (summary or {}).get("until")
+        if summarized_until:
+            messages = [m for m in messages if m.get("timestamp", "") > summarized_until]
+
+        units = group_units(messages)
+        unit_tokens = [sum(message_tokens(m) for m in unit) for unit in units]
+        summary_text = (summary or {}).get("content", "")
+        summary_tokens = count_tokens(summary_text)
+
+        if summary_tokens + sum(unit_tokens) > self.max_tokens and len(units) > 1:
+            # 从最新的单元往前保留，至少保留最后一个单元
+            keep_from = len(units) - 1
+            used = unit_tokens[-1]
+            while keep_from > 0 and used + unit_tokens[keep_from - 1] <= self.recent_tokens:
+                keep_from -= 1
+                used += unit_tokens[keep_from]
+            overflow = [m for unit in units[:keep_from] for m in unit]
+            if overflow:
+                try:
+                    async with asyncio.timeout(turn_budget()):
+                        new_summary = await self.llm_service.summarize(summary_text, overflow)
+                except Exception as e:
+                    # 摘要与 until 保持不变，这些消息下一轮会再次尝试并入摘要
+                    logger.warning(f"[Context] 会话 {session_id} 摘要生成失败，保留原有摘要，"
+                                   f"本轮未发送较早的 {len(overflow)} 条消息: {e!r}")
+                else:
+                    summary_text = new_summary
+                    summary = {
+                        "content": summary_text,
+                        "until": overflow[-1].get("timestamp", ""),
+                        "message_count": (summary or {}).get("message_count", 0) + len(overflow)
+                    }
+                    try:
+                        await self.session_manager.update_session_summary(session_id, summary)
+                        logger.info(f"[Context] 会话 {session_id} 摘要已更新，新并入 {len(overflow)} 条消息")
+                    except Exception as e:
+                        logger.error(f"[Context] 会话 {session_id} 摘要保存失败: {e}")
+                units = units[keep_from:]
+
+        context = [m for unit in units for m in unit]
+        if summary_text:
+            context.insert(0, {"role": "system", "content": SUMMARY_PREFIX + summary_text})
+        return context
@@ -0,0 +1,91 @@
+import contextvars
+import os
+import random
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+# 每轮对话的默认时限（秒），请求可以要求更短但不能更长
+TURN_DEADLINE = float(os.getenv("TURN_DEADLINE", "120"))
+# 为时间用尽后的最终回答预留的秒数，LLM 轮次与工具调用只能使用其余部分
+FINAL_ANSWER_RESERVE = float(os.getenv("FINAL_ANSWER_RESERVE", "10"))
+# 服务器未配置 timeout 时的单次工具调用时限（秒）
+TOOL_CALL_TIMEOUT = float(os.getenv("TOOL_CALL_TIMEOUT", "30"))
+
+_current_deadline: contextvars.ContextVar[Optional["Deadline"]] = contextvars.ContextVar(
+    "mcp_turn_deadline", default=None)
+
+
+class Deadline:
+    """一轮对话的截止时间（单调时钟），随协程上下文传递给 LLM 轮次与工具调用"""
+
+    def __init__(self, timeout: float, reserve: float = FINAL_ANSWER_RESERVE):
+        self.timeout = timeout
+        self.expires_at = time.monotonic() + timeout
+        # 预留不超过总时限的一半，避免时限很短时没有时间做任何事
+        self.reserve = min(reserve, timeout / 2)
+
+    def remaining(self) -> float:
+        """距截止的秒数"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def budget(self) -> float:
+        """扣除最终回答预留后，LLM 轮次与工具调用还能使用的秒数"""
+        return max(0.0, self.expires_at - self.reserve - time.monotonic())
+
+    @property
+    def exhausted(self) -> bool:
+        return self.budget() <= 0
+
+    def cap(self, timeout: Optional[float]) -> float:
+        """将单个操作的时限限制在剩余预算内"""
+        budget = self.budget()
+        return budget if timeout is None else min(timeout, budget)
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _current_deadline.get()
+
+
+def turn_budget(timeout: Optional[float] = None) -> Optional[float]:
+    """当前轮次的剩余预算与 timeout 取较小值；不在轮次内时原样返回 timeout"""
+    deadline = _current_deadline.get()
+    if deadline is None:
+        return timeout
+    return deadline.cap(timeout)
+
+
+@contextmanager
+def deadline_scope(deadline: Optional[Deadline]):
+    """将 deadline 设为当前轮次的截止时间，create_task 创建的子任务自动继承"""
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        try:
+            _current_deadline.reset(token)
+        except ValueError:
+            # 在其他上下文中退出（异步生成器被回收）时无法 reset，忽略即可
+            pass
+
+
+def tool_timeout(server_config: Dict[str, Any], tool_name: str) -> float:
+    """
+    工具的单次调用时限（秒）：servers 文档的 tool_timeouts（{工具名: 秒}，"*" 为通配）优先，
+    其次是服务器的 timeout，都未配置时使用 TOOL_CALL_TIMEOUT。
+    """
+    timeouts = server_config.get("tool_timeouts") or {}
+    value = None
+    if isinstance(timeouts, dict):
+        value = timeouts.get(tool_name, timeouts.get("*"))
+    if value is None:
+        value = server_config.get("timeout")
+    try:
+        return float(value) if value else TOOL_CALL_TIMEOUT
+    except (TypeError, ValueError):
+        return TOOL_CALL_TIMEOUT
+
+
+def backoff_delay(attempt: int, base: float = 0.5, max_delay: float = 8.0) -> float:
+    """第 attempt 次（从 0 开始）重试前的等待秒数：指数退避，带 ±20% 抖动避免同时重试"""
+    return min(base * 2 ** attempt, max_delay) * random.uniform(0.8, 1.2)
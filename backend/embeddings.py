@@ -0,0 +1,304 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .cache import stable_key
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，只支持单进程写入
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+_TOKEN_RE = re.compile(r"[\w]+", re.UNICODE)
+
+
+class HashingEmbedder:
+    """
+    离线嵌入器：对词与字符 n-gram 做特征哈希，输出 L2 归一化的向量。
+
+    不依赖任何外部服务，结果确定，用于测试、基准与无 API Key 的本地开发。
+    """
+
+    def __init__(self, dim: Optional[int] = None, model: str = "hashing"):
+        self.dim = dim or int(os.getenv("EMBEDDING_DIM", "256"))
+        self.model = f"{model}-{self.dim}"
+
+    def _features(self, text: str) -> List[str]:
+        text = text.lower()
+        features = _TOKEN_RE.findall(text)
+        compact = re.sub(r"\s+", " ", text)
+        # 字符 2/3-gram，对中文等无空格分词的文本同样有效
+        for n in (2, 3):
+            features.extend(compact[i:i + n] for i in range(max(0, len(compact) - n + 1)))
+        return features
+
+    def embed_one(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in self._features(text):
+            digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+            value = int.from_bytes(digest, "little")
+            vector[value % self.dim] += 1.0 if (value >> 63) & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    async def embed(self, texts: Sequence[str]) -> np.ndarray:
+        return np.stack([self.embed_one(t) for t in texts]) if texts else np.zeros((0, self.dim), np.float32)
+
+
+class OpenAIEmbedder:
+    """通过 OpenAI 兼容接口批量获取嵌入向量"""
+
+    def __init__(self, client, model: Optional[str] = None):
+        self.client = client
+        self.model = model or os.getenv("EMBEDDING_MODEL", "text-embedding-ada-002")
+
+    async def embed(self, texts: Sequence[str]) -> np.ndarray:
+        response = await self.client.embeddings.create(model=self.model, input=list(texts))
+        data = sorted(response.data, key=lambda d: d.index)
+        return np.asarray([d.embedding for d in data], dtype=np.float32)
+
+
+class VectorStore:
+    """
+    按内容哈希索引的 float32 向量存储，数据文件通过 np.memmap 映射，重启后无需反序列化即可使用。
+
+    目录结构：
+        meta.json      {"dim": 1536}
+        vectors.f32    行主序的 float32 矩阵，容量按倍数增长
+        keys.txt       每行一个 key，行号即向量所在行；先写向量再追加 key，崩溃时不会索引到未写完的行
+        store.lock     写入时持有的文件锁，多个 worker 共享同一目录时串行追加
+
+    写入前会重新读取其他进程追加的 key 与扩容后的数据文件，行号以磁盘上的 key 行数为准。
+    """
+
+    def __init__(self, path: str, initial_capacity: int = 1024):
+        self.path = Path(path)
+        self.initial_capacity = initial_capacity
+        self.dim: Optional[int] = None
+        self._index: Dict[str, int] = {}
+        self._matrix: Optional[np.memmap] = None
+        self._capacity = 0
+        # keys.txt 中已读取的行数与字节数
+        self._rows = 0
+        self._keys_offset = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def _load(self) -> None:
+        meta_file = self.path / "meta.json"
+        if not meta_file.exists():
+            return
+        self.dim = json.loads(meta_file.read_text())["dim"]
+        self._remap()
+        self._read_new_keys()
+        logger.info(f"[VectorStore] 已加载 {len(self._index)} 个向量（dim={self.dim}）: {self.path}")
+
+    def _disk_capacity(self) -> int:
+        data_file = self.path / "vectors.f32"
+        return data_file.stat().st_size // (4 * self.dim) if data_file.exists() else 0
+
+    def _remap(self) -> None:
+        """按数据文件当前大小重新映射（其他进程可能已扩容）"""
+        capacity = self._disk_capacity()
+        if capacity == self._capacity and self._matrix is not None:
+            return
+        if self._matrix is not None:
+            self._matrix.flush()
+        self._capacity = capacity
+        self._matrix = np.memmap(self.path / "vectors.f32", dtype=np.float32, mode="r+",
+                                 shape=(capacity, self.dim)) if capacity else None
+
+    def _read_new_keys(self) -> None:
+        """读取 keys.txt 中自上次读取以来追加的 key（包括其他进程写入的），只处理完整的行"""
+        keys_file = self.path / "keys.txt"
+        if not keys_file.exists():
+            return
+        with open(keys_file, "rb") as f:
+            f.seek(self._keys_offset)
+            data = f.read()
+        for line in data.splitlines(keepends=True):
+            if not line.endswith(b"\n") or self._rows >= self._capacity:
+                break
+            self._index.setdefault(line[:-1].decode("utf-8"), self._rows)
+            self._rows += 1
+            self._keys_offset += len(line)
+
+    @contextmanager
+    def _file_lock(self):
+        """跨进程的写入锁"""
+        self.path.mkdir(parents=True, exist_ok=True)
+        if fcntl is None:
+            yield
+            return
+        with open(self.path / "store.lock", "a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _ensure_capacity(self, rows: int) -> None:
+        if rows <= self._capacity:
+            return
+        capacity = max(self.initial_capacity, self._capacity)
+        while capacity < rows:
+            capacity *= 2
+        if self._matrix is not None:
+            self._matrix.flush()
+        data_file = self.path / "vectors.f32"
+        with open(data_file, "ab") as f:
+            f.truncate(capacity * self.dim * 4)
+        self._matrix = np.memmap(data_file, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+        self._capacity = capacity
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        row = self._index.get(key)
+        if row is None:
+            return None
+        return np.array(self._matrix[row])
+
+    def add_many(self, items: Sequence[Tuple[str, np.ndarray]]) -> None:
+        """写入一批向量，已存在的 key 会被跳过"""
+        with self._lock:
+            items = [(k, v) for k, v in items if k not in self._index]
+            if not items:
+                return
+            with self._file_lock():
+                meta_file = self.path / "meta.json"
+                if self.dim is None and meta_file.exists():
+                    # 其他进程已创建存储
+                    self.dim = json.loads(meta_file.read_text())["dim"]
+                if self.dim is None:
+                    self.dim = int(len(items[0][1]))
+                    meta_file.write_text(json.dumps({"dim": self.dim}))
+                # 同步其他进程追加的向量，新行从磁盘上的 key 行数开始写
+                self._remap()
+                self._read_new_keys()
+                items = [(k, v) for k, v in items if k not in self._index]
+                if not items:
+                    return
+                start = self._rows
+                self._ensure_capacity(start + len(items))
+                for offset, (_, vector) in enumerate(items):
+                    self._matrix[start + offset] = np.asarray(vector, dtype=np.float32)
+                self._matrix.flush()
+                data = "".join(f"{k}\n" for k, _ in items).encode("utf-8")
+                with open(self.path / "keys.txt", "ab") as f:
+                    f.write(data)
+                for offset, (key, _) in enumerate(items):
+                    self._index[key] = start + offset
+                self._rows += len(items)
+                self._keys_offset += len(data)
+
+    def flush(self) -> None:
+        if self._matrix is not None:
+            self._matrix.flush()
+
+
+class EmbeddingService:
+    """
+    嵌入向量服务：向量存储命中时直接返回，未命中的请求在 batch_window 内合并为一次批量调用。
+
+    相同文本的并发请求共享同一个 Future；单批最多 batch_size 条，攒满立即发送。
+    """
+
+    def __init__(self, embedder, store: Optional[VectorStore] = None, batch_size: Optional[int] = None,
+                 batch_window: Optional[float] = None):
+        self.embedder = embedder
+        store_dir = Path(os.getenv("EMBEDDING_STORE_DIR", ".cache/vectors"))
+        self.store = store if store is not None else VectorStore(str(store_dir / re.sub(r"[^\w.-]", "_", embedder.model)))
+        self.batch_size = batch_size or int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+        self.batch_window = batch_window if batch_window is not None else float(os.getenv("EMBEDDING_BATCH_WINDOW", "0.01"))
+        self._queue: List[Tuple[str, str]] = []
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set = set()
+        self.stats = {"requests": 0, "store_hits": 0, "batches": 0, "embedded": 0}
+
+    def key_for(self, text: str) -> str:
+        return stable_key(self.embedder.model, text)
+
+    async def embed(self, text: str) -> List[float]:
+        return (await self.embed_vector(text)).tolist()
+
+    async def embed_many(self, texts: Sequence[str]) -> np.ndarray:
+        vectors = await asyncio.gather(*(self.embed_vector(t) for t in texts))
+        return np.stack(vectors) if vectors else np.zeros((0, self.store.dim or 0), np.float32)
+
+    async def embed_vector(self, text: str) -> np.ndarray:
+        self.stats["requests"] += 1
+        key = self.key_for(text)
+        vector = self.store.get(key)
+        if vector is not None:
+            self.stats["store_hits"] += 1
+            return vector
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[key] = future
+            self._queue.append((key, text))
+            if len(self._queue) >= self.batch_size:
+                self._dispatch()
+            elif self._timer is None:
+                self._timer = asyncio.get_running_loop().call_later(self.batch_window, self._dispatch)
+        return await asyncio.shield(future)
+
+    def _dispatch(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._queue:
+            batch, self._queue = self._queue[:self.batch_size], self._queue[self.batch_size:]
+            task = asyncio.create_task(self._run_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch: List[Tuple[str, str]]) -> None:
+        try:
+            vectors = await self.embedder.embed([text for _, text in batch])
+            items = list(zip([key for key, _ in batch], vectors))
+            await asyncio.to_thread(self.store.add_many, items)
+            self.stats["batches"] += 1
+            self.stats["embedded"] += len(batch)
+            for key, vector in items:
+                future = self._inflight.pop(key, None)
+                if future and not future.done():
+                    future.set_result(np.asarray(vector, dtype=np.float32))
+        except Exception as e:
+            logger.error(f"[Embedding] 批量获取嵌入向量失败（{len(batch)} 条）: {e}")
+            for key, _ in batch:
+                future = self._inflight.pop(key, None)
+                if future and not future.done():
+                    future.set_exception(e)
+
+    async def close(self) -> None:
+        """发送剩余请求并等待完成"""
+        self._dispatch()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self.store.flush()
+
+
+def create_embedding_service(client) -> EmbeddingService:
+    """根据 EMBEDDING_PROVIDER（openai/hashing）创建嵌入服务"""
+    provider = os.getenv("EMBEDDING_PROVIDER", "openai").lower()
+    if provider == "hashing":
+        return EmbeddingService(HashingEmbedder())
+    return EmbeddingService(OpenAIEmbedder(client))
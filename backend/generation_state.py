@@ -0,0 +1,370 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import datetime
+from typing import AsyncIterator, Callable, Dict, List, Optional, Set
+
+from pymongo import ASCENDING, CursorType
+from pymongo.errors import CollectionInvalid
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationChannel:
+    """
+    单个会话正在生成的 AI 回复的广播通道。
+
+    生成方 publish() 增量 token，每个增量带递增的 seq；订阅方先收到一次快照，
+    之后只收到增量，无需轮询，也不会重复发送已累积的内容。
+    生成方通过 on_cancel 注册取消回调，cancel() 只会触发一次。
+    发起本轮的 POST 流直接接收生成事件，通过 attach()/detach() 计入 consumers。
+    """
+
+    def __init__(self, chat_id: str):
+        self.chat_id = chat_id
+        self.generation_id = uuid.uuid4().hex
+        self.content = ""
+        self.seq = 0
+        self.status = "generating"
+        self.cancel_requested = False
+        self.on_cancel: Optional[Callable[[], None]] = None
+        self.consumers = 0
+        self._subscribers: Set[asyncio.Queue] = set()
+
+    @property
+    def subscriber_count(self) -> int:
+        """仍在接收本轮生成的客户端数：POST 流与刷新页面后的订阅方"""
+        return len(self._subscribers) + self.consumers
+
+    def attach(self) -> None:
+        self.consumers += 1
+
+    def detach(self) -> None:
+        self.consumers = max(0, self.consumers - 1)
+
+    def cancel(self) -> None:
+        if self.cancel_requested or self.status != "generating":
+            return
+        self.cancel_requested = True
+        if self.on_cancel is not None:
+            self.on_cancel()
+
+    def publish(self, delta: str) -> None:
+        if not delta:
+            return
+        self.seq += 1
+        self.content += delta
+        for queue in self._subscribers:
+            queue.put_nowait((self.seq, delta))
+
+    def finish(self) -> None:
+        self.status = "done"
+        for queue in self._subscribers:
+            queue.put_nowait(None)
+
+    async def subscribe(self) -> AsyncIterator[dict]:
+        """先产出 snapshot，再逐个产出 delta，生成结束时退出"""
+        queue: asyncio.Queue = asyncio.Queue()
+        # 快照与注册之间没有 await，保证不会漏掉或重复增量
+        snapshot = {"type": "snapshot", "seq": self.seq, "content": self.content}
+        if self.status != "generating":
+            yield snapshot
+            return
+        self._subscribers.add(queue)
+        try:
+            yield snapshot
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                seq, delta = item
+                yield {"type": "delta", "seq": seq, "delta": delta}
+        finally:
+            self._subscribers.discard(queue)
+
+
+class InProcessGenerationState:
+    """进程内的生成状态登记表：chat_id -> GenerationChannel，仅对本 worker 可见"""
+
+    def __init__(self):
+        self._channels: Dict[str, GenerationChannel] = {}
+
+    def __len__(self) -> int:
+        return len(self._channels)
+
+    async def init(self) -> None:
+        pass
+
+    def _new_channel(self, chat_id: str) -> GenerationChannel:
+        return GenerationChannel(chat_id)
+
+    async def start(self, chat_id: str) -> GenerationChannel:
+        channel = self._new_channel(chat_id)
+        previous = self._channels.get(chat_id)
+        if previous:
+            previous.finish()
+        self._channels[chat_id] = channel
+        return channel
+
+    def get(self, chat_id: str) -> Optional[GenerationChannel]:
+        return self._channels.get(chat_id)
+
+    async def is_generating(self, chat_id: str) -> bool:
+        return chat_id in self._channels
+
+    async def cancel(self, chat_id: str) -> bool:
+        """请求取消会话正在进行的生成，没有进行中的生成时返回 False"""
+        channel = self._channels.get(chat_id)
+        if channel is None:
+            return False
+        channel.cancel()
+        return True
+
+    async def has_subscribers(self, chat_id: str) -> bool:
+        """是否仍有客户端（POST 流或刷新页面后的订阅方）在接收该会话的生成"""
+        channel = self._channels.get(chat_id)
+        return channel is not None and channel.subscriber_count > 0
+
+    async def finish(self, chat_id: str, channel: GenerationChannel) -> None:
+        """结束生成并移除登记；只移除同一个通道，避免误删新一轮生成"""
+        if self._channels.get(chat_id) is channel:
+            del self._channels[chat_id]
+        channel.finish()
+
+    async def subscribe(self, chat_id: str) -> AsyncIterator[dict]:
+        """订阅会话的生成过程，没有进行中的生成时不产出任何事件"""
+        channel = self._channels.get(chat_id)
+        if channel:
+            async for event in channel.subscribe():
+                yield event
+
+
+class MongoGenerationChannel(GenerationChannel):
+    """同时写入 MongoDB 的广播通道：增量按 flush_interval 合并后写入 capped collection"""
+
+    def __init__(self, chat_id: str, state: "MongoGenerationState"):
+        super().__init__(chat_id)
+        self._state = state
+        self._pending: List[str] = []
+        self._flush_lock = asyncio.Lock()
+        self._flusher: Optional[asyncio.Task] = None
+        self._heartbeat: Optional[asyncio.Task] = None
+
+    def start_heartbeat(self) -> None:
+        self._heartbeat = asyncio.create_task(self._heartbeat_loop())
+
+    async def _heartbeat_loop(self) -> None:
+        """
+        长时间没有输出（如工具执行）时也定期刷新心跳，避免被其他 worker 判定为失效；
+        同时按 cancel_poll_interval 检查其他 worker 写入的取消请求。
+        """
+        heartbeat_interval = self._state.stale_after / 3
+        last_heartbeat = time.monotonic()
+        try:
+            while True:
+                await asyncio.sleep(min(heartbeat_interval, self._state.cancel_poll_interval))
+                doc = await self._state.generations.find_one({"_id": self.generation_id}, {"cancel_requested": 1})
+                if doc and doc.get("cancel_requested"):
+                    self.cancel()
+                if time.monotonic() - last_heartbeat >= heartbeat_interval:
+                    last_heartbeat = time.monotonic()
+                    await self._state.generations.update_one(
+                        {"_id": self.generation_id}, {"$set": {"updated_at": datetime.utcnow()}}
+                    )
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"[GenerationState] 心跳写入失败: {e}")
+
+    def publish(self, delta: str) -> None:
+        if not delta:
+            return
+        super().publish(delta)
+        self._pending.append(delta)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self) -> None:
+        await asyncio.sleep(self._state.flush_interval)
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"[GenerationState] 增量写入失败: {e}")
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            delta, self._pending = ''.join(self._pending), []
+            seq, content = self.seq, self.content
+            now = datetime.utcnow()
+            # 先写事件再更新快照：订阅方读到旧快照时，新事件一定在 seq 之后
+            await self._state.events.insert_one({
+                "generation_id": self.generation_id,
+                "chat_id": self.chat_id,
+                "type": "delta",
+                "seq": seq,
+                "delta": delta,
+                "at": now
+            })
+            await self._state.generations.update_one(
+                {"_id": self.generation_id},
+                {"$set": {"content": content, "seq": seq, "updated_at": now}}
+            )
+
+    async def close(self) -> None:
+        if self._heartbeat:
+            self._heartbeat.cancel()
+        if self._flusher:
+            # 等待已排队的写入完成，不在写入中途取消
+            await self._flusher
+        await self.flush()
+
+
+class MongoGenerationState(InProcessGenerationState):
+    """
+    基于 MongoDB 的生成状态，多个 uvicorn worker 共享。
+
+    - generations 集合：每个进行中的生成一条文档（chat_id、worker、累积内容快照、seq、心跳）
+    - generation_events capped collection：按 seq 追加的增量与结束事件，订阅方用 tailable cursor 跟随
+    本 worker 发起的生成直接走进程内通道，其他 worker 的生成通过 MongoDB 订阅。
+    跨 worker 的取消请求写入 generations 文档的 cancel_requested，由发起生成的 worker 轮询；
+    其他 worker 上的订阅方计入 watchers，用于判断客户端断开后生成是否仍有人接收。
+    """
+
+    def __init__(self, db, flush_interval: Optional[float] = None, stale_after: Optional[float] = None):
+        super().__init__()
+        self.db = db
+        self.generations = db.generations
+        self.events = db.generation_events
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.flush_interval = flush_interval or float(os.getenv("GENERATION_FLUSH_INTERVAL", "0.05"))
+        self.stale_after = stale_after or float(os.getenv("GENERATION_STALE_SECONDS", "60"))
+        self.capped_size = int(os.getenv("GENERATION_EVENTS_CAPPED_BYTES", str(64 * 1024 * 1024)))
+        self.cancel_poll_interval = float(os.getenv("GENERATION_CANCEL_POLL_INTERVAL", "1"))
+
+    async def init(self) -> None:
+        """创建 capped collection 与索引"""
+        try:
+            await self.db.create_collection("generation_events", capped=True, size=self.capped_size)
+        except CollectionInvalid:
+            pass
+        await self.events.create_index([("generation_id", ASCENDING), ("seq", ASCENDING)])
+        await self.generations.create_index("chat_id")
+
+    def _new_channel(self, chat_id: str) -> GenerationChannel:
+        return MongoGenerationChannel(chat_id, self)
+
+    async def start(self, chat_id: str) -> GenerationChannel:
+        channel = await super().start(chat_id)
+        now = datetime.utcnow()
+        await self.generations.delete_many({"chat_id": chat_id})
+        await self.generations.insert_one({
+            "_id": channel.generation_id,
+            "chat_id": chat_id,
+            "worker": self.worker_id,
+            "status": "generating",
+            "content": "",
+            "seq": 0,
+            "watchers": 0,
+            "started_at": now,
+            "updated_at": now
+        })
+        channel.start_heartbeat()
+        return channel
+
+    async def finish(self, chat_id: str, channel: GenerationChannel) -> None:
+        try:
+            if isinstance(channel, MongoGenerationChannel):
+                await channel.close()
+            await self.events.insert_one({
+                "generation_id": channel.generation_id,
+                "chat_id": chat_id,
+                "type": "finish",
+                "seq": channel.seq + 1,
+                "at": datetime.utcnow()
+            })
+            await self.generations.delete_one({"_id": channel.generation_id})
+        finally:
+            await super().finish(chat_id, channel)
+
+    async def _find_remote(self, chat_id: str) -> Optional[dict]:
+        doc = await self.generations.find_one({"chat_id": chat_id})
+        if doc and self._is_stale(doc):
+            logger.warning(f"[GenerationState] 会话 {chat_id} 的生成已失去心跳（worker={doc.get('worker')}），忽略")
+            return None
+        return doc
+
+    def _is_stale(self, doc: dict) -> bool:
+        updated_at = doc.get("updated_at") or doc.get("started_at")
+        return updated_at is not None and (datetime.utcnow() - updated_at).total_seconds() > self.stale_after
+
+    async def is_generating(self, chat_id: str) -> bool:
+        return chat_id in self._channels or await self._find_remote(chat_id) is not None
+
+    async def cancel(self, chat_id: str) -> bool:
+        if await super().cancel(chat_id):
+            return True
+        result = await self.generations.update_many({"chat_id": chat_id}, {"$set": {"cancel_requested": True}})
+        return result.matched_count > 0
+
+    async def has_subscribers(self, chat_id: str) -> bool:
+        if await super().has_subscribers(chat_id):
+            return True
+        doc = await self.generations.find_one({"chat_id": chat_id}, {"watchers": 1})
+        return bool(doc and doc.get("watchers", 0) > 0)
+
+    async def subscribe(self, chat_id: str) -> AsyncIterator[dict]:
+        if chat_id in self._channels:
+            async for event in super().subscribe(chat_id):
+                yield event
+            return
+        doc = await self._find_remote(chat_id)
+        if not doc:
+            return
+        generation_id = doc["_id"]
+        await self.generations.update_one({"_id": generation_id}, {"$inc": {"watchers": 1}})
+        try:
+            async for event in self._follow(chat_id, generation_id, doc):
+                yield event
+        finally:
+            try:
+                await self.generations.update_one({"_id": generation_id}, {"$inc": {"watchers": -1}})
+            except Exception as e:
+                logger.error(f"[GenerationState] 更新订阅数失败: {e}")
+
+    async def _follow(self, chat_id: str, generation_id: str, doc: dict) -> AsyncIterator[dict]:
+        seq = doc.get("seq", 0)
+        yield {"type": "snapshot", "seq": seq, "content": doc.get("content", "")}
+        last_event_at = time.monotonic()
+        while True:
+            cursor = self.events.find(
+                {"generation_id": generation_id, "seq": {"$gt": seq}},
+                cursor_type=CursorType.TAILABLE_AWAIT
+            )
+            while cursor.alive:
+                async for event in cursor:
+                    last_event_at = time.monotonic()
+                    if event["type"] == "finish":
+                        return
+                    seq = event["seq"]
+                    yield {"type": "delta", "seq": seq, "delta": event["delta"]}
+                if time.monotonic() - last_event_at > self.stale_after:
+                    if await self._find_remote(chat_id) is None:
+                        return
+                    last_event_at = time.monotonic()
+                await asyncio.sleep(self.flush_interval)
+            await asyncio.sleep(self.flush_interval)
+
+
+def create_generation_state(db=None):
+    """根据 GENERATION_STATE_BACKEND（memory/mongo）创建生成状态后端"""
+    backend = os.getenv("GENERATION_STATE_BACKEND", "memory").lower()
+    if backend == "mongo":
+        if db is None:
+            raise ValueError("mongo generation state backend requires a database")
+        return MongoGenerationState(db)
+    return InProcessGenerationState()
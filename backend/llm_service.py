@@ -1,15 +1,31 @@
-from typing import List, Dict, Any, AsyncGenerator
+from typing import List, Dict, Any, AsyncGenerator, Optional
 import logging
 import json
 import os
+import httpx
 import openai
+from fastmcp.exceptions import ToolError
+from mcp.shared.exceptions import McpError
+from mcp.types import CONNECTION_CLOSED
 from .cache import cache
+from .deadline import current_deadline, tool_timeout, turn_budget
+from .embeddings import create_embedding_service
 from .mcp_server_dao import MCPServerDAO
-import re
+from .metrics import (CHAIN_STEPS, LLM_STREAM_SECONDS, LLM_TTFT_SECONDS, TOOL_CALLS, TOOL_CALL_SECONDS,
+                      TURN_DEADLINE_EXCEEDED)
 from .server import StdioMCPServer, SSEMCPServer
+from .server_health import ServerHealthMonitor
+from .server_limits import ServerBusyError, ServerLimiter
+from .tool_catalog import ToolCatalog
+from .tool_result_cache import ToolResultCache
+from .tool_selector import ToolSelector
+from .tracing import payload_size, tracer
+from .stream_parser import FunctionCallStreamParser, TEXT, INNER_THOUGHT
 import asyncio
+import time
 import traceback
 import uuid
+from contextlib import aclosing
 
 logger = logging.getLogger(__name__)
 
@@ -26,9 +42,27 @@ def convert_obj_id(obj):
         return obj
 
 
+# 时限用尽时追加的系统消息：不再提供工具，要求基于已有信息直接作答
+FINAL_ANSWER_PROMPT = "本轮处理时间已用完，不能再调用任何工具。请根据以上对话与已获得的工具结果，直接给出尽可能完整的最终回答，并说明哪些部分因时间不足未能完成。"
+# 连最终回答也没能生成时附加在回复末尾的说明
+DEADLINE_NOTICE = "\n\n（处理超时，以上回答可能不完整）"
+
+
+def _is_tool_level_error(e: Exception) -> bool:
+    """
+    服务器已正常响应、只是工具本身报错（isError 结果、参数错误等），不代表服务器不健康；
+    连接断开与请求超时仍视为服务器故障。
+    """
+    if isinstance(e, ToolError):
+        return True
+    return isinstance(e, McpError) and e.error.code not in (CONNECTION_CLOSED, httpx.codes.REQUEST_TIMEOUT)
+
+
 def filter_llm_message(msg):
     msg = convert_obj_id(msg)
-    return {k: v for k, v in msg.items() if k not in ("session_id", "tools", "updated_at", "timestamp", 'call')}
+    return {k: v for k, v in msg.items() if k not in ("session_id", "tools", "updated_at", "timestamp", 'call',
+                                                     "is_error", "content_preview", "content_size", "latency_ms", "cancelled",
+                                                     "inner_thoughts")}
 
 
 def _serialize_tool_result(result):
@@ -55,41 +89,119 @@ def _serialize_tool_result(result):
     return result
 
 
-def extract_function_call(text):
-    # logger.info(f"[FunctionCall] 检查内容: {text}")
-    match = re.search(r"<\|FunctionCallBegin\|>([\s\S]*?)<\|FunctionCallEnd\|>", text)
-    if not match:
-        logger.info("[FunctionCall] 正则未匹配")
-        return None
-    try:
-        parsed = json.loads(match.group(1))
-        # logger.info(f"[FunctionCall] 解析成功: {parsed}")
-        return parsed
-    except Exception as e:
-        logger.error(f"[FunctionCall] JSON 解析失败: {e}, 内容: {match.group(1)}")
-        return None
+def _is_error_result(result) -> bool:
+    return isinstance(result, dict) and (bool(result.get('error')) or bool(result.get('isError')))
+
+
+class ToolCallBatch:
+    """
+    同一轮 LLM 输出中的工具调用批次。
+
+    submit() 后立即开始执行，并发数受 TOOL_CALL_CONCURRENCY 限制；
+    drain() 在每个调用完成后成对下发 function_call/tool_result 事件（成对保存，历史中不会拆散），
+    全部完成后再按原始调用顺序写入 messages，保证对话内容确定。
+    """
+
+    def __init__(self, service: "LLMService"):
+        self.service = service
+        self._semaphore = asyncio.Semaphore(max(1, int(os.getenv("TOOL_CALL_CONCURRENCY", "4"))))
+        self._prepared: List[dict] = []
+        self._tasks: List[asyncio.Task] = []
+        self._done: asyncio.Queue = asyncio.Queue()
+
+    def submit(self, call: dict) -> bool:
+        prepared = self.service._prepare_function_call(call)
+        if not prepared:
+            return False
+        index = len(self._prepared)
+        prepared["submitted_at"] = time.perf_counter()
+        self._prepared.append(prepared)
+        self._tasks.append(asyncio.create_task(self._execute(index, prepared)))
+        return True
+
+    async def _execute(self, index: int, item: dict) -> None:
+        # 每个工具调用一个 span（挂在所属 chain.step 下），包含批次内排队与 mcp.call_tool
+        with tracer.span("tool.handle_function_call", {"tool.name": item["call"].get("name"),
+                                                       "tool.batch_index": index}) as span:
+            try:
+                async with self._semaphore:
+                    span.set_attribute("tool.batch_wait_ms",
+                                       round((time.perf_counter() - item["submitted_at"]) * 1000, 2))
+                    # 以批次作为排队 flow：服务器繁忙时同一批次的调用与其他会话轮流获得名额
+                    result = await self.service.call_mcp_tool(item["server"], item["tool"], item["params"], flow=self)
+            except Exception as e:
+                logger.error(f"调用 MCP 工具失败: {e}")
+                span.set_attribute("error", str(e))
+                result = {"error": str(e)}
+        self._done.put_nowait((index, result, time.perf_counter()))
+
+    async def drain(self, messages: list):
+        results: Dict[int, dict] = {}
+        while len(results) < len(self._prepared):
+            index, result, finished_at = await self._done.get()
+            item = self._prepared[index]
+            call = item["call"]
+            logger.info(f"[FunctionCall] call: {call} 执行结果: {result}")
+            tool_result = self.service._build_tool_result(call, call['name'], item["id"], result)
+            # 从提交到完成的耗时（含排队），随结果一起保存
+            tool_result["latency_ms"] = round((finished_at - item["submitted_at"]) * 1000, 2)
+            results[index] = tool_result
+            yield {'function_call': item["message"]}
+            yield {"tool_result": tool_result}
+
+        for index, item in enumerate(self._prepared):
+            messages.append(filter_llm_message(item["message"]))
+            messages.append(filter_llm_message(results[index]))
+
+    def __len__(self) -> int:
+        return len(self._prepared)
+
+    def cancel(self) -> None:
+        """取消尚未完成的工具调用"""
+        for task in self._tasks:
+            if not task.done():
+                task.cancel()
 
 
 class LLMService:
     def __init__(self, server_dao: MCPServerDAO):
         self.server_dao = server_dao
-        self.client = openai.OpenAI(
+        # 所有补全/嵌入请求共享同一个异步连接池，避免阻塞事件循环
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", "200")),
+                max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "50")),
+            ),
+            timeout=httpx.Timeout(float(os.getenv("LLM_TIMEOUT", "600")), connect=10.0),
+        )
+        self.client = openai.AsyncOpenAI(
             api_key=os.getenv("API_KEY"),
-            base_url=os.getenv("BASE_URL", "https://api.openai.com/v1")
+            base_url=os.getenv("BASE_URL", "https://api.openai.com/v1"),
+            http_client=self.http_client
         )
         self._function_prompt = None
+        self.cache = cache
+        self.health = ServerHealthMonitor(probe=self._probe_server)
+        self.limiter = ServerLimiter()
+        self.tool_catalog = ToolCatalog(cache=self.cache, health=self.health)
+        self.tool_result_cache = ToolResultCache(cache=self.cache)
+        self.embedding_service = create_embedding_service(self.client)
+        self.tool_selector = ToolSelector(self.embedding_service)
         self.mcp_servers: Dict[str, SSEMCPServer | StdioMCPServer] = {}
-        self.server_dao = MCPServerDAO()
-        self.update_mcp_servers()
 
     def get_mcp_server(self, name: str) -> SSEMCPServer | StdioMCPServer:
         return self.mcp_servers.get(name)
 
-    def update_mcp_servers(self):
-        """更新 MCP Server 列表（支持多协议）"""
+    async def update_mcp_servers(self):
+        """更新 MCP Server 列表（支持多协议），在应用启动时调用"""
         logger.info(f"更新 MCP Server 列表（支持多协议）")
+        old_servers = list(self.mcp_servers.values())
         self.mcp_servers.clear()
-        servers = self.server_dao.list_servers()
+        self.tool_catalog.invalidate()
+        self.health.forget()
+        self.limiter.forget()
+        await asyncio.gather(*(s.cleanup() for s in old_servers), return_exceptions=True)
+        servers = await self.server_dao.list_servers()
         for server in servers:
             mode = server.get("mode", "sse")
             name = server["name"]
@@ -97,101 +209,110 @@ class LLMService:
                 self.mcp_servers[name] = StdioMCPServer(name, server)
             else:
                 self.mcp_servers[name] = SSEMCPServer(name, server)
+            self.tool_catalog.watch(self.mcp_servers[name])
 
     async def list_all_tools(self) -> List[Dict[str, Any]]:
         """汇总所有 MCP Server 的工具列表"""
-        all_tools = []
-        for name, server in self.mcp_servers.items():
-            try:
-                logger.info(f"[list_all_tools] 开始获取服务器 {name} 的工具列表...")
-                await server.initialize()
-                tools = await server.list_tools()
-                logger.info(
-                    f"[list_all_tools] 服务器 {name} 返回的原始工具列表: {json.dumps(tools, ensure_ascii=False, indent=2)}")
-
-                for tool in tools:
-                    all_tools.append({
-                        "name": tool["name"] if isinstance(tool, dict) else getattr(tool, "name", None),
-                        "server": name,
-                        "description": tool.get("description", "") if isinstance(tool, dict) else getattr(tool,
-                                                                                                            "description",
-                                                                                                            ""),
-                        "params": tool.get("inputSchema", {}) if isinstance(tool, dict) else getattr(tool,
-                                                                                                        "input_schema", {})
-                    })
-                logger.info(
-                    f"[list_all_tools] 服务器 {name} 处理后的工具列表: {json.dumps(all_tools, ensure_ascii=False, indent=2)}")
-            except Exception as e:
-                logger.error(f"获取 {name} 工具列表失败: {e}")
-                traceback.print_exc()
-        return all_tools
-
-    async def call_mcp_tool(self, server_name: str, tool_name: str, arguments: dict) -> Any:
+        entries = await self.tool_catalog.get_entries(self.mcp_servers)
+        return [tool for entry in entries for tool in entry.tools]
+
+    async def call_mcp_tool(self, server_name: str, tool_name: str, arguments: dict, flow=None) -> Any:
+        """调用 MCP 工具；flow 标识调用所属的一轮对话，用于服务器排队时在各轮之间公平分配"""
+        with tracer.span("mcp.call_tool", {"mcp.server": server_name, "mcp.tool": tool_name}) as span:
+            if span.recording:
+                span.set_attribute("mcp.arguments_bytes", payload_size(arguments))
+            result = await self._call_mcp_tool(server_name, tool_name, arguments, span, flow)
+            if span.recording:
+                span.set_attributes({"mcp.result_bytes": payload_size(result), "mcp.is_error": _is_error_result(result)})
+            return result
+
+    async def _call_mcp_tool(self, server_name: str, tool_name: str, arguments: dict, span, flow) -> Any:
         logger.info(
             f"[call_mcp_tool] 调用工具: server={server_name}, tool={tool_name}, arguments={json.dumps(arguments, ensure_ascii=False)}")
         server = self.mcp_servers.get(server_name)
         if not server:
             return {"error": f"未找到服务器: {server_name}"}
+        if not self.health.allow(server_name):
+            TOOL_CALLS.inc(server=server_name, tool=tool_name, status="circuit_open")
+            span.set_attribute("mcp.circuit_open", True)
+            return {"error": f"服务器 {server_name} 暂时不可用（熔断中），请稍后重试或改用其他工具",
+                    "code": "circuit_open", "retryable": True}
+        cache_ttl = self.tool_result_cache.ttl_for(server.config, tool_name)
+        if cache_ttl:
+            cached = self.tool_result_cache.get(server_name, tool_name, arguments)
+            if cached is not None:
+                logger.info(f"[call_mcp_tool] 命中结果缓存: server={server_name}, tool={tool_name}")
+                TOOL_CALLS.inc(server=server_name, tool=tool_name, status="cached")
+                span.set_attribute("mcp.cached", True)
+                return cached
+        budget = turn_budget()
+        if budget is not None and budget <= 0:
+            TOOL_CALLS.inc(server=server_name, tool=tool_name, status="deadline_exceeded")
+            return {"error": f"本轮处理时间已用完，未执行工具 {tool_name}", "code": "deadline_exceeded", "retryable": False}
         try:
-            await server.initialize()
-            result = await server.execute_tool(tool_name, arguments)
-            await server.cleanup()
-            return _serialize_tool_result(result)
+            # 排队与执行都不超过本轮剩余预算；预算耗尽不计入服务器健康度
+            async with asyncio.timeout(budget):
+                async with self.limiter.slot(server_name, server.config, flow) as waited:
+                    span.set_attribute("mcp.queue_wait_ms", round(waited * 1000, 2))
+                    return await self._execute_tool(server, tool_name, arguments, cache_ttl)
+        except TimeoutError:
+            logger.warning(f"[call_mcp_tool] 本轮处理时间已用完，中止工具调用: server={server_name}, tool={tool_name}")
+            TOOL_CALLS.inc(server=server_name, tool=tool_name, status="deadline_exceeded")
+            span.set_attribute("mcp.deadline_exceeded", True)
+            return {"error": f"本轮处理时间已用完，工具 {tool_name} 未完成", "code": "deadline_exceeded", "retryable": False}
+        except ServerBusyError as e:
+            # 队列已满时立即返回结构化错误，由 LLM 决定稍后重试或改用其他工具
+            logger.warning(f"[call_mcp_tool] {e}，拒绝调用 {tool_name}")
+            TOOL_CALLS.inc(server=server_name, tool=tool_name, status="server_busy")
+            span.set_attribute("mcp.server_busy", True)
+            return {"error": f"{e}，请稍后重试或改用其他工具", "code": "server_busy", "retryable": True}
+
+    async def _execute_tool(self, server, tool_name: str, arguments: dict, cache_ttl) -> Any:
+        """执行工具调用，记录耗时与服务器健康度"""
+        server_name = server.name
+        started = time.perf_counter()
+        try:
+            # 复用已初始化的会话（stdio 走连接池），不再每次调用都拉起/销毁子进程
+            if not getattr(server, '_initialized', False):
+                await server.initialize()
+            # 单次调用时限取 servers 文档的 tool_timeouts / timeout
+            result = await server.execute_tool(tool_name, arguments, timeout=tool_timeout(server.config, tool_name))
+            result = _serialize_tool_result(result)
+            if cache_ttl and not _is_error_result(result):
+                self.tool_result_cache.set(server_name, tool_name, arguments, result, cache_ttl)
+            # 工具返回的业务错误（isError）不计入服务器健康度
+            self.health.record_success(server_name, time.perf_counter() - started)
+        except (ToolError, McpError) as e:
+            if not _is_tool_level_error(e):
+                logger.error(f"调用 MCP 工具失败: {e}")
+                self.health.record_failure(server_name, f"{tool_name}: {e}", time.perf_counter() - started)
+            else:
+                # fastmcp 对 isError 结果抛出 ToolError：原样返回给模型，服务器本身是健康的
+                logger.warning(f"MCP 工具返回错误: server={server_name}, tool={tool_name}: {e}")
+                self.health.record_success(server_name, time.perf_counter() - started)
+            result = {"error": str(e)}
         except Exception as e:
             logger.error(f"调用 MCP 工具失败: {e}")
-            return {"error": str(e)}
+            self.health.record_failure(server_name, f"{tool_name}: {e}", time.perf_counter() - started)
+            result = {"error": str(e)}
+        TOOL_CALL_SECONDS.observe(time.perf_counter() - started, server=server_name, tool=tool_name)
+        TOOL_CALLS.inc(server=server_name, tool=tool_name, status="error" if _is_error_result(result) else "ok")
+        return result
+
+    async def _probe_server(self, name: str) -> None:
+        """熔断探测：强制重新拉取工具列表，成功即视为恢复"""
+        server = self.mcp_servers.get(name)
+        if server is None:
+            raise RuntimeError(f"未找到服务器: {name}")
+        await self.tool_catalog.get_entry(server, refresh=True)
 
     async def _fetch_functions(self):
-        """从 MCP Server 获取功能列表并返回 JSON"""
-        all_functions = []
+        """从工具目录获取功能列表并返回 JSON"""
+        if not self.mcp_servers:
+            logger.info("无 MCP Server，返回空功能列表")
+            return []
         try:
-            if not self.mcp_servers:
-                logger.info("无 MCP Server，返回空功能列表")
-                return []
-            for name, server in self.mcp_servers.items():
-                try:
-                    logger.info(f"[_fetch_functions] 开始获取服务器 {name} 的工具列表...")
-                    tools = await server.list_tools()
-                    logger.info(
-                        f"[_fetch_functions] 服务器 {name} 返回的原始工具列表: {json.dumps(tools, ensure_ascii=False, indent=2)}")
-
-                    for tool in tools:
-                        try:
-                            if isinstance(tool, dict) and 'name' in tool:
-                                param_schema = tool.get("params") or tool.get("inputSchema") or {}
-                                properties = param_schema.get("properties", {})
-                                required = param_schema.get("required", list(properties.keys()))
-                                tool_copy = {
-                                    "name": tool["name"],
-                                    "server": name,
-                                    "description": tool.get("description", ""),
-                                    "params": param_schema
-                                }
-                                all_functions.append(tool_copy)
-                            elif hasattr(tool, 'name'):
-                                param_schema = getattr(tool, "input_schema", {})
-                                properties = param_schema.get("properties", {})
-                                required = param_schema.get("required", list(properties.keys()))
-                                tool_copy = {
-                                    "name": getattr(tool, 'name', 'unknown'),
-                                    "server": name,
-                                    "description": getattr(tool, "description", ""),
-                                    "params": param_schema
-                                }
-                                all_functions.append(tool_copy)
-                            else:
-                                logger.warning(f"tool对象无name字段: {tool}")
-                                continue
-                        except Exception as e:
-                            logger.error(f"tools处理异常: {e}, tool内容: {tool}")
-                            raise
-                    logger.info(
-                        f"[_fetch_functions] 服务器 {name} 处理后的工具列表: {json.dumps(all_functions, ensure_ascii=False, indent=2)}")
-                except Exception as e:
-                    logger.error(f"获取 {name} 工具列表失败: {e}")
-                    traceback.print_exc()
-                    continue  # 跳过出错的服务器，继续处理其他服务器
-            return all_functions
+            return await self.list_all_tools()
         except Exception as e:
             logger.error(f"自动获取 MCP 功能列表失败: {e}")
             return []
@@ -201,94 +322,41 @@ class LLMService:
         """
         直接让 LLM 调用已注册的 MCP Server 处理消息
         """
-        # 构建系统提示词，包含所有可用的工具信息
-        tools = []
-        available_servers = []  # 记录所有可用的服务器
-
-        for name, server in self.mcp_servers.items():
-            try:
-                # 确保 server 已初始化
-                if not getattr(server, '_initialized', False):
-                    await server.initialize()
-                server_tools = await server.list_tools()
-                if isinstance(server_tools, dict) and "functions" in server_tools:
-                    server_tools = server_tools["functions"]
-                # 如果成功获取工具列表，将服务器标记为可用
-                available_servers.append(server)
-                for tool in server_tools:
-                    try:
-                        if isinstance(tool, dict) and 'name' in tool:
-                            param_schema = tool.get("params") or tool.get("inputSchema") or {}
-                            properties = param_schema.get("properties", {})
-                            required = param_schema.get("required", list(properties.keys()))
-                            tool_copy = {
-                                "type": "function",
-                                "function": {
-                                    "name": f"{name}.{tool['name']}",
-                                    "description": tool.get("description", ""),
-                                    "parameters": {
-                                        "type": "object",
-                                        "properties": properties,
-                                        "required": required
-                                    }
-                                }
-                            }
-                            tools.append(tool_copy)
-                        elif hasattr(tool, 'name'):
-                            param_schema = getattr(tool, "input_schema", {})
-                            properties = param_schema.get("properties", {})
-                            required = param_schema.get("required", list(properties.keys()))
-                            tool_copy = {
-                                "type": "function",
-                                "function": {
-                                    "name": f"{name}.{getattr(tool, 'name', 'unknown')}",
-                                    "description": getattr(tool, "description", ""),
-                                    "parameters": {
-                                        "type": "object",
-                                        "properties": properties,
-                                        "required": required
-                                    }
-                                }
-                            }
-                            tools.append(tool_copy)
-                        else:
-                            logger.warning(f"tool对象无name字段: {tool}")
-                            continue
-                    except Exception as e:
-                        logger.error(f"tools处理异常: {e}, tool内容: {tool}")
-                        traceback.print_exc()
-                        continue
-            except Exception as e:
-                logger.error(f"获取服务器 {name} 的工具列表失败: {e}")
-                traceback.print_exc()
-                continue  # 跳过出错的服务器，继续处理其他服务器
-
+        # 从工具目录获取各服务器的工具与预编译的 functions 负载
+        with tracer.span("tool.discovery", {"mcp.servers": len(self.mcp_servers)}) as span:
+            discovery = await self.tool_catalog.discover(self.mcp_servers)
+            span.set_attributes({"mcp.degraded": len(discovery.degraded),
+                                 "tool.count": sum(len(e.functions) for e in discovery.entries)})
+        entries = discovery.entries
+        available_servers = [e.server_name for e in entries]
+        openai_tools = [fn for e in entries for fn in e.functions]
+        if discovery.degraded:
+            # 超时或失败的服务器本轮降级，不阻塞首个 token
+            yield {"degraded_servers": discovery.degraded, "latencies": discovery.latencies}
+
+        deadline = current_deadline()
         # 如果没有可用工具，直接用 LLM 聊天
-        if not tools:
-            response = self.client.chat.completions.create(
-                model=os.getenv("MODEL"),
-                messages=messages,
-                stream=True
-            )
-            for chunk in response:
-                delta = getattr(chunk.choices[0], 'delta', None)
-                if delta and getattr(delta, 'content', None):
-                    yield delta.content
+        if not openai_tools:
+            CHAIN_STEPS.observe(0)
+            try:
+                async for item in self._stream_answer(messages, deadline.remaining() if deadline else None):
+                    yield item
+            except TimeoutError:
+                # 已输出的部分即为尽力而为的回答
+                TURN_DEADLINE_EXCEEDED.inc(stage="llm")
+                yield {"deadline_exceeded": {"stage": "llm", "timeout": deadline.timeout}}
+                yield DEADLINE_NOTICE
             return
 
+        # 按最近的对话语义筛选本轮发送的工具，系统消息只列出选中的工具
+        pinned = [f"{name}.{tool}" for name, server in self.mcp_servers.items()
+                  for tool in (getattr(server, 'config', None) or {}).get("pinned_tools") or []]
+        selection = await self.tool_selector.select(entries, messages, pinned)
+        openai_tools = selection.functions
+        yield {"tool_selection": selection.to_dict()}
+
         # 构建系统消息
-        tool_names = [tool['function']['name'] for tool in tools]
-        tool_names_str = '\n'.join(f'- {n}' for n in tool_names)
-        system_message = {
-            "role": "system",
-            "content": f"""你是一个强大的 AI 助手。你只能调用以下工具（名称区分大小写）：
-                {tool_names_str}
-                禁止调用未注册的工具，否则会报错。
-                调用工具时，请使用完整的工具名称（包含 server_name 前缀）。
-                调用工具时，参数必须严格按照 schema 格式传递。例如 sqlite.create_table 只接受 query 字符串参数，内容为完整的 SQL 语句。
-                每次调用需要严格按照参数数量给入，如果需要多次调用，则发起多次调用；
-                如果遇到错误，尝试其他可用的工具或向用户说明情况。"""
-        }
+        system_message = self.tool_catalog.render_system_message(entries, selection.names)
 
         logger.info(f"系统消息: {system_message['content']}")
 
@@ -300,203 +368,343 @@ class LLMService:
             yield {"error": "没有可用的服务器"}
             return
 
+        max_chain_steps = 10
+        chain_count = 0
+        # 时限用尽的阶段（llm/tool），非空时跳出循环并给出最终回答
+        deadline_stage = None
         try:
-            # 统一 tools 结构为 OpenAI function-calling 格式
-            def convert_to_openai_functions(tools_in):
-                openai_functions = []
-                for fn in tools_in:
-                    fn = fn.get('function')
-                    # 兼容不同字段
-                    schema = fn.get('params') or fn.get('inputSchema') or {}
-                    openai_functions.append({
-                        "name": fn["name"],
-                        "description": fn.get("description", ""),
-                        "parameters": schema
-                    })
-                return openai_functions
-
-            openai_tools = convert_to_openai_functions(tools)
-            max_chain_steps = 10
-            chain_count = 0
             while chain_count < max_chain_steps:
-                logger.info(f"当前轮数 {chain_count} / {max_chain_steps}")
-                # logger.info(f"当前messages: {json.dumps(messages, ensure_ascii=False, indent=2)}")
-                has_tool_calls = False
-                response = self.client.chat.completions.create(
-                    model=os.getenv("MODEL"),
-                    messages=messages,
-                    functions=openai_tools,
-                    stream=True
-                )
-                current_content = ""
-                tool_calls = {}
-                for chunk in response:
-                    # logger.info(f"收到chunk: {chunk}")
-                    if not chunk.choices:
-                        continue
-                    delta = chunk.choices[0].delta
-                    # logger.info(f"收到delta: {delta}")
-                    if hasattr(delta, 'content') and delta.content is not None:
-                        current_content += delta.content
-                        # 检查是否有完整的 FunctionCall
-                        yield delta.content
-                    if hasattr(delta, 'tool_calls') and delta.tool_calls:
-                        logger.info(f"[FunctionCall]2  call: delta.tool_calls={delta.tool_calls}")
-                        for call in delta.tool_calls:
-                            index = call.index
-
-                            # 初始化或更新工具调用信息
-                            if index not in tool_calls:
-                                tool_calls[index] = {
-                                    "name": "",
-                                    "id": call.id,
-                                    "parameters": {},
-                                    "arguments_buffer": ""  # 用于累积参数的JSON字符串
-                                }
-
-                            # 处理函数名称
-                            if call.function.name:
-                                tool_calls[index]["name"] += call.function.name
-
-                            # 处理参数
-                            if call.function.arguments:
-                                tool_calls[index]["arguments_buffer"] += call.function.arguments
-
-                # 解析累积的参数JSON字符串
-                for index, tool_call in tool_calls.items():
+                if deadline is not None and deadline.exhausted:
+                    # 工具发现或上一步的工具调用耗尽了预算
+                    deadline_stage = "tool" if chain_count else "llm"
+                    break
+                with tracer.span("chain.step", {"chain.step": chain_count, "llm.functions": len(openai_tools)}) as step_span:
+                    logger.info(f"当前轮数 {chain_count} / {max_chain_steps}")
+                    # logger.info(f"当前messages: {json.dumps(messages, ensure_ascii=False, indent=2)}")
+                    has_tool_calls = False
+                    response = self._stream_completion(
+                        model=os.getenv("MODEL"),
+                        messages=messages,
+                        functions=openai_tools,
+                        timeout=deadline.budget() if deadline else None
+                    )
+                    tool_calls = {}
+                    parser = FunctionCallStreamParser()
+                    # FunctionCall 片段在结束标记到达时立即开始执行
+                    batch = ToolCallBatch(self)
                     try:
-                        # 尝试解析完整的JSON
-                        tool_call["parameters"] = json.loads(tool_call["arguments_buffer"])
-                    except json.JSONDecodeError:
-                        # 如果解析失败，可能是JSON不完整（虽然流式响应应该会返回完整的JSON）
-                        logger.warning(f"警告: 工具调用参数JSON不完整: {tool_call['arguments_buffer']}")
-                        continue
-
-                    # 调用对应的工具函数
-                    async for item in self.handle_function_calling(tool_call, messages):  # 异步遍历子生成器
-                        has_tool_calls = True
-                        yield item
-
-                while True:
-                    match = re.search(r"<\|FunctionCallBegin\|>([\s\S]*?)<\|FunctionCallEnd\|>", current_content)
-                    if not match:
-                        break
-                    function_call_str = match.group(0)
-                    logger.info(f"[FunctionCall] 检测到 FunctionCall 字符串: {function_call_str}")
-                    calls = extract_function_call(function_call_str)
-                    if calls:
-                        if not isinstance(calls, list):
-                            calls = [calls]
-                        for call in calls:
-                            # yield {"tool_call": call}
-                            async for item in self.handle_function_calling(call, messages):  # 异步遍历子生成器
-                                if 'function_call' in item:
-                                    item['content'] = function_call_str
-                                yield item
+                        async for chunk in response:
+                            # logger.info(f"收到chunk: {chunk}")
+                            if not chunk.choices:
+                                continue
+                            delta = chunk.choices[0].delta
+                            # logger.info(f"收到delta: {delta}")
+                            if hasattr(delta, 'content') and delta.content is not None:
+                                for event in parser.feed(delta.content):
+                                    if event.kind == TEXT:
+                                        yield event.text
+                                    elif event.kind == INNER_THOUGHT:
+                                        yield {"inner_thought": event.body}
+                                    elif event.calls:
+                                        for call in event.calls:
+                                            batch.submit(call)
+                            if hasattr(delta, 'tool_calls') and delta.tool_calls:
+                                logger.info(f"[FunctionCall]2  call: delta.tool_calls={delta.tool_calls}")
+                                for call in delta.tool_calls:
+                                    index = call.index
+
+                                    # 初始化或更新工具调用信息
+                                    if index not in tool_calls:
+                                        tool_calls[index] = {
+                                            "name": "",
+                                            "id": call.id,
+                                            "parameters": {},
+                                            "arguments_buffer": ""  # 用于累积参数的JSON字符串
+                                        }
+
+                                    # 处理函数名称
+                                    if call.function.name:
+                                        tool_calls[index]["name"] += call.function.name
+
+                                    # 处理参数
+                                    if call.function.arguments:
+                                        tool_calls[index]["arguments_buffer"] += call.function.arguments
+                        for event in parser.close():
+                            yield event.text
+
+                        # 解析累积的参数JSON字符串
+                        for index, tool_call in sorted(tool_calls.items()):
+                            try:
+                                # 尝试解析完整的JSON
+                                tool_call["parameters"] = json.loads(tool_call["arguments_buffer"])
+                            except json.JSONDecodeError:
+                                # 如果解析失败，可能是JSON不完整（虽然流式响应应该会返回完整的JSON）
+                                logger.warning(f"警告: 工具调用参数JSON不完整: {tool_call['arguments_buffer']}")
+                                continue
+                            batch.submit(tool_call)
+
+                        # 等待本轮所有工具调用完成
+                        async for item in batch.drain(messages):
                             has_tool_calls = True
-                    # 移除已处理部分
-                    current_content = current_content.replace(function_call_str, "", 1)
-                if not has_tool_calls:
-                    logger.info(f"没有方法调用了，可以返回")
-                    break
-                else:
-                    chain_count += 1
-                    logger.info(f"有方法调用，且当前轮数 {chain_count} / {max_chain_steps}")
+                            yield item
+                    except TimeoutError:
+                        # LLM 在剩余预算内没有输出完，不再继续调用工具
+                        deadline_stage = "llm"
+                        step_span.set_attribute("deadline_exceeded", True)
+                    finally:
+                        # 取消生成时停止未完成的工具调用并关闭 LLM 流
+                        batch.cancel()
+                        await response.aclose()
+                    step_span.set_attribute("tool.calls", len(batch))
+                    if deadline_stage is not None:
+                        break
+                    if not has_tool_calls:
+                        logger.info(f"没有方法调用了，可以返回")
+                        break
+                    else:
+                        chain_count += 1
+                        logger.info(f"有方法调用，且当前轮数 {chain_count} / {max_chain_steps}")
+            if deadline_stage is not None:
+                async for item in self._final_answer(messages, deadline, deadline_stage):
+                    yield item
         except Exception as e:
             traceback.print_exc()
             logger.error(f"生成响应失败: {e}")
             yield {"error": f"生成响应失败: {e}"}
+        finally:
+            CHAIN_STEPS.observe(chain_count)
+
+    async def _stream_answer(self, messages: List[dict], timeout: Optional[float]):
+        """不带工具的流式回答，FunctionCall 片段被忽略"""
+        parser = FunctionCallStreamParser()
+        # 调用方提前关闭（如取消生成）时立即关闭 LLM 流
+        async with aclosing(self._stream_completion(model=os.getenv("MODEL"), messages=messages,
+                                                    timeout=timeout)) as response:
+            async for chunk in response:
+                if not chunk.choices:
+                    continue
+                delta = getattr(chunk.choices[0], 'delta', None)
+                if delta and getattr(delta, 'content', None):
+                    for event in parser.feed(delta.content):
+                        if event.kind == TEXT:
+                            yield event.text
+                        elif event.kind == INNER_THOUGHT:
+                            yield {"inner_thought": event.body}
+                        else:
+                            logger.warning(f"无可用工具，忽略 FunctionCall: {event.text}")
+        for event in parser.close():
+            yield event.text
+
+    async def _final_answer(self, messages: List[dict], deadline, stage: str):
+        """时限用尽：不再提供工具，用预留的时间根据已有信息给出尽力而为的最终回答"""
+        logger.warning(f"本轮处理时间已用完（{stage}），生成最终回答，剩余 {deadline.remaining():.1f}s")
+        TURN_DEADLINE_EXCEEDED.inc(stage=stage)
+        yield {"deadline_exceeded": {"stage": stage, "timeout": deadline.timeout}}
+        with tracer.span("chain.final_answer", {"deadline.stage": stage}):
+            try:
+                async for item in self._stream_answer(messages + [{"role": "system", "content": FINAL_ANSWER_PROMPT}],
+                                                      deadline.remaining()):
+                    yield item
+            except Exception as e:
+                logger.warning(f"最终回答未能完成: {e!r}")
+                yield DEADLINE_NOTICE
+
+    async def _stream_completion(self, timeout: Optional[float] = None, **kwargs):
+        """
+        发起流式补全并逐个返回 chunk，记录首 token 延迟与流总耗时。
+
+        timeout 为整个流（含建立请求）的时限，超时抛出 TimeoutError；计时只覆盖等待 LLM 的部分，
+        不把调用方在两次 yield 之间的处理时间算作超时。
+        """
+        model = kwargs.get("model") or ""
+        started = time.perf_counter()
+        expires_at = asyncio.get_running_loop().time() + timeout if timeout is not None else None
+        status = "error"
+        if os.getenv("LLM_STREAM_INCLUDE_USAGE", "").lower() in ("1", "true", "yes"):
+            # 部分兼容接口不支持 stream_options，默认不开启
+            kwargs["stream_options"] = {"include_usage": True}
+        # 不设为当前 span：两次 yield 之间调用方发起的工具调用与写入应挂在 chain.step 下
+        span = tracer.start_span("llm.stream", {"llm.model": model})
+        if span.recording:
+            span.set_attributes({"llm.messages": len(kwargs.get("messages") or []),
+                                 "llm.request_bytes": payload_size(kwargs.get("messages") or []),
+                                 "llm.functions": len(kwargs.get("functions") or [])})
+        chunks = content_chars = 0
+        response = None
+        try:
+            async with asyncio.timeout_at(expires_at):
+                response = await self.client.chat.completions.create(stream=True, **kwargs)
+            first = True
+            iterator = response.__aiter__()
+            while True:
+                try:
+                    async with asyncio.timeout_at(expires_at):
+                        chunk = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+                chunks += 1
+                delta = getattr(chunk.choices[0], 'delta', None) if chunk.choices else None
+                content = getattr(delta, 'content', None) if delta is not None else None
+                if content:
+                    content_chars += len(content)
+                # 首个只带 role 的 chunk 不计入首 token
+                if first and (content or getattr(delta, 'tool_calls', None)):
+                    first = False
+                    ttft = time.perf_counter() - started
+                    LLM_TTFT_SECONDS.observe(ttft, model=model)
+                    span.set_attribute("llm.ttft_ms", round(ttft * 1000, 2))
+                usage = getattr(chunk, 'usage', None)
+                if usage:
+                    span.set_attributes({"llm.usage.prompt_tokens": usage.prompt_tokens,
+                                         "llm.usage.completion_tokens": usage.completion_tokens})
+                yield chunk
+            status = "ok"
+        except (asyncio.CancelledError, GeneratorExit):
+            # 生成被取消或调用方提前关闭
+            status = "cancelled"
+            span.set_attribute("cancelled", True)
+            raise
+        except TimeoutError:
+            status = "timeout"
+            span.set_attribute("deadline_exceeded", True)
+            raise
+        except Exception as e:
+            span.record_exception(e)
+            raise
+        finally:
+            if response is not None and status != "ok":
+                # 释放底层 HTTP 连接，不再继续消耗 token
+                try:
+                    await response.close()
+                except Exception as e:
+                    logger.warning(f"关闭 LLM 流失败: {e}")
+            span.set_attributes({"llm.chunks": chunks, "llm.completion_chars": content_chars})
+            span.end()
+            LLM_STREAM_SECONDS.observe(time.perf_counter() - started, model=model, status=status)
+
+    async def summarize(self, previous_summary: str, messages: List[dict]) -> str:
+        """将新滑出上下文窗口的消息增量合并进已有摘要"""
+        limit = int(os.getenv("SUMMARY_TOOL_RESULT_CHARS", "1000"))
+        lines = []
+        for m in messages:
+            content = m.get("content") or ""
+            if not isinstance(content, str):
+                content = json.dumps(content, ensure_ascii=False)
+            if m.get("role") == "tool" and len(content) > limit:
+                content = content[:limit] + "...(已截断)"
+            if m.get("tool_calls"):
+                calls = ", ".join(f"{c['function']['name']}({c['function']['arguments']})" for c in m["tool_calls"])
+                content = f"{content} [调用工具: {calls}]".strip()
+            lines.append(f"{m.get('role', 'unknown')}: {content}")
+        prompt = [
+            {
+                "role": "system",
+                "content": "你负责维护对话的滚动摘要。请将新的对话内容合并进已有摘要，"
+                           "保留用户目标、关键事实、工具调用得到的重要结论和未完成事项，输出精简的中文摘要。"
+            },
+            {
+                "role": "user",
+                "content": f"已有摘要：\n{previous_summary or '（无）'}\n\n新的对话内容：\n" + "\n".join(lines)
+            }
+        ]
+        response = await self.client.chat.completions.create(
+            model=os.getenv("SUMMARY_MODEL") or os.getenv("MODEL"),
+            messages=prompt,
+            stream=False
+        )
+        return response.choices[0].message.content or previous_summary
+
+    async def aclose(self):
+        """关闭所有 MCP Server（含 stdio 进程池与回收任务）以及 LLM 客户端共享的连接池"""
+        servers = list(self.mcp_servers.values())
+        self.mcp_servers.clear()
+        results = await asyncio.gather(*(s.cleanup() for s in servers), return_exceptions=True)
+        for server, result in zip(servers, results):
+            if isinstance(result, Exception):
+                logger.error(f"关闭 MCP Server {server.name} 失败: {result}")
+        await self.client.close()
+        await self.http_client.aclose()
+        await self.embedding_service.close()
+        await self.cache.close()
 
     def generate_response(self, messages: List[dict], stream: bool = False):
         raise NotImplementedError("请使用 async_generate_response 以支持异步链式工具调用！")
 
     async def get_embedding(self, text: str) -> List[float]:
-        """获取文本嵌入向量"""
+        """获取文本嵌入向量（并发请求合并为批量调用，结果持久化在向量存储中）"""
         try:
-            # 检查缓存
-            cache_key = f"embedding_{hash(text)}"
-            cached_embedding = cache.get(cache_key)
-            if cached_embedding:
-                return cached_embedding
-
-            response = await self.client.embeddings.create(
-                model="text-embedding-ada-002",
-                input=text
-            )
-            embedding = response.data[0].embedding
-
-            # 缓存结果
-            cache.set(cache_key, embedding, persist=True)
-
-            return embedding
+            return await self.embedding_service.embed(text)
         except Exception as e:
             logger.error(f"获取嵌入向量失败: {e}")
             raise
 
-    async def handle_function_calling(self, call: dict, messages: list):
+    def _prepare_function_call(self, call: dict):
+        """校验工具调用并构造 assistant 的 function_call 消息，无法执行时返回 None"""
         name = call.get('name')
         params = call.get('parameters')
         # logger.info(f"[FunctionCall] 解析到调用2: name={name}, params={params}")
-        if name and params is not None and '.' in name:
-            server_name, tool_name = name.split('.', 1)
-            logger.info(
-                f"[FunctionCall] 自动执行: server={server_name}, "
-                f"tool={tool_name}, params={params}")
-
-            tool_call_id = call.get('id') or call.get('tool_call_id')
-            if not tool_call_id:
-                tool_call_id = f"fc_{uuid.uuid4().hex[:16]}"
-                call['id'] = tool_call_id
-                logger.warning(f"FunctionCall缺少id，已自动生成: {tool_call_id}")
-
-            function_call_msg = {
-                "role": 'assistant',
-                'tool_calls': [{
-                    'id': call['id'],
-                    'type': 'function',
-                    'function': {
-                        'name': name,
-                        'arguments': json.dumps(params)
-                    }
-                }]
-            }
-            yield {'function_call': function_call_msg}
-            messages.append(filter_llm_message(function_call_msg))
-
-            result = await self.call_mcp_tool(server_name, tool_name, params)
-            logger.info(f"[FunctionCall] call: {call} 执行结果: {result}")
-
-            def convert_text_content(obj):
-                if isinstance(obj, dict):
-                    return {k: convert_text_content(v) for k, v in obj.items()}
-                elif isinstance(obj, list):
-                    return [convert_text_content(item) for item in obj]
-                elif hasattr(obj, 'text') or hasattr(obj, '__str__'):
-                    # 假设 TextContent 对象有 text 属性或者可以直接转换为字符串
-                    return str(obj)
-                else:
-                    return obj
-
-            # 在序列化之前使用这个函数处理数据
-            data_to_serialize = convert_text_content(result)
-            json_result = json.dumps(data_to_serialize, ensure_ascii=False)
-
-            tool_result = {
-                "role": "tool",
-                'name': name,
-                "content": json_result,
-                'call': call,
-                "tool_call_id": tool_call_id
-            }
-            messages.append(filter_llm_message(tool_result))
-            # 用于保存到数组中
-            yield {"tool_result": tool_result}
-            # has_tool_calls = True
-        else:
+        if not (name and params is not None and '.' in name):
             logger.warning(f"find no tool call for {call}")
+            return None
+        server_name, tool_name = name.split('.', 1)
+        logger.info(
+            f"[FunctionCall] 自动执行: server={server_name}, "
+            f"tool={tool_name}, params={params}")
+
+        tool_call_id = call.get('id') or call.get('tool_call_id')
+        if not tool_call_id:
+            tool_call_id = f"fc_{uuid.uuid4().hex[:16]}"
+            call['id'] = tool_call_id
+            logger.warning(f"FunctionCall缺少id，已自动生成: {tool_call_id}")
+
+        function_call_msg = {
+            "role": 'assistant',
+            'tool_calls': [{
+                'id': call['id'],
+                'type': 'function',
+                'function': {
+                    'name': name,
+                    'arguments': json.dumps(params)
+                }
+            }]
+        }
+        return {
+            "call": call,
+            "message": function_call_msg,
+            "server": server_name,
+            "tool": tool_name,
+            "params": params,
+            "id": tool_call_id
+        }
+
+    @staticmethod
+    def _build_tool_result(call: dict, name: str, tool_call_id: str, result: Any) -> dict:
+        def convert_text_content(obj):
+            if isinstance(obj, dict):
+                return {k: convert_text_content(v) for k, v in obj.items()}
+            elif isinstance(obj, list):
+                return [convert_text_content(item) for item in obj]
+            elif hasattr(obj, 'text') or hasattr(obj, '__str__'):
+                # 假设 TextContent 对象有 text 属性或者可以直接转换为字符串
+                return str(obj)
+            else:
+                return obj
+
+        # 在序列化之前使用这个函数处理数据
+        data_to_serialize = convert_text_content(result)
+        json_result = json.dumps(data_to_serialize, ensure_ascii=False)
+
+        return {
+            "role": "tool",
+            'name': name,
+            "content": json_result,
+            'call': call,
+            "tool_call_id": tool_call_id,
+            "is_error": _is_error_result(result)
+        }
 
-    def add_mcp_server(self, server: dict) -> None:
-        """添加一个 MCP Server 到服务列表
+    async def add_mcp_server(self, server: dict) -> None:
+        """添加一个 MCP Server 到服务列表，同名服务器已存在时先清理旧实例（stdio 进程池等）
 
         Args:
             server: 服务器配置字典
@@ -505,22 +713,40 @@ class LLMService:
             return
         name = server["name"]
         mode = server.get("mode", "sse")
+        previous = self.mcp_servers.pop(name, None)
+        if previous is not None and hasattr(previous, "cleanup"):
+            try:
+                await previous.cleanup()
+            except Exception as e:
+                logger.error(f"清理旧的 MCP Server {name} 失败: {e}")
         if mode == "stdio":
             self.mcp_servers[name] = StdioMCPServer(name, server)
         else:
-            self.mcp_servers[name] = FastMCPServer(name, server)
+            self.mcp_servers[name] = SSEMCPServer(name, server)
+        self.tool_catalog.invalidate(name)
+        self.tool_catalog.watch(self.mcp_servers[name])
+        self.tool_result_cache.invalidate(name)
+        self.health.forget(name)
+        self.limiter.forget(name)
         logger.info(f"添加 MCP Server: {name}")
 
-    def remove_mcp_server(self, server_name: str) -> None:
-        """从服务列表中移除一个 MCP Server
+    async def remove_mcp_server(self, server_name: str) -> None:
+        """从服务列表中移除一个 MCP Server，并等待其释放资源（stdio 进程池等）
 
         Args:
             server_name: 服务器名称
         """
-        if server_name in self.mcp_servers:
-            server = self.mcp_servers[server_name]
-            # 确保清理资源
-            if hasattr(server, "cleanup"):
-                asyncio.create_task(server.cleanup())
-            del self.mcp_servers[server_name]
-            logger.info(f"移除 MCP Server: {server_name}")
+        server = self.mcp_servers.pop(server_name, None)
+        if server is None:
+            return
+        self.tool_catalog.invalidate(server_name)
+        self.tool_result_cache.invalidate(server_name)
+        self.health.forget(server_name)
+        self.limiter.forget(server_name)
+        # 确保清理资源
+        if hasattr(server, "cleanup"):
+            try:
+                await server.cleanup()
+            except Exception as e:
+                logger.error(f"清理 MCP Server {server_name} 失败: {e}")
+        logger.info(f"移除 MCP Server: {server_name}")
@@ -1,9 +1,10 @@
 import sys
-from typing import List, Optional
+from contextlib import aclosing
+from typing import Dict, List, Optional, Set
 
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Request, Body
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, Body, Query, Response
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
 import uvicorn
 import logging
@@ -11,12 +12,14 @@ from mcp_agent.llm_service import LLMService, convert_obj_id
 from datetime import datetime
 import json
 from mcp_agent.session_manager import AsyncSessionManager
+from mcp_agent.context_builder import ContextBuilder
+from mcp_agent.generation_state import create_generation_state
+from mcp_agent.admission import AdmissionController, AdmissionRejected
+from mcp_agent.deadline import TURN_DEADLINE, Deadline, deadline_scope
 import os
-import re
-from pymongo import MongoClient
-import httpx
 from mcp_agent.mcp_server_dao import MCPServerDAO
-from bson import ObjectId
+from mcp_agent.metrics import registry, ACTIVE_STREAMS, MONGO_WRITES_PER_TURN, CONTENT_TYPE
+from mcp_agent.tracing import tracer
 import asyncio
 
 load_dotenv()
@@ -31,13 +34,27 @@ logger = logging.getLogger(__name__)
 
 # 全局变量
 llm_service = None
-completion_tasks = {}
 
 # 初始化异步会话管理器
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/mcp")
 session_manager = AsyncSessionManager(MONGO_URI)
-server_dao = MCPServerDAO()
+# 正在生成的回复（GENERATION_STATE_BACKEND=mongo 时多 worker 共享）
+completion_tasks = create_generation_state(session_manager.db)
+# MCP Server 配置与会话共用同一个 Motor 连接池
+server_dao = MCPServerDAO(session_manager.db)
 llm_service = LLMService(server_dao)
+context_builder = ContextBuilder(llm_service, session_manager)
+registry.gauge("mcp_generations_in_progress", "本 worker 正在生成的回复数（completion_tasks）",
+               callback=lambda: len(completion_tasks))
+# 补全接口的准入控制，超出并发与排队上限时快速返回 429/503
+admission = AdmissionController()
+registry.gauge("mcp_generation_admission_active", "已获得准入名额的补全请求数",
+               callback=lambda: admission.active)
+# 本 worker 上正在执行的生成任务：chat_id -> Task
+active_turns: Dict[str, asyncio.Task] = {}
+_background_tasks: Set[asyncio.Task] = set()
+# SSE 客户端断开后等待重新订阅（如刷新页面）的秒数，期间无人接收则取消生成
+DISCONNECT_GRACE = float(os.getenv("GENERATION_DISCONNECT_GRACE", "5"))
 
 class ChatMessage(BaseModel):
     """聊天消息模型"""
@@ -63,10 +80,31 @@ class ChatResponse(BaseModel):
 
 class CompletionRequest(BaseModel):
     message: str
+    # 本轮时限（秒），不超过 TURN_DEADLINE
+    timeout: Optional[float] = None
 
 app = FastAPI()
 
 
+@app.on_event("startup")
+async def on_startup():
+    """初始化索引、生成状态后端并加载 MCP Server 列表"""
+    await session_manager.init_indexes()
+    await session_manager.backfill_counters()
+    await completion_tasks.init()
+    await llm_service.update_mcp_servers()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    """取消进行中的生成并保存已生成部分，写入缓冲消息并关闭共享连接池"""
+    await asyncio.gather(*(cancel_turn(chat_id) for chat_id in list(active_turns)))
+    await session_manager.close()
+    if llm_service:
+        await llm_service.aclose()
+    await tracer.shutdown()
+
+
 @app.get("/health")
 async def health_check():
     """健康检查接口"""
@@ -75,17 +113,39 @@ async def health_check():
         "timestamp": datetime.now().isoformat(),
         "services": {
             "llm_service": "running" if llm_service else "stopped"
+        },
+        # 补全请求的准入情况：进行中、排队与拒绝次数
+        "generations": admission.snapshot(),
+        # 各 MCP Server 的熔断状态、健康评分与并发/排队情况
+        "mcp_servers": {
+            name: {**llm_service.health.snapshot(name), "load": llm_service.limiter.snapshot(name)}
+            for name in llm_service.mcp_servers
         }
     }
 
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 文本格式的指标"""
+    return PlainTextResponse(registry.render(), media_type=CONTENT_TYPE)
+
+
 @app.get("/sessions")
-async def list_sessions():
-    sessions = await session_manager.list_sessions()
+async def list_sessions(response: Response, limit: Optional[int] = Query(None, ge=1, le=200),
+                        before: Optional[str] = None):
+    """分页列出会话，下一页游标通过 X-Next-Cursor 响应头返回"""
+    try:
+        sessions, next_cursor = await session_manager.list_sessions(limit=limit, before=before)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     return [{
         "_id": s["_id"],
         "name": s["name"],
-        "title": s["name"] or "新会话"
+        "title": s["name"] or "新会话",
+        "message_count": s["message_count"],
+        "updated_at": s["updated_at"]
     } for s in sessions]
 
 
@@ -99,6 +159,140 @@ async def create_session():
     }
 
 
+async def run_turn(chat_id: str, messages: list, channel, turn_span, ticket, deadline: Deadline,
+                   events: asyncio.Queue):
+    """
+    在独立任务中执行一轮生成，SSE 事件放入 events（None 表示结束）。
+    deadline 随上下文传给每个 LLM 轮次与工具调用，用尽时以尽力而为的回答结束本轮。
+
+    被取消（取消接口、客户端断开或同一会话发起新一轮）时关闭 LLM 流与未完成的工具调用，
+    已生成的部分照常保存；无论结果如何都会释放生成名额、生成状态登记与本轮 trace。
+    """
+    response_text = ""
+    # 本轮 InnerThought 片段，随 AI 消息一起保存
+    inner_thoughts = []
+    cancelled = False
+    # 取消请求经生成状态通道转为取消本任务；在任务内注册，避免任务开始执行前被取消时跳过清理
+    channel.on_cancel = asyncio.current_task().cancel
+    try:
+        with tracer.activate(turn_span), deadline_scope(deadline):
+            start_event = {"status": "start"}
+            if turn_span.recording:
+                # 便于按 trace_id 在导出的追踪数据中定位本轮
+                start_event["trace_id"] = turn_span.trace_id
+            events.put_nowait(f"data: {json.dumps(start_event)}\n\n")
+            try:
+                if channel.cancel_requested:
+                    # 任务开始执行前已被取消
+                    raise asyncio.CancelledError
+                async with aclosing(llm_service.async_generate_response(messages, stream=True)) as stream:
+                    async for chunk in stream:
+                        if isinstance(chunk, dict):
+                            logger.info(f"Received dict chunk: {chunk}")
+                            if "error" in chunk:
+                                # 发生错误，返回错误信息
+                                response_text = f"错误: {chunk['error']}"
+                                events.put_nowait(f"data: {{\"error\": {json.dumps(chunk['error'], ensure_ascii=False)} }}\n\n")
+                            elif "function_call" in chunk:
+                                msg = chunk["function_call"]
+                                msg['session_id'] = chat_id
+                                await session_manager.add_message_obj(msg)
+                                events.put_nowait(f"data: {{\"function_call\": {json.dumps(convert_obj_id(msg), ensure_ascii=False)} }}\n\n")
+                            elif "tool_result" in chunk:
+                                tool_result = chunk["tool_result"]
+                                tool_result['session_id'] = chat_id
+                                await session_manager.add_message_obj(tool_result)
+                                events.put_nowait(f"data: {{\"tool_result\": {json.dumps(convert_obj_id(tool_result), ensure_ascii=False)} }}\n\n")
+                            elif "degraded_servers" in chunk:
+                                events.put_nowait(f"data: {{\"degraded_servers\": {json.dumps(chunk['degraded_servers'], ensure_ascii=False)} }}\n\n")
+                            elif "inner_thought" in chunk:
+                                inner_thoughts.append(chunk["inner_thought"])
+                                events.put_nowait(f"data: {{\"inner_thought\": {json.dumps(chunk['inner_thought'], ensure_ascii=False)} }}\n\n")
+                            elif "deadline_exceeded" in chunk:
+                                turn_span.set_attribute("deadline_exceeded", chunk["deadline_exceeded"]["stage"])
+                                events.put_nowait(f"data: {{\"deadline_exceeded\": {json.dumps(chunk['deadline_exceeded'], ensure_ascii=False)} }}\n\n")
+                        elif isinstance(chunk, str):
+                            # LLMService 已通过增量解析器剥离 InnerThought 与 FunctionCall 片段
+                            response_text += chunk
+                            channel.publish(chunk)
+                            events.put_nowait(f"data: {{\"response\": {json.dumps(chunk, ensure_ascii=False)} }}\n\n")
+            except asyncio.CancelledError:
+                # 取消只中断生成本身，继续保存已生成的部分
+                asyncio.current_task().uncancel()
+                cancelled = True
+                turn_span.set_attribute("cancelled", True)
+                logger.info(f"[completion] 会话 {chat_id} 的生成已取消，已生成 {len(response_text)} 个字符")
+            # 生成已结束，之后的取消请求不再打断保存
+            channel.on_cancel = None
+            # 4. 追加AI消息
+            ai_message = {
+                'session_id': chat_id,
+                'role': 'assistant',
+                'content': response_text
+            }
+            if inner_thoughts:
+                ai_message['inner_thoughts'] = inner_thoughts
+            if cancelled:
+                ai_message['cancelled'] = True
+            await session_manager.add_message_obj(ai_message)
+            # 回合结束，写入缓冲的消息
+            await session_manager.flush(chat_id)
+            events.put_nowait(f"data: {{\"update_msg\": {json.dumps(convert_obj_id(ai_message), ensure_ascii=False)} }}\n\n")
+            if cancelled:
+                events.put_nowait('data: {"cancelled": true}\n\n')
+            events.put_nowait('data: {"finish": true}\n\n')
+    except Exception as e:
+        logger.exception(f"[completion] 会话 {chat_id} 的生成失败: {e}")
+        events.put_nowait(f"data: {{\"error\": {json.dumps(f'生成失败: {e}', ensure_ascii=False)} }}\n\n")
+    finally:
+        channel.on_cancel = None
+        try:
+            # 任务结束，移除生成中登记
+            await completion_tasks.finish(chat_id, channel)
+        except Exception as e:
+            logger.error(f"[completion] 结束会话 {chat_id} 的生成状态失败: {e}")
+        ticket.release()
+        if active_turns.get(chat_id) is asyncio.current_task():
+            del active_turns[chat_id]
+        writes = session_manager.pop_turn_writes(chat_id)
+        MONGO_WRITES_PER_TURN.observe(writes)
+        turn_span.set_attributes({"mongo.writes": writes, "response.chars": len(response_text)})
+        turn_span.end()
+        events.put_nowait(None)
+
+
+def on_client_disconnect(chat_id: str) -> None:
+    """SSE 客户端在生成结束前断开：宽限期内没有客户端重新订阅（如刷新页面）则取消本 worker 上的生成"""
+    task = active_turns.get(chat_id)
+    if task is None or task.done():
+        return
+    channel = completion_tasks.get(chat_id)
+    if channel is not None and channel.consumers > 0:
+        # 发起本轮的 POST 流仍在接收，其他标签页关闭不影响生成
+        return
+
+    async def cancel_if_abandoned():
+        tracer.detach()
+        await asyncio.sleep(DISCONNECT_GRACE)
+        if active_turns.get(chat_id) is task and not await completion_tasks.has_subscribers(chat_id):
+            logger.info(f"[completion] 会话 {chat_id} 的客户端已断开，取消生成")
+            await completion_tasks.cancel(chat_id)
+
+    watcher = asyncio.create_task(cancel_if_abandoned())
+    _background_tasks.add(watcher)
+    watcher.add_done_callback(_background_tasks.discard)
+
+
+async def cancel_turn(chat_id: str, timeout: float = 5) -> bool:
+    """请求取消会话的生成，并等待本 worker 上的生成任务保存已生成的部分"""
+    task = active_turns.get(chat_id)
+    if not await completion_tasks.cancel(chat_id):
+        return False
+    if task is not None:
+        await asyncio.wait({task}, timeout=timeout)
+    return True
+
+
 @app.post("/chat/{chat_id}/session/completion")
 async def chat_session_completion(chat_id: str, req: CompletionRequest):
     """
@@ -107,87 +301,79 @@ async def chat_session_completion(chat_id: str, req: CompletionRequest):
     session = await session_manager.get_session(chat_id)
     if not session:
         raise HTTPException(status_code=404, detail="会话不存在")
-    # 1. 追加用户消息
-    await session_manager.add_message(
-        session_id=chat_id,
-        role="user",
-        content=req.message
-    )
-    # 2. 获取历史消息
-    messages = await session_manager.get_messages(chat_id)
-    for m in messages:
-        m.pop('_id', None)
-    response_text = ""
-    tool_results = []
+    # 本轮时限从收到请求开始计算，排队与准备上下文也计入
+    deadline = Deadline(min(req.timeout, TURN_DEADLINE) if req.timeout and req.timeout > 0 else TURN_DEADLINE)
+    # 同一会话发起新一轮时取消仍在进行的上一轮
+    await cancel_turn(chat_id)
+    # 每轮对话一个 trace，准备阶段与流式生成阶段共用同一个根 span
+    turn_span = tracer.start_span("chat.turn", {"session.id": chat_id, "message.chars": len(req.message)}, root=True)
+    ticket = None
+    try:
+        with tracer.activate(turn_span):
+            # 0. 获取生成名额，被拒绝时不写入用户消息
+            ticket = await admission.acquire()
+            turn_span.set_attribute("admission.wait_ms", round(ticket.waited * 1000, 1))
+            # 1. 追加用户消息
+            await session_manager.add_message(
+                session_id=chat_id,
+                role="user",
+                content=req.message
+            )
+            # 2. 获取历史消息，并按 token 预算组装上下文（较早的消息并入滚动摘要）
+            with tracer.span("context.build") as span:
+                messages = await session_manager.get_messages(chat_id)
+                for m in messages:
+                    m.pop('_id', None)
+                span.set_attribute("context.history_messages", len(messages))
+                # 摘要生成计入本轮时限
+                with deadline_scope(deadline):
+                    messages = await context_builder.build(chat_id, messages, session.summary)
+                span.set_attribute("context.messages", len(messages))
+            # 3. 标记任务为生成中，刷新页面的订阅方通过该通道接收增量
+            channel = await completion_tasks.start(chat_id)
+    except AdmissionRejected as e:
+        logger.warning(f"[admission] 拒绝会话 {chat_id} 的补全请求: {e}")
+        turn_span.set_attribute("admission.rejected", e.reason)
+        turn_span.end()
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except BaseException:
+        if ticket:
+            ticket.release()
+        turn_span.end()
+        raise
+
+    # 生成在独立任务中执行，SSE 连接只负责转发事件，断开时不会让生成悬挂或泄漏登记
+    events: asyncio.Queue = asyncio.Queue()
+    active_turns[chat_id] = asyncio.create_task(run_turn(chat_id, messages, channel, turn_span, ticket, deadline, events))
 
     async def event_stream():
-        # 标记任务为生成中
-        completion_tasks[chat_id] = {"status": "generating", "content": ""}
-        yield 'data: {"status": "start"}\n\n'
-        nonlocal response_text, tool_results
-
-        async for chunk in llm_service.async_generate_response(messages, stream=True):
-            if isinstance(chunk, dict):
-                logger.info(f"Received dict chunk: {chunk}")
-                if "error" in chunk:
-                    # 发生错误，返回错误信息
-                    response_text = f"错误: {chunk['error']}"
-                    yield f"data: {{\"error\": {json.dumps(chunk['error'], ensure_ascii=False)} }}\n\n"
-                elif "function_call" in chunk:
-                    msg = chunk["function_call"]
-                    msg['session_id'] = chat_id
-                    await session_manager.add_message_obj(msg)
-                    yield f"data: {{\"function_call\": {json.dumps(convert_obj_id(msg), ensure_ascii=False)} }}\n\n"
-                elif "tool_result" in chunk:
-                    tool_result = chunk["tool_result"]
-                    tool_result['session_id'] = chat_id
-                    await session_manager.add_message_obj(tool_result)
-                    yield f"data: {{\"tool_result\": {json.dumps(convert_obj_id(tool_result), ensure_ascii=False)} }}\n\n"
-            elif isinstance(chunk, str):
-                response_text += chunk
-                # 检查 FunctionCall
-                pattern_fc = r"<\|FunctionCallBegin\|>([\s\S]*?)<\|FunctionCallEnd\|>"
-                for match in re.finditer(pattern_fc, chunk):
-                    try:
-                        fc_json = match.group(1)
-                        calls = json.loads(fc_json)
-                        if not isinstance(calls, list):
-                            calls = [calls]
-                        for call in calls:
-                            await session_manager.add_message(
-                                session_id=chat_id,
-                                role="assistant",
-                                content=match.group(0),
-                                tool_call=call,
-                                type="tool_call"
-                            )
-                    except Exception as e:
-                        logger.error(f"FunctionCall解析失败: {e}, 内容: {match.group(1)}")
-                # 移除 FunctionCall 片段后再保存主回复
-                chunk_no_fc = re.sub(pattern_fc, '', chunk)
-                completion_tasks[chat_id]["content"] = response_text
-                yield f"data: {{\"response\": {json.dumps(chunk_no_fc, ensure_ascii=False)} }}\n\n"
-        # 4. 追加AI消息
-        # 移除 InnerThought 和 FunctionCall 片段，只保留自然语言内容
-        pattern_inner = r"<InnerThoughtBegin>[\s\S]*?<InnerThoughtEnd>"
-        pattern_fc = r"<\|FunctionCallBegin\|>[\s\S]*?<\|FunctionCallEnd\|>"
-        clean_content = re.sub(pattern_inner, '', response_text)
-        clean_content = re.sub(pattern_fc, '', clean_content)
-
-        ai_message = {
-            'session_id': chat_id,
-            'role': 'assistant',
-            'content': clean_content
-        }
-        await session_manager.add_message_obj(ai_message)
-        yield f"data: {{\"update_msg\": {json.dumps(convert_obj_id(ai_message), ensure_ascii=False)} }}\n\n"
-        # 任务完成
-        completion_tasks.pop(chat_id, None)
-        yield f"data: {{\"finish\": true}}\n\n"
+        ACTIVE_STREAMS.inc(endpoint="completion")
+        channel.attach()
+        finished = False
+        try:
+            while True:
+                event = await events.get()
+                if event is None:
+                    finished = True
+                    break
+                yield event
+        finally:
+            ACTIVE_STREAMS.dec(endpoint="completion")
+            channel.detach()
+            if not finished:
+                on_client_disconnect(chat_id)
 
     return StreamingResponse(event_stream(), media_type="text/event-stream")
 
 
+@app.post("/chat/{chat_id}/session/cancel")
+async def cancel_chat_completion(chat_id: str):
+    """取消会话正在进行的生成，已生成的部分保存为一条 AI 消息"""
+    if not await cancel_turn(chat_id):
+        raise HTTPException(status_code=404, detail="没有进行中的生成")
+    return {"cancelled": True}
+
+
 @app.delete("/chat/{chat_id}/session")
 async def delete_chat_session(chat_id: str):
     """
@@ -210,75 +396,103 @@ async def clear_chat_session(chat_id: str):
     raise HTTPException(status_code=404, detail="会话不存在")
 
 
+@app.get("/chat/{chat_id}/messages")
+async def list_chat_messages(chat_id: str, before: Optional[str] = None,
+                             limit: Optional[int] = Query(None, ge=1, le=200), full: bool = False):
+    """
+    按时间倒序分页获取历史消息，每页内按时间正序返回。
+    before 为上一页返回的 next_cursor；默认返回精简字段，full=true 时返回完整消息。
+    """
+    try:
+        messages, next_cursor = await session_manager.get_message_page(chat_id, before=before, limit=limit, full=full)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"messages": convert_obj_id(messages), "next_cursor": next_cursor}
+
+
+@app.get("/chat/{chat_id}/messages/{message_id}")
+async def get_chat_message(chat_id: str, message_id: str):
+    """获取单条完整消息（如被截断的工具结果）"""
+    message = await session_manager.get_message(chat_id, message_id)
+    if not message:
+        raise HTTPException(status_code=404, detail="消息不存在")
+    return convert_obj_id(message)
+
+
 @app.get("/chat/{chat_id}/completion")
 async def get_chat_completion_status(chat_id: str):
     """
-    刷新聊天页面时，流式返回历史消息列表（每条data: ...），以及正在生成的AI消息（如有）。
-    前端只需监听此接口即可获取全部历史和生成中消息。
+    刷新聊天页面时，流式返回最近一页历史消息（每条data: ...），以及正在生成的AI消息（如有）。
+    更早的消息通过 history_cursor 调用 /chat/{chat_id}/messages 按需加载。
     """
 
     async def event_stream():
-        # 1. 先返回历史消息
-        messages = await session_manager.get_messages(chat_id)
-        for m in messages:
-            yield f'data: {json.dumps(convert_obj_id(m), ensure_ascii=False)}\n\n'
-        # 2. 持续返回生成中的AI消息（如有）
-        last_content = None
-        while True:
-            task = completion_tasks.get(chat_id)
-            if not task:
-                break  # 任务已完成，跳出循环
-            content = task.get("content", "")
-            if content != last_content:
-                last_content = content
-                data = {
-                    "id": f"{chat_id}-generating",
-                    "role": "assistant",
-                    "content": content,
-                    "timestamp": None,
-                    "loading": True
-                }
-                json_str = json.dumps(data, ensure_ascii=False)
-                yield f"data: {json_str}\n\n"
-            await asyncio.sleep(0.5)  # 降低频率，减少CPU占用
-        # 3. 结束标记
-        yield 'data: {"finish": true}\n\n'
+        ACTIVE_STREAMS.inc(endpoint="resume")
+        finished = False
+        try:
+            # 1. 先返回最近一页历史消息
+            messages, next_cursor = await session_manager.get_message_page(chat_id)
+            yield f'data: {json.dumps({"history_cursor": next_cursor}, ensure_ascii=False)}\n\n'
+            for m in messages:
+                yield f'data: {json.dumps(convert_obj_id(m), ensure_ascii=False)}\n\n'
+            # 2. 订阅生成中的AI消息（如有）：先推送一次快照，之后只推送增量
+            # 生成可能运行在任意 worker 上，由生成状态后端负责跨 worker 订阅
+            # 断开时立即关闭订阅，使订阅数在判断是否取消前已更新
+            async with aclosing(completion_tasks.subscribe(chat_id)) as subscription:
+                async for event in subscription:
+                    data = {
+                        "id": f"{chat_id}-generating",
+                        "role": "assistant",
+                        "timestamp": None,
+                        "loading": True,
+                        "seq": event["seq"]
+                    }
+                    if event["type"] == "snapshot":
+                        data["content"] = event["content"]
+                    else:
+                        data["delta"] = event["delta"]
+                    yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+            # 3. 结束标记
+            yield 'data: {"finish": true}\n\n'
+            finished = True
+        finally:
+            ACTIVE_STREAMS.dec(endpoint="resume")
+            if not finished:
+                on_client_disconnect(chat_id)
 
     return StreamingResponse(event_stream(), media_type="text/event-stream")
 
 
 # MCP Server 管理相关接口
 
-def get_servers_collection():
-    client = MongoClient(MONGO_URI)
-    db = client.get_default_database()
-    return db.servers
-
-
 @app.get("/servers")
 async def list_mcp_servers():
-    col = get_servers_collection()
-    servers = list(col.find({}))
+    servers = await server_dao.list_all()
     # _id 转字符串，前端需要
     for s in servers:
         s["_id"] = str(s["_id"])
+        if s.get("name") in llm_service.mcp_servers:
+            s["health"] = llm_service.health.snapshot(s["name"])
+            s["load"] = llm_service.limiter.snapshot(s["name"])
     return servers
 
 
 @app.post("/server")
 async def save_mcp_server(server: dict):
-    col = get_servers_collection()
     name = server.get("name")
     if not name:
         raise HTTPException(status_code=400, detail="服务器名称不能为空")
 
     _id = server.get("_id")
+    # 健康状态与负载为运行时数据，不写入配置
+    server.pop("health", None)
+    server.pop("load", None)
 
     # _id = server.pop("_id")
     logger.info(f"save_mcp_server  _id: {_id}, server: {server}")
     if _id:
         server.pop("_id")
-        col.update_one({"_id": ObjectId(_id)}, {"$set": server}, upsert=True)
+        await server_dao.update(_id, server, upsert=True)
     else:
         args = server.get("args")
         if isinstance(args, str):
@@ -288,15 +502,13 @@ async def save_mcp_server(server: dict):
                     server["args"] = parsed
             except Exception:
                 pass
-        col.insert_one(server)
+        await server_dao.insert(server)
     return {"ok": True}
 
 
 @app.delete("/server/{server_id}")
 async def delete_mcp_server(server_id: str):
-    col = get_servers_collection()
-    result = col.delete_one({"_id": ObjectId(server_id)})
-    if result.deleted_count:
+    if await server_dao.delete(server_id):
         return {"ok": True}
     raise HTTPException(status_code=404, detail="未找到该服务器")
 
@@ -306,11 +518,7 @@ async def get_server_abilities(_id: str):
     """
     获取指定MCP Server的能力列表（/list_tools）
     """
-    col = get_servers_collection()
-    try:
-        server = col.find_one({"_id": ObjectId(_id)})
-    except Exception as e:
-        server = col.find_one({"_id": _id})
+    server = await server_dao.get(_id)
     if not server:
         raise HTTPException(status_code=404, detail="未找到该服务器")
     mode = server.get("mode", "sse")
@@ -319,11 +527,9 @@ async def get_server_abilities(_id: str):
     if not mcp_server:
         raise HTTPException(status_code=404, detail="未找到该STDIO服务器实例")
     try:
-        logger.info(f"{mode} 服务器配置: {mcp_server.config}")
-        await mcp_server.initialize()
-        tools = await mcp_server.list_tools()
-        logger.info(f"{mode} 服务器能力: {tools}")
-        return {"functions": tools}
+        entry = await llm_service.tool_catalog.get_entry(mcp_server)
+        logger.info(f"{mode} 服务器能力: {entry.tools}")
+        return {"functions": entry.tools}
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -336,29 +542,23 @@ async def set_server_enabled(_id: str, data: dict = Body(...)):
     """
     启用/禁用指定id的server，支持热加载/卸载
     """
-    global llm_service
     enabled = data.get("enabled")
     if enabled is None:
         raise HTTPException(status_code=400, detail="缺少enabled字段")
-    col = get_servers_collection()
-    try:
-        result = col.update_one({"_id": ObjectId(_id)}, {"$set": {"enabled": enabled}})
-    except Exception as e:
-        result = col.update_one({"_id": _id}, {"$set": {"enabled": enabled}})
-    if result.matched_count == 0:
+    server = await server_dao.set_enabled(_id, enabled)
+    if server is None:
         raise HTTPException(status_code=404, detail="未找到该服务器")
-    server = col.find_one({"_id": ObjectId(_id)}) if result.matched_count else col.find_one({"_id": _id})
     if server:
         server["_id"] = str(server["_id"])
         server_name = server.get("name", "未知服务器")
         if enabled:
             logger.info(f"正在启用服务器: {server_name}")
-            llm_service.add_mcp_server(server)
+            await llm_service.add_mcp_server(server)
             # llm_service.update_mcp_servers()
             logger.info(f"服务器 {server_name} 已启用并完成热加载")
         else:
             logger.info(f"正在禁用服务器: {server_name}")
-            llm_service.remove_mcp_server(server["name"])
+            await llm_service.remove_mcp_server(server["name"])
             # llm_service.update_mcp_servers()
             logger.info(f"服务器 {server_name} 已禁用并完成热卸载")
         return server
@@ -367,11 +567,7 @@ async def set_server_enabled(_id: str, data: dict = Body(...)):
 
 def main():
     """主函数"""
-    global llm_service
-    from mcp_agent.mcp_server_dao import MCPServerDAO
-    server_dao = MCPServerDAO()
     try:
-        llm_service = LLMService(server_dao)
         uvicorn.run(app, host="0.0.0.0", port=8000)
     except KeyboardInterrupt:
         logger.info("收到退出信号")
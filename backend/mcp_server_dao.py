@@ -1,11 +1,43 @@
+from typing import List, Optional
+
+from bson import ObjectId
+
+
+def _id_filter(_id) -> dict:
+    """兼容 ObjectId 与字符串形式的 _id"""
+    if isinstance(_id, str) and ObjectId.is_valid(_id):
+        return {"_id": ObjectId(_id)}
+    return {"_id": _id}
+
+
 class MCPServerDAO:
-    """MCP Server 数据库访问对象"""
-    def __init__(self, mongo_uri=None):
-        from pymongo import MongoClient
-        import os
-        self.mongo_uri = mongo_uri or os.getenv('MONGO_URI')
-        self.client = MongoClient(self.mongo_uri)
-        self.db = self.client.get_default_database()
-
-    def list_servers(self):
-        return list(self.db.servers.find({"enabled": {"$ne": False}}))
\ No newline at end of file
+    """MCP Server 数据库访问对象（异步，复用会话管理器的 Motor 连接池）"""
+    def __init__(self, db):
+        self.collection = db.servers
+
+    async def list_servers(self) -> List[dict]:
+        """列出已启用的服务器"""
+        return [s async for s in self.collection.find({"enabled": {"$ne": False}})]
+
+    async def list_all(self) -> List[dict]:
+        return [s async for s in self.collection.find({})]
+
+    async def get(self, _id) -> Optional[dict]:
+        return await self.collection.find_one(_id_filter(_id))
+
+    async def insert(self, server: dict):
+        return await self.collection.insert_one(server)
+
+    async def update(self, _id, fields: dict, upsert: bool = False):
+        return await self.collection.update_one(_id_filter(_id), {"$set": fields}, upsert=upsert)
+
+    async def delete(self, _id) -> bool:
+        result = await self.collection.delete_one(_id_filter(_id))
+        return result.deleted_count > 0
+
+    async def set_enabled(self, _id, enabled: bool) -> Optional[dict]:
+        """更新启用状态并返回最新文档，未找到时返回 None"""
+        result = await self.update(_id, {"enabled": enabled})
+        if result.matched_count == 0:
+            return None
+        return await self.get(_id)
@@ -0,0 +1,217 @@
+import bisect
+import math
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# 默认的延迟分桶（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """单调递增计数器"""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}"
+                for k, v in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    """可增减的瞬时值；传入 callback 时在导出时取值"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 callback: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self.callback = callback
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        if self.callback is not None:
+            try:
+                return [f"{self.name} {_format_value(self.callback())}"]
+            except Exception:
+                return []
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}"
+                for k, v in sorted(self._values.items())]
+
+
+class Histogram(_Metric):
+    """分桶直方图，observe 只做一次二分查找与两次累加"""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 每组标签：[各桶计数（非累计）..., +Inf 桶计数, sum]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        row = self._values.get(key)
+        if row is None:
+            row = self._values[key] = [0] * (len(self.buckets) + 2)
+        row[bisect.bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """记录代码块耗时（秒）"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels) -> int:
+        row = self._values.get(self._key(labels))
+        return int(sum(row[:-1])) if row else 0
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, row in sorted(self._values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (math.inf,), row[:-1]):
+                cumulative += n
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(row[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """指标注册表，按 Prometheus 文本格式导出"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            if type(existing) is not type(metric):
+                raise ValueError(f"指标 {metric.name} 已以其他类型注册")
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+              callback: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames, callback))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def get(self, name: str) -> Optional[_Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        return "\n".join(m.render() for m in self._metrics.values()) + "\n"
+
+
+registry = Registry()
+
+# 各阶段指标，由 ToolCatalog / LLMService / AsyncSessionManager / main 记录
+TOOL_DISCOVERY_SECONDS = registry.histogram(
+    "mcp_tool_discovery_seconds", "单个 MCP Server 拉取工具列表的耗时", ("server", "status"))
+TOOL_DISCOVERY_DEGRADED = registry.counter(
+    "mcp_tool_discovery_degraded_total", "工具发现中被降级的服务器次数", ("server", "reason"))
+LLM_TTFT_SECONDS = registry.histogram(
+    "mcp_llm_ttft_seconds", "LLM 流式请求从发起到首个内容 chunk 的耗时", ("model",))
+LLM_STREAM_SECONDS = registry.histogram(
+    "mcp_llm_stream_seconds", "LLM 流式请求从发起到结束的总耗时", ("model", "status"))
+TOOL_CALL_SECONDS = registry.histogram(
+    "mcp_tool_call_seconds", "MCP 工具执行耗时（不含缓存命中）", ("server", "tool"))
+TOOL_CALLS = registry.counter(
+    "mcp_tool_calls_total", "MCP 工具调用次数，status 为 ok/error/cached/circuit_open/server_busy/deadline_exceeded", ("server", "tool", "status"))
+TOOL_QUEUE_WAIT_SECONDS = registry.histogram(
+    "mcp_tool_queue_wait_seconds", "工具调用在服务器并发闸门前的排队耗时", ("server",))
+TOOL_QUEUE_DEPTH = registry.gauge(
+    "mcp_tool_queue_depth", "等待服务器并发名额的工具调用数", ("server",))
+CHAIN_STEPS = registry.histogram(
+    "mcp_chain_steps", "每轮对话中带工具调用的 LLM 步数", buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10))
+MONGO_WRITES = registry.counter(
+    "mcp_mongo_writes_total", "MongoDB 写操作次数", ("collection", "op"))
+MONGO_WRITES_PER_TURN = registry.histogram(
+    "mcp_mongo_writes_per_turn", "每轮对话的 MongoDB 写操作次数", buckets=(1, 2, 4, 6, 8, 12, 16, 24, 32, 64))
+ACTIVE_STREAMS = registry.gauge(
+    "mcp_active_sse_streams", "当前打开的 SSE 流", ("endpoint",))
+SERVER_CIRCUIT_OPEN = registry.gauge(
+    "mcp_server_circuit_open", "MCP Server 熔断状态（1 为熔断中）", ("server",))
+GENERATION_QUEUE_DEPTH = registry.gauge(
+    "mcp_generation_queue_depth", "等待准入名额的补全请求数")
+GENERATION_ADMISSION_WAIT_SECONDS = registry.histogram(
+    "mcp_generation_admission_wait_seconds", "补全请求获得准入名额前的排队耗时")
+GENERATION_ADMISSION_REJECTED = registry.counter(
+    "mcp_generation_admission_rejected_total", "被准入控制拒绝的补全请求数，reason 为 queue_full/queue_timeout", ("reason",))
+TURN_DEADLINE_EXCEEDED = registry.counter(
+    "mcp_turn_deadline_exceeded_total", "因时限用尽而提前给出最终回答的轮次，stage 为 llm/tool", ("stage",))
@@ -1,13 +1,13 @@
 import asyncio
 import os
 import shutil
-from typing import Any, Dict, List
-from contextlib import AsyncExitStack
+from datetime import timedelta
+from typing import Any, Dict, List, Optional
 import logging
-from mcp import ClientSession, StdioServerParameters
-from mcp.client.stdio import stdio_client
-from mcp.client.streamable_http import streamablehttp_client
+from mcp import StdioServerParameters
+from mcp_agent.deadline import backoff_delay, turn_budget
 from mcp_agent.servers.sse_server import MCPServer, FastMCPServer
+from mcp_agent.stdio_pool import StdioConnection, StdioSessionPool
 import shlex
 import json
 
@@ -16,15 +16,18 @@ logger = logging.getLogger(__name__)
 
         
 class StdioMCPServer(MCPServer):
-    """基于 stdio 协议的 MCP Server 通信实现"""
+    """基于 stdio 协议的 MCP Server 通信实现，复用连接池中的常驻子进程"""
     def __init__(self, name: str, config: dict):
         super().__init__(name, config)
-        self.stdio_context = None
+        self._init_lock = asyncio.Lock()
         self._cleanup_lock = asyncio.Lock()
-        self.exit_stack = AsyncExitStack()
-        self.session = None
+        self.pool: StdioSessionPool | None = None
 
-    async def initialize(self) -> None:
+    @property
+    def _initialized(self) -> bool:
+        return self.pool is not None and not self.pool.closed
+
+    def _server_params(self) -> StdioServerParameters:
         command = (
             shutil.which("npx")
             if self.config.get("command") == "npx"
@@ -32,12 +35,12 @@ class StdioMCPServer(MCPServer):
         )
         if command is None:
             raise ValueError("The command must be a valid string and cannot be None.")
-        
+
         args = self.config.get("args", [])
         if isinstance(args, str):
             args = shlex.split(args)
         logger.info(f"[stdio] args: {args}")
-        
+
         env = self.config.get("env", {})
         if isinstance(env, str):
             try:
@@ -45,30 +48,40 @@ class StdioMCPServer(MCPServer):
             except json.JSONDecodeError:
                 env = {}
 
-        server_params = StdioServerParameters(
+        return StdioServerParameters(
             command=command,
             args=args,
             env={**os.environ, **env} if self.config.get("env") else None,
         )
-        try:
-            stdio_transport = await self.exit_stack.enter_async_context(
-                stdio_client(server_params)
-            )
-            read, write = stdio_transport
-            session = await self.exit_stack.enter_async_context(
-                ClientSession(read, write)
-            )
-            await session.initialize()
-            self.session = session
-        except Exception as e:
-            logger.error(f"Error initializing stdio server {self.name}: {e}")
-            await self.cleanup()
-            raise
+
+    async def _connect(self) -> StdioConnection:
+        conn = StdioConnection(self.name, self._server_params(), message_handler=self._handle_message)
+        await conn.start()
+        return conn
+
+    async def initialize(self) -> None:
+        """创建并预热连接池，重复调用无副作用"""
+        async with self._init_lock:
+            if not self._initialized:
+                self.pool = StdioSessionPool(
+                    self.name,
+                    self._connect,
+                    max_size=int(self.config.get("pool_size", os.getenv("STDIO_POOL_SIZE", "2"))),
+                    min_idle=int(self.config.get("pool_min_idle", os.getenv("STDIO_POOL_MIN_IDLE", "1"))),
+                    idle_timeout=float(self.config.get("pool_idle_timeout", os.getenv("STDIO_POOL_IDLE_TIMEOUT", "300"))),
+                )
+            try:
+                await self.pool.warm()
+            except Exception as e:
+                logger.error(f"Error initializing stdio server {self.name}: {e}")
+                await self.cleanup()
+                raise
 
     async def list_tools(self) -> List[Any]:
-        if not self.session:
+        if not self._initialized:
             raise RuntimeError(f"Server {self.name} not initialized")
-        tools_response = await self.session.list_tools()
+        async with self.pool.session() as session:
+            tools_response = await session.list_tools()
         # logger.info(f"[list_tools] tools_response: {tools_response}")
         tools = []
         for item in tools_response:
@@ -94,33 +107,46 @@ class StdioMCPServer(MCPServer):
                         tools.append(tool_dict)
         return tools
 
-    async def execute_tool(self, tool_name: str, arguments: dict, **kwargs) -> Any:
-        if not self.session:
+    async def execute_tool(self, tool_name: str, arguments: dict, timeout: Optional[float] = None, **kwargs) -> Any:
+        """
+        执行工具；timeout 为单次尝试的时限。失败后按带抖动的指数退避重试，
+        每次尝试与等待都不超过当前轮次的剩余预算，预算不足以再等一次时直接失败。
+        """
+        if not self._initialized:
             raise RuntimeError(f"Server {self.name} not initialized")
-        retries = 3
-        delay = 1
+        retries = int(self.config.get("retries", 3))
         attempt = 0
-        while attempt < retries:
+        while True:
+            attempt_timeout = turn_budget(timeout)
             try:
                 logger.info(f"[stdio] Executing {tool_name} on {self.name}...")
-                result = await self.session.call_tool(tool_name, arguments)
-                return result
+                # 每次重试重新 checkout，失效的连接会被连接池替换
+                async with self.pool.session() as session:
+                    return await session.call_tool(
+                        tool_name, arguments,
+                        read_timeout_seconds=timedelta(seconds=attempt_timeout) if attempt_timeout is not None else None
+                    )
             except Exception as e:
                 attempt += 1
                 logger.warning(f"Error executing tool: {e}. Attempt {attempt} of {retries}.")
-                if attempt < retries:
-                    logger.info(f"Retrying in {delay} seconds...")
-                    await asyncio.sleep(delay)
-                else:
+                delay = backoff_delay(attempt - 1, base=1.0)
+                budget = turn_budget()
+                if attempt >= retries:
                     logger.error("Max retries reached. Failing.")
                     raise
+                if budget is not None and budget <= delay:
+                    logger.error(f"Turn budget exhausted ({budget:.1f}s left). Failing.")
+                    raise
+                logger.info(f"Retrying in {delay:.1f} seconds...")
+                await asyncio.sleep(delay)
 
     async def cleanup(self) -> None:
         async with self._cleanup_lock:
+            if self.pool is None:
+                return
+            pool, self.pool = self.pool, None
             try:
-                await self.exit_stack.aclose()
-                self.session = None
-                self.stdio_context = None
+                await pool.close()
             except Exception as e:
                 logger.error(f"Error during cleanup of server {self.name}: {e}")
 
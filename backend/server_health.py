@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+from .metrics import SERVER_CIRCUIT_OPEN
+from .tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class ServerHealth:
+    """单个服务器的滚动健康统计与熔断状态"""
+
+    def __init__(self, name: str, window: int):
+        self.name = name
+        # (是否成功, 耗时秒)
+        self.outcomes: Deque[Tuple[bool, float]] = deque(maxlen=window)
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.next_probe_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.last_success_at: Optional[float] = None
+        self.last_failure_at: Optional[float] = None
+        self.probe_task: Optional[asyncio.Task] = None
+
+    @property
+    def success_rate(self) -> Optional[float]:
+        if not self.outcomes:
+            return None
+        return sum(1 for ok, _ in self.outcomes if ok) / len(self.outcomes)
+
+    def latency_percentile(self, q: float) -> Optional[float]:
+        latencies = sorted(latency for ok, latency in self.outcomes if ok)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+class ServerHealthMonitor:
+    """
+    MCP Server 健康评分与熔断器。
+
+    工具发现与工具调用的结果按服务器记录在滚动窗口中；连续失败达到 failure_threshold 次，
+    或窗口内成功率低于 min_success_rate（样本数不少于 min_calls）时打开熔断：
+    该服务器立即从工具发现与工具调用中排除，由后台任务按指数退避（带抖动）探测，探测成功后关闭熔断。
+    """
+
+    def __init__(self, probe: Optional[Callable[[str], Awaitable[None]]] = None):
+        self.probe = probe
+        self.window = int(os.getenv("SERVER_HEALTH_WINDOW", "20"))
+        self.failure_threshold = int(os.getenv("SERVER_FAILURE_THRESHOLD", "3"))
+        self.min_success_rate = float(os.getenv("SERVER_MIN_SUCCESS_RATE", "0.5"))
+        self.min_calls = int(os.getenv("SERVER_MIN_CALLS", "5"))
+        self.probe_interval = float(os.getenv("SERVER_PROBE_INTERVAL", "5"))
+        self.probe_max_interval = float(os.getenv("SERVER_PROBE_MAX_INTERVAL", "60"))
+        self.probe_timeout = float(os.getenv("SERVER_PROBE_TIMEOUT", "5"))
+        # 评分中的延迟基准：p95 不超过该值时不扣分
+        self.latency_target = float(os.getenv("SERVER_LATENCY_TARGET", "2"))
+        self._servers: Dict[str, ServerHealth] = {}
+
+    def _get(self, name: str) -> ServerHealth:
+        health = self._servers.get(name)
+        if health is None:
+            health = self._servers[name] = ServerHealth(name, self.window)
+        return health
+
+    def allow(self, name: str) -> bool:
+        """熔断打开（或正在探测）时返回 False"""
+        health = self._servers.get(name)
+        return health is None or health.state == CLOSED
+
+    def record_success(self, name: str, latency: float) -> None:
+        health = self._get(name)
+        health.outcomes.append((True, latency))
+        health.consecutive_failures = 0
+        health.last_success_at = time.time()
+        if health.state != CLOSED:
+            self._close(health)
+
+    def record_failure(self, name: str, error: str, latency: float = 0.0) -> None:
+        health = self._get(name)
+        health.outcomes.append((False, latency))
+        health.consecutive_failures += 1
+        health.last_error = error
+        health.last_failure_at = time.time()
+        if health.state != CLOSED:
+            return
+        rate = health.success_rate
+        if health.consecutive_failures >= self.failure_threshold or (
+                len(health.outcomes) >= self.min_calls and rate is not None and rate < self.min_success_rate):
+            self._open(health)
+
+    def _open(self, health: ServerHealth) -> None:
+        health.state = OPEN
+        health.opened_at = time.time()
+        SERVER_CIRCUIT_OPEN.set(1, server=health.name)
+        logger.warning(f"[ServerHealth] 服务器 {health.name} 已熔断（连续失败 {health.consecutive_failures} 次，"
+                       f"最近错误: {health.last_error}）")
+        if self.probe is not None and (health.probe_task is None or health.probe_task.done()):
+            try:
+                health.probe_task = asyncio.get_running_loop().create_task(self._probe_loop(health))
+            except RuntimeError:
+                pass
+
+    def _close(self, health: ServerHealth) -> None:
+        downtime = time.time() - health.opened_at if health.opened_at else 0
+        health.state = CLOSED
+        health.opened_at = None
+        health.next_probe_at = None
+        # 恢复后重新积累样本，避免旧的失败立即再次触发熔断
+        health.outcomes.clear()
+        health.consecutive_failures = 0
+        SERVER_CIRCUIT_OPEN.set(0, server=health.name)
+        logger.info(f"[ServerHealth] 服务器 {health.name} 已恢复，熔断持续 {downtime:.1f}s")
+
+    async def _probe_loop(self, health: ServerHealth) -> None:
+        # 探测任务在请求中创建，不应挂在该请求的 trace 下
+        tracer.detach()
+        delay = self.probe_interval
+        while health.state != CLOSED and self._servers.get(health.name) is health:
+            # 抖动避免多个 worker 同时探测
+            wait = delay * random.uniform(0.8, 1.2)
+            health.next_probe_at = time.time() + wait
+            await asyncio.sleep(wait)
+            if health.state == CLOSED or self._servers.get(health.name) is not health:
+                return
+            health.state = HALF_OPEN
+            started = time.perf_counter()
+            try:
+                await asyncio.wait_for(self.probe(health.name), timeout=self.probe_timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                health.state = OPEN
+                health.last_error = f"probe: {e or type(e).__name__}"
+                health.last_failure_at = time.time()
+                delay = min(delay * 2, self.probe_max_interval)
+                logger.info(f"[ServerHealth] 服务器 {health.name} 探测失败，{delay:.0f}s 后重试: {health.last_error}")
+                continue
+            self.record_success(health.name, time.perf_counter() - started)
+
+    def forget(self, name: Optional[str] = None) -> None:
+        """移除服务器（或全部）的健康状态并停止探测"""
+        names = [name] if name is not None else list(self._servers)
+        for n in names:
+            health = self._servers.pop(n, None)
+            if health is None:
+                continue
+            if health.probe_task and not health.probe_task.done():
+                health.probe_task.cancel()
+            SERVER_CIRCUIT_OPEN.set(0, server=n)
+
+    def score(self, health: ServerHealth) -> Optional[float]:
+        """0~1 的健康评分：成功率乘以延迟系数（p95 超过 latency_target 时按比例扣分）"""
+        rate = health.success_rate
+        if rate is None:
+            return None
+        p95 = health.latency_percentile(0.95)
+        factor = 1.0 if not p95 or p95 <= self.latency_target else self.latency_target / p95
+        return round(rate * factor, 3)
+
+    def snapshot(self, name: str) -> dict:
+        health = self._servers.get(name)
+        if health is None:
+            return {"state": CLOSED, "score": None, "samples": 0}
+        p50, p95 = health.latency_percentile(0.5), health.latency_percentile(0.95)
+        rate = health.success_rate
+        return {
+            "state": health.state,
+            "score": self.score(health),
+            "samples": len(health.outcomes),
+            "success_rate": round(rate, 3) if rate is not None else None,
+            "latency_p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+            "latency_p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            "consecutive_failures": health.consecutive_failures,
+            "last_error": health.last_error,
+            "last_success_at": health.last_success_at,
+            "last_failure_at": health.last_failure_at,
+            "opened_at": health.opened_at,
+            "next_probe_at": health.next_probe_at
+        }
+
+    def snapshot_all(self) -> Dict[str, dict]:
+        return {name: self.snapshot(name) for name in self._servers}
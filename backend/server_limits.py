@@ -0,0 +1,148 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, Deque, Dict, Hashable, Optional
+
+from .metrics import TOOL_QUEUE_DEPTH, TOOL_QUEUE_WAIT_SECONDS
+
+
+class ServerBusyError(Exception):
+    """服务器并发已满且等待队列已满"""
+
+    def __init__(self, server_name: str, active: int, queued: int):
+        super().__init__(f"服务器 {server_name} 繁忙（执行中 {active}，排队 {queued}）")
+        self.server_name = server_name
+        self.active = active
+        self.queued = queued
+
+
+class ServerGate:
+    """
+    单个服务器的并发闸门：最多 max_concurrency 个调用同时执行，其余进入有界等待队列。
+
+    等待者按 flow（通常是一轮对话）分组，空出名额时在各 flow 之间轮转分配，
+    避免某一轮一次发起大量调用时饿死其他会话；队列已满时立即抛出 ServerBusyError。
+    """
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.active = 0
+        self.queued = 0
+        self.rejected = 0
+        self._flows: "OrderedDict[Hashable, Deque[asyncio.Future]]" = OrderedDict()
+
+    def _update_depth(self) -> None:
+        TOOL_QUEUE_DEPTH.set(self.queued, server=self.name)
+
+    async def acquire(self, flow: Hashable = None) -> float:
+        """获取执行名额，返回排队等待的秒数"""
+        if self.max_concurrency <= 0 or (self.active < self.max_concurrency and not self._flows):
+            self.active += 1
+            return 0.0
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            raise ServerBusyError(self.name, self.active, self.queued)
+        started = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        self._flows.setdefault(flow, deque()).append(future)
+        self.queued += 1
+        self._update_depth()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self._remove(flow, future)
+            else:
+                # 已分配到名额后才被取消，归还名额
+                self.release()
+            raise
+        return time.perf_counter() - started
+
+    def _remove(self, flow: Hashable, future: asyncio.Future) -> None:
+        waiters = self._flows.get(flow)
+        if waiters is None or future not in waiters:
+            return
+        waiters.remove(future)
+        if not waiters:
+            del self._flows[flow]
+        self.queued -= 1
+        self._update_depth()
+
+    def release(self) -> None:
+        self.active -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while self._flows and (self.max_concurrency <= 0 or self.active < self.max_concurrency):
+            flow, waiters = next(iter(self._flows.items()))
+            future = waiters.popleft()
+            self.queued -= 1
+            if waiters:
+                self._flows.move_to_end(flow)
+            else:
+                del self._flows[flow]
+            if future.done():
+                continue
+            self.active += 1
+            future.set_result(None)
+        self._update_depth()
+
+    def snapshot(self) -> dict:
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "rejected": self.rejected
+        }
+
+
+class ServerLimiter:
+    """
+    按服务器管理并发闸门。
+
+    上限取 servers 文档的 max_concurrency / max_queue，未配置时使用环境变量
+    SERVER_MAX_CONCURRENCY（默认 8，0 表示不限制）/ SERVER_MAX_QUEUE（默认 32）。
+    """
+
+    def __init__(self):
+        self.default_concurrency = int(os.getenv("SERVER_MAX_CONCURRENCY", "8"))
+        self.default_queue = int(os.getenv("SERVER_MAX_QUEUE", "32"))
+        self._gates: Dict[str, ServerGate] = {}
+
+    def gate(self, name: str, config: Optional[Dict[str, Any]] = None) -> ServerGate:
+        gate = self._gates.get(name)
+        if gate is None:
+            config = config or {}
+            gate = self._gates[name] = ServerGate(
+                name,
+                int(config.get("max_concurrency", self.default_concurrency)),
+                int(config.get("max_queue", self.default_queue))
+            )
+        return gate
+
+    @asynccontextmanager
+    async def slot(self, name: str, config: Optional[Dict[str, Any]] = None, flow: Hashable = None):
+        """在服务器的并发名额内执行，排队耗时计入 mcp_tool_queue_wait_seconds"""
+        gate = self.gate(name, config)
+        waited = await gate.acquire(flow)
+        TOOL_QUEUE_WAIT_SECONDS.observe(waited, server=name)
+        try:
+            yield waited
+        finally:
+            gate.release()
+
+    def forget(self, name: Optional[str] = None) -> None:
+        """配置变更后丢弃闸门（正在执行的调用仍会归还到旧闸门）"""
+        if name is None:
+            self._gates.clear()
+        else:
+            self._gates.pop(name, None)
+
+    def snapshot(self, name: str) -> Optional[dict]:
+        gate = self._gates.get(name)
+        return gate.snapshot() if gate else None
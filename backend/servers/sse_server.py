@@ -1,11 +1,14 @@
 from typing import Dict, List, Any
 
 import abc
-from typing import List, Any, Dict
+import asyncio
+from typing import List, Any, Dict, Optional
 import logging
 
 from fastmcp.client import Client
 from fastmcp.client.transports import SSETransport
+from mcp import types
+from mcp_agent.deadline import TOOL_CALL_TIMEOUT, turn_budget
 
 logger = logging.getLogger(__name__)
 
@@ -16,6 +19,15 @@ class MCPServer(abc.ABC):
     def __init__(self, name: str, config: dict):
         self.name = name
         self.config = config
+        # 工具列表变更回调，由 ToolCatalog 注册
+        self.on_tools_changed = None
+
+    async def _handle_message(self, message) -> None:
+        """处理服务端推送的消息，收到 tools/list_changed 时通知订阅方"""
+        if isinstance(getattr(message, "root", None), types.ToolListChangedNotification):
+            logger.info(f"服务器 {self.name} 工具列表已变更")
+            if self.on_tools_changed:
+                self.on_tools_changed(self.name)
 
     @abc.abstractmethod
     async def initialize(self) -> None:
@@ -45,7 +57,7 @@ class FastMCPServer(MCPServer):
         - config: 配置字典，应包含:
         - base_url: FastMCP服务端的基础URL
         - group_id: 组ID(可选)
-        - timeout: 请求超时时间(秒，默认30)
+        - timeout: 请求超时时间(秒，默认 TOOL_CALL_TIMEOUT)
         """
         super().__init__(name, config)
         # logger.info(f"构建 FastMCPServer: {name}, config: {config}")
@@ -53,24 +65,53 @@ class FastMCPServer(MCPServer):
         self.base_url = config.get("url")
         if self.base_url:
             self.base_url = self.base_url.rstrip("/")
-        self.timeout = config.get("timeout", 30)
+        self.timeout = float(config.get("timeout") or TOOL_CALL_TIMEOUT)
         self.headers = config.get("headers", {})
         self._initialized = False
         self.client = None
-        self._client_cm = None  # 用于保存 async context manager
+        # Client 基于 anyio 的 task group，必须在同一个任务内进入和退出，
+        # 因此由专属任务持有连接，cleanup() 时通知该任务退出（与 StdioConnection 相同）
+        self._task: Optional[asyncio.Task] = None
+        self._ready: Optional[asyncio.Future] = None
+        self._closing: Optional[asyncio.Event] = None
+        self._init_lock = asyncio.Lock()
 
     async def initialize(self) -> None:
         logger.info(f"初始化 FastMCPServer: {self.name}")
-        if self._initialized:
-            return
-        self.client = Client(
+        async with self._init_lock:
+            if self._initialized:
+                return
+            if self._task is None or self._task.done():
+                self._closing = asyncio.Event()
+                self._ready = asyncio.get_running_loop().create_future()
+                self._task = asyncio.create_task(self._run(self._ready, self._closing))
+            # 调用方被取消时连接任务继续建立连接，下一次调用直接等待同一个任务
+            await asyncio.shield(self._ready)
+            self._initialized = True
+        print(f"FastMCP客户端初始化完成")
+
+    async def _run(self, ready: asyncio.Future, closing: asyncio.Event) -> None:
+        client = Client(
             transport=SSETransport(self.base_url),
-            timeout=10,
+            message_handler=self._handle_message,
+            timeout=self.timeout,
         )
-        self._client_cm = self.client.__aenter__()
-        await self._client_cm
-        self._initialized = True
-        print(f"FastMCP客户端初始化完成")
+        try:
+            async with client:
+                self.client = client
+                ready.set_result(None)
+                await closing.wait()
+        except Exception as e:
+            if not ready.done():
+                ready.set_exception(e)
+            else:
+                logger.warning(f"FastMCP客户端 {self.name} 连接异常断开: {e}")
+        finally:
+            if self.client is client:
+                self.client = None
+                self._initialized = False
+            if not ready.done():
+                ready.set_exception(RuntimeError(f"sse server {self.name} disconnected during startup"))
 
     def _get_headers(self) -> Dict[str, str]:
         """获取请求头，包含认证信息"""
@@ -88,12 +129,23 @@ class FastMCPServer(MCPServer):
             await self.initialize()
         return await self.client.list_tools()
 
-    async def execute_tool(self, tool_name: str, arguments: dict, **kwargs) -> Any:
+    async def execute_tool(self, tool_name: str, arguments: dict, timeout: Optional[float] = None, **kwargs) -> Any:
+        """timeout 为本次调用的时限（默认取服务器 timeout），不超过当前轮次的剩余预算"""
         if not self._initialized or not self.client:
             await self.initialize()
-        return await self.client.call_tool(tool_name, arguments)
+        return await self.client.call_tool(tool_name, arguments, timeout=turn_budget(timeout or self.timeout))
     
-    async def cleanup(self) -> None:
-        if self.client:
-            await self.client.__aexit__(None, None, None)
+    async def cleanup(self, timeout: float = 5) -> None:
+        if self._closing is not None:
+            self._closing.set()
+        task = self._task
+        if task and not task.done():
+            try:
+                await asyncio.wait_for(task, timeout=timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                task.cancel()
+            except Exception as e:
+                logger.error(f"FastMCP客户端 {self.name} 关闭失败: {e}")
+        self._task = None
+        self._initialized = False
         print(f"FastMCP客户端 {self.name} 已清理资源")
@@ -1,16 +1,28 @@
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime
 from pymongo import MongoClient, ASCENDING
+from pymongo.errors import BulkWriteError
+from pymongo.results import InsertOneResult
 import json
 import asyncio
 from motor.motor_asyncio import AsyncIOMotorClient
 from bson import ObjectId
 import logging
+import os
 import random
 import string
 
+from .metrics import MONGO_WRITES
+from .tracing import payload_size, tracer
+
 logger = logging.getLogger(__name__)
 
+# 历史分页中工具结果的预览长度，超出部分通过单条消息接口获取
+MESSAGE_PREVIEW_CHARS = int(os.getenv("MESSAGE_PREVIEW_CHARS", "500"))
+# 历史分页默认返回的字段（不含 call 等只在执行时使用的大字段）
+MESSAGE_LIST_FIELDS = ("session_id", "role", "name", "timestamp", "tool_calls", "tool_call_id",
+                       "is_error", "content_size", "latency_ms", "cancelled", "inner_thoughts", "updated_at")
+
 
 class ChatSession:
     """聊天会话类"""
@@ -23,6 +35,9 @@ class ChatSession:
         self.status = status
         self.last_sync = datetime.now().isoformat()
         self.metadata: Dict = {}
+        self.summary: Optional[Dict] = None
+        self.message_count = 0
+        self.last_message_at: Optional[str] = None
 
     def add_message(self, role: str, content: str):
         """添加消息"""
@@ -46,7 +61,9 @@ class ChatSession:
             "updated_at": self.updated_at,
             "status": self.status,
             "last_sync": self.last_sync,
-            "metadata": self.metadata
+            "metadata": self.metadata,
+            "message_count": self.message_count,
+            "last_message_at": self.last_message_at
         }
         if self._id:
             d["_id"] = self._id
@@ -64,6 +81,9 @@ class ChatSession:
         session.updated_at = data["updated_at"]
         session.last_sync = data.get("last_sync", session.created_at)
         session.metadata = data.get("metadata", {})
+        session.summary = data.get("summary")
+        session.message_count = data.get("message_count", 0)
+        session.last_message_at = data.get("last_message_at")
         return session
 
 class SessionManager:
@@ -165,19 +185,77 @@ class SessionManager:
         )
 
 class AsyncSessionManager:
-    """异步会话管理器"""
-    def __init__(self, mongo_uri: str):
+    """
+    异步会话管理器
+
+    开启 write_behind（或环境变量 SESSION_WRITE_BEHIND=1）后，消息先按会话缓存在内存中，
+    达到 flush_size 条或每隔 flush_interval 秒通过 insert_many 批量写入，
+    同一批次只更新一次 sessions.updated_at。回合结束与关闭时需调用 flush()/close()。
+    消息 _id 在入队时生成，重试时重复键错误视为已写入，保证按序、至少一次写入。
+
+    部署为副本集或分片集群时，消息写入与 sessions.message_count 的递增在同一个事务中完成；
+    单机 MongoDB 不支持事务，计数为尽力而为：插入后更新计数失败或重试时遇到重复键的会话
+    会被记录下来，在下一次 flush() 时按实际消息数重新校正。
+    """
+    def __init__(self, mongo_uri: str, write_behind: Optional[bool] = None):
         self.client = AsyncIOMotorClient(mongo_uri, maxPoolSize=50)
         self.db = self.client.get_default_database()
         self.sessions = self.db.sessions
         self.messages = self.db.messages
         self._sync_task = None
         self._sync_interval = 5  # 同步间隔（秒）
+        if write_behind is None:
+            write_behind = os.getenv("SESSION_WRITE_BEHIND", "").lower() in ("1", "true", "yes")
+        self.write_behind = write_behind
+        self.flush_size = int(os.getenv("SESSION_FLUSH_SIZE", "20"))
+        self.flush_interval = float(os.getenv("SESSION_FLUSH_INTERVAL", "0.5"))
+        self._pending: Dict[str, List[Dict]] = {}
+        self._flush_locks: Dict[str, asyncio.Lock] = {}
+        self._flush_task = None
+        # 是否支持事务（副本集/分片集群），首次写入时检测
+        self._transactions: Optional[bool] = None
+        # 计数可能与实际消息数不一致、需要重新统计的会话
+        self._recount: set = set()
+        # 各会话自上次 pop_turn_writes 以来的写操作次数，用于统计每轮写入量
+        self._turn_writes: Dict[str, int] = {}
+
+    def _record_write(self, collection: str, op: str, session_id: Optional[str] = None, n: int = 1):
+        MONGO_WRITES.inc(n, collection=collection, op=op)
+        if session_id is not None:
+            session_id = str(session_id)
+            self._turn_writes[session_id] = self._turn_writes.get(session_id, 0) + n
+
+    def pop_turn_writes(self, session_id: str) -> int:
+        """返回并清零会话累计的写操作次数"""
+        return self._turn_writes.pop(str(session_id), 0)
 
     async def init_indexes(self):
         """初始化数据库索引"""
         await self.sessions.create_index("updated_at")
-        await self.messages.create_index([("session_id", 1), ("timestamp", 1)])
+        # /sessions 键集分页：status 等值过滤 + (updated_at, _id) 倒序
+        await self.sessions.create_index([("status", 1), ("updated_at", -1), ("_id", -1)])
+        await self.messages.create_index([("session_id", 1), ("timestamp", 1), ("_id", 1)])
+
+    async def backfill_counters(self):
+        """为旧会话补齐 message_count / last_message_at，只处理缺少计数字段的会话"""
+        missing = [s["_id"] async for s in self.sessions.find({"message_count": {"$exists": False}}, {"_id": 1})]
+        if not missing:
+            return
+        counts = {}
+        pipeline = [
+            {"$match": {"session_id": {"$in": [str(_id) for _id in missing]}}},
+            {"$group": {"_id": "$session_id", "count": {"$sum": 1}, "last": {"$max": "$timestamp"}}}
+        ]
+        async for row in self.messages.aggregate(pipeline):
+            counts[row["_id"]] = row
+        for _id in missing:
+            row = counts.get(str(_id), {})
+            self._record_write("sessions", "update")
+            await self.sessions.update_one(
+                {"_id": _id, "message_count": {"$exists": False}},
+                {"$set": {"message_count": row.get("count", 0), "last_message_at": row.get("last")}}
+            )
+        logger.info(f"已为 {len(missing)} 个会话补齐消息计数")
 
     def start_sync(self):
         """启动自动同步任务"""
@@ -214,6 +292,7 @@ class AsyncSessionManager:
         """同步单个会话"""
         session = await self.get_session(_id)
         if session:
+            self._record_write("sessions", "update")
             await self.sessions.update_one(
                 {"_id": ObjectId(_id)},
                 {
@@ -229,6 +308,7 @@ class AsyncSessionManager:
         rand_suffix = ''.join(random.choices(string.ascii_uppercase + string.digits, k=5))
         session_name = f"会话-{rand_suffix}"
         session = ChatSession(name=session_name)
+        self._record_write("sessions", "insert")
         result = await self.sessions.insert_one(session.to_dict())
         session._id = result.inserted_id
         return session
@@ -242,41 +322,238 @@ class AsyncSessionManager:
 
     async def delete_session(self, _id: str) -> bool:
         """删除会话"""
+        self._pending.pop(str(_id), None)
+        self._turn_writes.pop(str(_id), None)
+        self._record_write("sessions", "delete")
         result = await self.sessions.delete_one({"_id": ObjectId(_id)})
+        self._record_write("messages", "delete")
         await self.messages.delete_many({"session_id": str(_id)})
         return result.deleted_count > 0
 
-    async def list_sessions(self) -> List[Dict]:
-        """列出所有会话，按更新时间降序"""
-        cursor = self.sessions.find({"status": "active"}).sort("updated_at", -1)
-        sessions = []
-        async for session in cursor:
-            message_count = await self.messages.count_documents({"session_id": str(session["_id"])})
-            sessions.append({
-                "_id": str(session["_id"]),
-                "name": session["name"],
-                "message_count": message_count,
-                "updated_at": session["updated_at"],
-                "last_sync": session.get("last_sync", session["created_at"])
-            })
-        return sessions
+    async def list_sessions(self, limit: Optional[int] = None, before: Optional[str] = None,
+                            status: str = "active") -> Tuple[List[Dict], Optional[str]]:
+        """
+        按 (updated_at, _id) 倒序分页列出会话，返回 (会话列表, 下一页游标)。
+
+        before 为上一页返回的游标，没有更多数据时下一页游标为 None。
+        """
+        limit = limit or int(os.getenv("SESSION_PAGE_SIZE", "50"))
+        query: Dict = {"status": status}
+        if before:
+            updated_at, _, last_id = before.rpartition("|")
+            if not updated_at or not ObjectId.is_valid(last_id):
+                raise ValueError(f"无效的分页游标: {before}")
+            query["$or"] = [
+                {"updated_at": {"$lt": updated_at}},
+                {"updated_at": updated_at, "_id": {"$lt": ObjectId(last_id)}}
+            ]
+        cursor = self.sessions.find(
+            query,
+            {"name": 1, "message_count": 1, "last_message_at": 1, "updated_at": 1, "created_at": 1, "last_sync": 1},
+            sort=[("updated_at", -1), ("_id", -1)],
+            limit=limit + 1
+        )
+        docs = [session async for session in cursor]
+        next_cursor = None
+        if len(docs) > limit:
+            docs = docs[:limit]
+            next_cursor = f"{docs[-1]['updated_at']}|{docs[-1]['_id']}"
+        sessions = [{
+            "_id": str(session["_id"]),
+            "name": session["name"],
+            "message_count": session.get("message_count", 0),
+            "last_message_at": session.get("last_message_at"),
+            "updated_at": session["updated_at"],
+            "last_sync": session.get("last_sync", session["created_at"])
+        } for session in docs]
+        return sessions, next_cursor
 
     async def rename_session(self, session_id: str, new_name: str) -> bool:
         """重命名会话"""
+        self._record_write("sessions", "update")
         result = await self.sessions.update_one(
             {"_id": ObjectId(session_id)},
             {"$set": {"name": new_name, "updated_at": datetime.now().isoformat()}}
         )
         return result.modified_count > 0
 
+    async def _write_message(self, message: dict):
+        """写入单条消息：write-behind 模式下入队，否则直接写库"""
+        with tracer.span("session.write_message", {"session.id": str(message.get('session_id')),
+                                                   "message.role": message.get('role'),
+                                                   "session.write_behind": self.write_behind}) as span:
+            if span.recording:
+                span.set_attribute("message.bytes", payload_size(message.get('content') or ""))
+            self._annotate_preview(message)
+            if not self.write_behind:
+                session_id = str(message['session_id'])
+                self._record_write("messages", "insert", session_id)
+                if await self._supports_transactions():
+                    async with await self.client.start_session() as s:
+                        async with s.start_transaction():
+                            insert_result = await self.messages.insert_one(message, session=s)
+                            await self._touch_session(session_id, 1, message['timestamp'], session=s)
+                    return insert_result
+                insert_result = await self.messages.insert_one(message)
+                await self._touch_session_best_effort(session_id, 1, message['timestamp'])
+                return insert_result
+            message.setdefault('_id', ObjectId())
+            session_id = str(message['session_id'])
+            buffer = self._pending.setdefault(session_id, [])
+            buffer.append(message)
+            self._ensure_flusher()
+            if len(buffer) >= self.flush_size:
+                await self.flush(session_id)
+            return InsertOneResult(message['_id'], acknowledged=True)
+
+    def _ensure_flusher(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        """按时间阈值定期刷新缓冲区"""
+        # 后台任务继承了创建时的请求上下文，定期刷新不应挂在该请求的 trace 下
+        tracer.detach()
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+        except asyncio.CancelledError:
+            pass
+
+    async def flush(self, session_id: Optional[str] = None):
+        """将缓冲的消息写入数据库并校正需要重新统计的计数，session_id 为空时处理全部会话"""
+        session_ids = [str(session_id)] if session_id is not None else list(self._pending)
+        for sid in session_ids:
+            try:
+                await self._flush_session(sid)
+            except Exception as e:
+                logger.error(f"刷新会话 {sid} 消息失败，将在下次刷新时重试: {e}")
+                if session_id is not None:
+                    raise
+        recount = [str(session_id)] if session_id is not None else list(self._recount)
+        for sid in recount:
+            if sid in self._recount:
+                await self._recount_session(sid)
+
+    async def _supports_transactions(self) -> bool:
+        """副本集成员或 mongos 才支持多文档事务；检测失败时按不支持处理"""
+        if self._transactions is None:
+            try:
+                hello = await self.client.admin.command("hello")
+                self._transactions = bool(hello.get("setName")) or hello.get("msg") == "isdbgrid"
+            except Exception as e:
+                logger.warning(f"检测 MongoDB 事务支持失败，消息计数按尽力而为更新: {e}")
+                self._transactions = False
+        return self._transactions
+
+    async def _recount_session(self, session_id: str):
+        """按实际消息数重写会话的 message_count / last_message_at"""
+        lock = self._flush_locks.setdefault(session_id, asyncio.Lock())
+        async with lock:
+            try:
+                count = await self.messages.count_documents({"session_id": session_id})
+                last = await self.messages.find_one({"session_id": session_id}, {"timestamp": 1},
+                                                    sort=[("timestamp", -1)])
+                self._record_write("sessions", "update", session_id)
+                await self.sessions.update_one(
+                    {"_id": ObjectId(session_id)},
+                    {"$set": {"message_count": count, "last_message_at": last["timestamp"] if last else None}}
+                )
+                self._recount.discard(session_id)
+                logger.info(f"会话 {session_id} 消息计数已校正为 {count}")
+            except Exception as e:
+                logger.error(f"校正会话 {session_id} 消息计数失败，将在下次刷新时重试: {e}")
+
+    async def _flush_session(self, session_id: str):
+        with tracer.span("session.flush", {"session.id": session_id}) as span:
+            lock = self._flush_locks.setdefault(session_id, asyncio.Lock())
+            async with lock:
+                batch = self._pending.pop(session_id, None)
+                if not batch:
+                    return
+                span.set_attribute("session.messages", len(batch))
+                if await self._supports_transactions():
+                    try:
+                        await self._flush_batch_in_transaction(session_id, batch)
+                    except Exception:
+                        # 事务整体回滚，整批放回队首
+                        self._pending[session_id] = batch + self._pending.get(session_id, [])
+                        raise
+                    logger.info(f" flush messages: session_id: {session_id}, count: {len(batch)}")
+                    return
+                remaining = batch
+                inserted = 0
+                try:
+                    while remaining:
+                        try:
+                            self._record_write("messages", "insert_many", session_id)
+                            await self.messages.insert_many(remaining, ordered=True)
+                            inserted += len(remaining)
+                            remaining = []
+                        except BulkWriteError as e:
+                            written = e.details.get("nInserted", 0)
+                            inserted += written
+                            errors = e.details.get("writeErrors", [])
+                            # 上次刷新已写入的消息会触发重复键错误，跳过后继续写入剩余部分；
+                            # 无法确定上次是否已计数，计数在 flush() 结束时按实际消息数校正
+                            if errors and errors[0].get("code") == 11000:
+                                self._recount.add(session_id)
+                                remaining = remaining[written + 1:]
+                            else:
+                                remaining = remaining[written:]
+                                raise
+                except Exception:
+                    # 未写入的消息放回队首，保持顺序；已写入部分的计数立即记上
+                    self._pending[session_id] = remaining + self._pending.get(session_id, [])
+                    if inserted:
+                        await self._touch_session_best_effort(
+                            session_id, inserted, batch[len(batch) - len(remaining) - 1]["timestamp"])
+                    raise
+                await self._touch_session_best_effort(session_id, inserted, batch[-1]["timestamp"])
+                logger.info(f" flush messages: session_id: {session_id}, count: {len(batch)}")
+
+    async def _flush_batch_in_transaction(self, session_id: str, batch: List[Dict]):
+        """在一个事务中写入整批消息并递增计数；上次提交结果未知而实际已写入的消息不重复写入与计数"""
+        async with await self.client.start_session() as s:
+            async with s.start_transaction():
+                ids = [m['_id'] for m in batch]
+                existing = {m['_id'] async for m in self.messages.find({"_id": {"$in": ids}}, {"_id": 1}, session=s)}
+                new = [m for m in batch if m['_id'] not in existing]
+                if new:
+                    self._record_write("messages", "insert_many", session_id)
+                    await self.messages.insert_many(new, ordered=True, session=s)
+                await self._touch_session(session_id, len(new), batch[-1]["timestamp"], session=s)
+
+    async def _touch_session_best_effort(self, session_id: str, count: int, timestamp: str):
+        """消息已写入，计数更新失败时不再抛出，记录下来等待校正"""
+        try:
+            await self._touch_session(session_id, count, timestamp)
+        except Exception as e:
+            logger.error(f"更新会话 {session_id} 消息计数失败，将按实际消息数校正: {e}")
+            self._recount.add(session_id)
+
+    async def _touch_session(self, session_id: str, count: int, timestamp: str, session=None):
+        """在同一次更新中递增消息计数并刷新 last_message_at / updated_at；session 为所属事务"""
+        self._record_write("sessions", "update", session_id)
+        await self.sessions.update_one(
+            {"_id": ObjectId(session_id)},
+            {"$inc": {"message_count": count},
+             "$set": {"last_message_at": timestamp, "updated_at": timestamp}},
+            session=session
+        )
+
+    async def close(self):
+        """停止后台刷新并写入所有缓冲消息"""
+        if self._flush_task:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
     async def add_message_obj(self, message: dict):
         """添加消息体到会话"""
         message['timestamp'] = datetime.now().isoformat()
-        insert_result = await self.messages.insert_one(message)
-        await self.sessions.update_one(
-            {"_id": ObjectId(message['session_id'])},
-            {"$set": {"updated_at": datetime.now().isoformat()}}
-        )
+        insert_result = await self._write_message(message)
         logger.info(f" save message: session_id: {message}")
         return insert_result
 
@@ -289,33 +566,98 @@ class AsyncSessionManager:
             "timestamp": datetime.now().isoformat(),
             **kwargs
         }
-        insert_result = await self.messages.insert_one(message)
-        await self.sessions.update_one(
-            {"_id": ObjectId(session_id)},
-            {"$set": {"updated_at": datetime.now().isoformat()}}
-        )
+        insert_result = await self._write_message(message)
         logger.info(f" save message: session_id: {session_id}, role: {role}, content: {content}")
         return insert_result
 
+    @staticmethod
+    def _annotate_preview(message: dict):
+        """工具结果过大时在写入时附带预览与原始长度，历史分页只返回预览"""
+        content = message.get("content")
+        if message.get("role") == "tool" and isinstance(content, str) and len(content) > MESSAGE_PREVIEW_CHARS:
+            message["content_preview"] = content[:MESSAGE_PREVIEW_CHARS]
+            message["content_size"] = len(content)
+
+    async def get_message_page(self, session_id: str, before: Optional[str] = None, limit: Optional[int] = None,
+                               full: bool = False) -> Tuple[List[Dict], Optional[str]]:
+        """
+        按时间倒序分页读取消息，返回 (按时间正序排列的一页消息, 更早一页的游标)。
+
+        默认只返回列表展示需要的字段，过大的工具结果以 content_preview 代替并标记
+        content_truncated，完整内容通过 get_message 按需获取；full=True 时返回完整文档。
+        """
+        if self.write_behind:
+            await self.flush(session_id)
+        limit = limit or int(os.getenv("MESSAGE_PAGE_SIZE", "50"))
+        query: Dict = {"session_id": str(session_id)}
+        if before:
+            timestamp, _, last_id = before.rpartition("|")
+            if not timestamp or not ObjectId.is_valid(last_id):
+                raise ValueError(f"无效的分页游标: {before}")
+            query["$or"] = [
+                {"timestamp": {"$lt": timestamp}},
+                {"timestamp": timestamp, "_id": {"$lt": ObjectId(last_id)}}
+            ]
+        pipeline = [
+            {"$match": query},
+            {"$sort": {"timestamp": -1, "_id": -1}},
+            {"$limit": limit + 1}
+        ]
+        if full:
+            pipeline.append({"$project": {"content_preview": 0}})
+        else:
+            pipeline.append({"$project": {
+                **{field: 1 for field in MESSAGE_LIST_FIELDS},
+                "content": {"$ifNull": ["$content_preview", "$content"]}
+            }})
+        docs = [message async for message in self.messages.aggregate(pipeline)]
+        next_cursor = None
+        if len(docs) > limit:
+            docs = docs[:limit]
+            next_cursor = f"{docs[-1]['timestamp']}|{docs[-1]['_id']}"
+        for message in docs:
+            message["content_truncated"] = not full and "content_size" in message
+        docs.reverse()
+        return docs, next_cursor
+
+    async def get_message(self, session_id: str, message_id: str) -> Optional[Dict]:
+        """获取单条完整消息"""
+        if not ObjectId.is_valid(message_id):
+            return None
+        if self.write_behind:
+            await self.flush(session_id)
+        return await self.messages.find_one(
+            {"_id": ObjectId(message_id), "session_id": str(session_id)},
+            {"content_preview": 0}
+        )
+
     async def get_messages(self, session_id: str) -> List[Dict]:
         """获取会话的所有消息"""
+        if self.write_behind:
+            await self.flush(session_id)
         cursor = self.messages.find(
             {"session_id": str(session_id)},
+            {"content_preview": 0},
             sort=[("timestamp", 1)]
         )
         return [message async for message in cursor]
 
     async def clear_messages(self, session_id: str) -> bool:
         """清空会话消息"""
+        self._pending.pop(str(session_id), None)
+        self._record_write("messages", "delete")
         await self.messages.delete_many({"session_id": str(session_id)})
+        self._record_write("sessions", "update")
         await self.sessions.update_one(
             {"_id": ObjectId(session_id)},
-            {"$set": {"updated_at": datetime.now().isoformat()}}
+            {"$set": {"updated_at": datetime.now().isoformat(), "message_count": 0, "last_message_at": None},
+             "$unset": {"summary": ""}}
         )
         return True
 
     async def update_message_content(self, message_id: str, content: str):
         """更新会话元数据"""
+        self._record_write("messages", "update")
         await self.messages.update_one(
             {"_id": ObjectId(message_id)},
             {
@@ -326,8 +668,18 @@ class AsyncSessionManager:
             }
         )
 
+    async def update_session_summary(self, session_id: str, summary: Dict):
+        """更新会话滚动摘要"""
+        self._record_write("sessions", "update", session_id)
+        with tracer.span("session.update_summary", {"session.id": str(session_id)}):
+            await self.sessions.update_one(
+                {"_id": ObjectId(session_id)},
+                {"$set": {"summary": summary}}
+            )
+
     async def update_session_metadata(self, session_id: str, metadata: Dict):
         """更新会话元数据"""
+        self._record_write("sessions", "update")
         await self.sessions.update_one(
             {"_id": ObjectId(session_id)},
             {
@@ -340,6 +692,7 @@ class AsyncSessionManager:
 
     async def archive_session(self, session_id: str):
         """归档会话"""
+        self._record_write("sessions", "update")
         await self.sessions.update_one(
             {"_id": ObjectId(session_id)},
             {
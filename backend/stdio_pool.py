@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Deque, Optional, Set
+
+from mcp import ClientSession, StdioServerParameters
+from mcp.client.stdio import stdio_client
+from mcp.shared.exceptions import McpError
+
+logger = logging.getLogger(__name__)
+
+
+class StdioConnection:
+    """
+    单个 stdio 子进程及其已初始化的 ClientSession。
+
+    stdio_client/ClientSession 基于 anyio 的 task group，必须在同一个任务内进入和退出，
+    因此由一个专属任务持有上下文，close() 时通知该任务退出。
+    """
+
+    def __init__(self, name: str, params: StdioServerParameters, message_handler=None):
+        self.name = name
+        self.params = params
+        self.message_handler = message_handler
+        self.session: Optional[ClientSession] = None
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.last_checked = self.created_at
+        self._task: Optional[asyncio.Task] = None
+        self._ready: Optional[asyncio.Future] = None
+        self._closing = asyncio.Event()
+
+    @property
+    def alive(self) -> bool:
+        return self.session is not None and self._task is not None and not self._task.done()
+
+    async def start(self) -> None:
+        self._ready = asyncio.get_running_loop().create_future()
+        self._task = asyncio.create_task(self._run())
+        await self._ready
+
+    async def _run(self) -> None:
+        try:
+            async with stdio_client(self.params) as (read, write):
+                async with ClientSession(read, write, message_handler=self.message_handler) as session:
+                    await session.initialize()
+                    self.session = session
+                    self._ready.set_result(None)
+                    await self._closing.wait()
+        except Exception as e:
+            if not self._ready.done():
+                self._ready.set_exception(e)
+            else:
+                logger.warning(f"[stdio-pool] {self.name} 子进程异常退出: {e}")
+        finally:
+            self.session = None
+            if not self._ready.done():
+                self._ready.set_exception(RuntimeError(f"stdio server {self.name} exited during startup"))
+
+    async def ping(self, timeout: float) -> bool:
+        if not self.alive:
+            return False
+        try:
+            await asyncio.wait_for(self.session.send_ping(), timeout=timeout)
+            self.last_checked = time.monotonic()
+            return True
+        except Exception as e:
+            logger.warning(f"[stdio-pool] {self.name} 健康检查失败: {e}")
+            return False
+
+    async def close(self, timeout: float = 5) -> None:
+        self._closing.set()
+        if self._task and not self._task.done():
+            try:
+                await asyncio.wait_for(self._task, timeout=timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                self._task.cancel()
+            except Exception as e:
+                logger.error(f"[stdio-pool] 关闭 {self.name} 子进程失败: {e}")
+        self.session = None
+
+
+class StdioSessionPool:
+    """
+    stdio MCP Server 的连接池。
+
+    - 最多 max_size 个常驻子进程，启动时预热 min_idle 个
+    - checkout 前对空闲较久的连接做 ping 健康检查，失效即重启
+    - 传输层异常的连接在 checkin 时丢弃，由下一次 checkout 重新拉起
+    - 后台任务回收空闲超过 idle_timeout 的连接（保留 min_idle 个）
+    """
+
+    def __init__(self, name: str, connect: Callable[[], Awaitable[StdioConnection]], max_size: int = 2,
+                 min_idle: int = 1, idle_timeout: float = 300, health_check_interval: float = 30,
+                 health_check_timeout: float = 5):
+        self.name = name
+        self._connect = connect
+        self.max_size = max(1, max_size)
+        self.min_idle = max(0, min(min_idle, self.max_size))
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self._idle: Deque[StdioConnection] = deque()
+        self._all: Set[StdioConnection] = set()
+        self._slots = asyncio.Semaphore(self.max_size)
+        self._reaper: Optional[asyncio.Task] = None
+        # release() 中发起的关闭任务，保留引用避免被回收，close() 时等待完成
+        self._discarding: Set[asyncio.Task] = set()
+        self._closed = False
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def stats(self) -> dict:
+        return {"size": len(self._all), "idle": len(self._idle), "max_size": self.max_size}
+
+    async def warm(self) -> None:
+        """预热到 min_idle 个空闲连接，并启动空闲回收任务"""
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap_loop())
+        while len(self._idle) < self.min_idle and len(self._all) < self.max_size:
+            self._idle.append(await self._spawn())
+
+    async def _spawn(self) -> StdioConnection:
+        conn = await self._connect()
+        self._all.add(conn)
+        logger.info(f"[stdio-pool] {self.name} 新建连接，当前 {len(self._all)}/{self.max_size}")
+        return conn
+
+    async def _discard(self, conn: StdioConnection) -> None:
+        self._all.discard(conn)
+        await conn.close()
+
+    async def acquire(self) -> StdioConnection:
+        if self._closed:
+            raise RuntimeError(f"Server {self.name} pool is closed")
+        await self._slots.acquire()
+        try:
+            while self._idle:
+                conn = self._idle.pop()
+                if not conn.alive:
+                    await self._discard(conn)
+                    continue
+                if time.monotonic() - conn.last_checked > self.health_check_interval:
+                    if not await conn.ping(self.health_check_timeout):
+                        await self._discard(conn)
+                        continue
+                return conn
+            return await self._spawn()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn: StdioConnection, broken: bool = False) -> None:
+        conn.last_used = time.monotonic()
+        if broken or self._closed or not conn.alive:
+            self._all.discard(conn)
+            task = asyncio.create_task(self._discard(conn))
+            self._discarding.add(task)
+            task.add_done_callback(self._on_discarded)
+        else:
+            conn.last_checked = conn.last_used
+            self._idle.append(conn)
+        self._slots.release()
+
+    def _on_discarded(self, task: asyncio.Task) -> None:
+        self._discarding.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"[stdio-pool] {self.name} 关闭连接失败: {task.exception()}")
+
+    @asynccontextmanager
+    async def session(self):
+        """checkout 一个已初始化的 ClientSession，用完自动 checkin"""
+        conn = await self.acquire()
+        broken = False
+        try:
+            yield conn.session
+        except McpError:
+            # 工具层面的错误，连接本身仍可用
+            raise
+        except BaseException:
+            broken = True
+            raise
+        finally:
+            self.release(conn, broken=broken)
+
+    async def _reap_loop(self) -> None:
+        interval = max(1.0, min(self.idle_timeout, self.health_check_interval) / 2)
+        try:
+            while not self._closed:
+                await asyncio.sleep(interval)
+                now = time.monotonic()
+                alive = [c for c in self._idle if c.alive]
+                dead = [c for c in self._idle if not c.alive]
+                expired = [c for c in alive if now - c.last_used > self.idle_timeout]
+                victims = dead + expired[:max(0, len(alive) - self.min_idle)]
+                for conn in victims:
+                    self._idle.remove(conn)
+                for conn in victims:
+                    logger.info(f"[stdio-pool] {self.name} 回收空闲连接")
+                    await self._discard(conn)
+        except asyncio.CancelledError:
+            pass
+
+    async def close(self) -> None:
+        self._closed = True
+        if self._reaper:
+            self._reaper.cancel()
+            self._reaper = None
+        conns = list(self._all)
+        self._idle.clear()
+        self._all.clear()
+        await asyncio.gather(*(conn.close() for conn in conns), *list(self._discarding), return_exceptions=True)
@@ -0,0 +1,145 @@
+import json
+import logging
+from typing import Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+FUNCTION_CALL_BEGIN = "<|FunctionCallBegin|>"
+FUNCTION_CALL_END = "<|FunctionCallEnd|>"
+INNER_THOUGHT_BEGIN = "<InnerThoughtBegin>"
+INNER_THOUGHT_END = "<InnerThoughtEnd>"
+
+TEXT = "text"
+INNER_THOUGHT = "inner_thought"
+FUNCTION_CALL = "function_call"
+
+_BLOCKS = {
+    FUNCTION_CALL_BEGIN: (FUNCTION_CALL, FUNCTION_CALL_END),
+    INNER_THOUGHT_BEGIN: (INNER_THOUGHT, INNER_THOUGHT_END),
+}
+
+
+class StreamEvent:
+    """解析器输出的事件：普通文本、内心独白或函数调用"""
+
+    def __init__(self, kind: str, text: str, calls: Optional[List[Any]] = None):
+        self.kind = kind
+        self.text = text
+        self.calls = calls
+
+    @property
+    def body(self) -> str:
+        """去掉起止标记后的片段内容，普通文本原样返回"""
+        for begin, (kind, end) in _BLOCKS.items():
+            if kind == self.kind and self.text.startswith(begin) and self.text.endswith(end):
+                return self.text[len(begin):len(self.text) - len(end)].strip()
+        return self.text
+
+    def __repr__(self):
+        return f"StreamEvent({self.kind!r}, {self.text!r}, calls={self.calls!r})"
+
+
+def parse_function_calls(body: str) -> Optional[List[Any]]:
+    """解析 FunctionCall 片段中的 JSON，统一返回列表，失败时返回 None"""
+    try:
+        parsed = json.loads(body)
+    except Exception as e:
+        logger.error(f"[FunctionCall] JSON 解析失败: {e}, 内容: {body}")
+        return None
+    return parsed if isinstance(parsed, list) else [parsed]
+
+
+class FunctionCallStreamParser:
+    """
+    增量状态机：逐个消费 LLM 的 delta，输出 text / inner_thought / function_call 事件。
+
+    跨 chunk 的标记通过保留不超过标记长度的尾部来识别，每个字符只被扫描常数次，
+    整体耗时与输出总长度成线性关系。FunctionCall 在结束标记到达时立即产出，
+    未闭合的片段在 close() 时按普通文本输出。
+    """
+
+    def __init__(self):
+        self._state = TEXT
+        self._end_marker = None
+        self._begin_marker = None
+        self._pending = ""
+        self._block: List[str] = []
+
+    def feed(self, delta: str) -> List[StreamEvent]:
+        events: List[StreamEvent] = []
+        buf = self._pending + delta
+        self._pending = ""
+        while buf:
+            if self._state == TEXT:
+                buf = self._consume_text(buf, events)
+            else:
+                buf = self._consume_block(buf, events)
+        return events
+
+    def close(self) -> List[StreamEvent]:
+        """流结束时输出剩余内容"""
+        events: List[StreamEvent] = []
+        if self._state == TEXT:
+            if self._pending:
+                events.append(StreamEvent(TEXT, self._pending))
+        else:
+            logger.warning(f"[StreamParser] 未闭合的 {self._state} 片段，按文本输出")
+            events.append(StreamEvent(TEXT, self._begin_marker + ''.join(self._block) + self._pending))
+        self.__init__()
+        return events
+
+    def _consume_text(self, buf: str, events: List[StreamEvent]) -> str:
+        index, marker = -1, None
+        for begin in _BLOCKS:
+            i = buf.find(begin)
+            if i != -1 and (index == -1 or i < index):
+                index, marker = i, begin
+        if marker is not None:
+            if index:
+                self._emit_text(buf[:index], events)
+            self._state, self._end_marker = _BLOCKS[marker]
+            self._begin_marker = marker
+            return buf[index + len(marker):]
+        hold = self._partial_suffix(buf, _BLOCKS)
+        if len(buf) > hold:
+            self._emit_text(buf[:len(buf) - hold], events)
+        self._pending = buf[len(buf) - hold:] if hold else ""
+        return ""
+
+    def _consume_block(self, buf: str, events: List[StreamEvent]) -> str:
+        index = buf.find(self._end_marker)
+        if index == -1:
+            hold = self._partial_suffix(buf, (self._end_marker,))
+            self._block.append(buf[:len(buf) - hold])
+            self._pending = buf[len(buf) - hold:] if hold else ""
+            return ""
+        self._block.append(buf[:index])
+        body = ''.join(self._block)
+        rest = buf[index + len(self._end_marker):]
+        raw = self._begin_marker + body + self._end_marker
+        if self._state == FUNCTION_CALL:
+            logger.info(f"[FunctionCall] 检测到 FunctionCall 字符串: {raw}")
+            events.append(StreamEvent(FUNCTION_CALL, raw, parse_function_calls(body)))
+        else:
+            events.append(StreamEvent(INNER_THOUGHT, raw))
+        self._state, self._end_marker, self._begin_marker = TEXT, None, None
+        self._block = []
+        return rest
+
+    @staticmethod
+    def _emit_text(text: str, events: List[StreamEvent]) -> None:
+        if events and events[-1].kind == TEXT:
+            events[-1].text += text
+        else:
+            events.append(StreamEvent(TEXT, text))
+
+    @staticmethod
+    def _partial_suffix(buf: str, markers) -> int:
+        """buf 末尾可能是某个标记开头的最长长度"""
+        longest = 0
+        for marker in markers:
+            for size in range(min(len(marker) - 1, len(buf)), longest, -1):
+                if buf.endswith(marker[:size]):
+                    longest = size
+                    break
+        return longest
@@ -0,0 +1,261 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional, Set
+
+from .cache import Cache, cache as default_cache, stable_key
+from .deadline import turn_budget
+from .metrics import TOOL_DISCOVERY_DEGRADED, TOOL_DISCOVERY_SECONDS
+
+logger = logging.getLogger(__name__)
+
+SYSTEM_PROMPT_TEMPLATE = """你是一个强大的 AI 助手。你只能调用以下工具（名称区分大小写）：
+                {tool_names}
+                禁止调用未注册的工具，否则会报错。
+                调用工具时，请使用完整的工具名称（包含 server_name 前缀）。
+                调用工具时，参数必须严格按照 schema 格式传递。例如 sqlite.create_table 只接受 query 字符串参数，内容为完整的 SQL 语句。
+                每次调用需要严格按照参数数量给入，如果需要多次调用，则发起多次调用；
+                如果遇到错误，尝试其他可用的工具或向用户说明情况。"""
+
+
+def normalize_tool(server_name: str, tool: Any) -> Optional[Dict[str, Any]]:
+    """将不同协议返回的工具描述统一为 {name, server, description, params}"""
+    if isinstance(tool, dict):
+        name = tool.get("name")
+        description = tool.get("description", "")
+        schema = tool.get("params") or tool.get("inputSchema") or {}
+    else:
+        name = getattr(tool, "name", None)
+        description = getattr(tool, "description", "")
+        schema = getattr(tool, "inputSchema", None) or getattr(tool, "input_schema", None) or {}
+    if not name:
+        logger.warning(f"tool对象无name字段: {tool}")
+        return None
+    if not isinstance(schema, dict):
+        schema = {}
+    return {
+        "name": name,
+        "server": server_name,
+        "description": description or "",
+        "params": schema
+    }
+
+
+def to_openai_function(tool: Dict[str, Any]) -> Dict[str, Any]:
+    """将归一化后的工具转换为 OpenAI function-calling 格式"""
+    schema = tool.get("params") or {}
+    properties = schema.get("properties", {})
+    required = schema.get("required", list(properties.keys()))
+    return {
+        "name": f"{tool['server']}.{tool['name']}",
+        "description": tool.get("description", ""),
+        "parameters": {
+            "type": "object",
+            "properties": properties,
+            "required": required
+        }
+    }
+
+
+class CatalogEntry:
+    """单个 MCP Server 的工具目录快照"""
+
+    def __init__(self, server_name: str, tools: List[Dict[str, Any]], version: int):
+        self.server_name = server_name
+        self.tools = tools
+        self.functions = [to_openai_function(t) for t in tools]
+        self.prompt_lines = [f"- {fn['name']}" for fn in self.functions]
+        self.fetched_at = time.monotonic()
+        self.version = version
+
+
+class DiscoveryResult:
+    """一次工具发现的结果：可用条目、降级服务器及各服务器耗时（毫秒）"""
+
+    def __init__(self):
+        self.entries: List[CatalogEntry] = []
+        self.degraded: Dict[str, str] = {}
+        self.latencies: Dict[str, float] = {}
+
+
+class ToolCatalog:
+    """
+    缓存各 MCP Server 的工具列表、OpenAI functions 负载与系统提示词。
+
+    条目在 TTL 到期、收到 tools/list_changed 通知或被显式 invalidate 后才会重新拉取。
+    """
+
+    NAMESPACE = "tool_catalog"
+    PROMPT_NAMESPACE = "system_prompts"
+
+    def __init__(self, ttl: Optional[float] = None, cache: Optional[Cache] = None, health=None):
+        self.ttl = ttl if ttl is not None else float(os.getenv("TOOL_CATALOG_TTL", "300"))
+        self.server_timeout = float(os.getenv("TOOL_DISCOVERY_SERVER_TIMEOUT", "5"))
+        self.global_timeout = float(os.getenv("TOOL_DISCOVERY_TIMEOUT", "8"))
+        # 目录条目不设过期时间：过期的条目在服务器降级时仍作为兜底，新鲜度由 ttl 判断
+        self.cache = cache or default_cache
+        self._refreshing: Dict[str, asyncio.Task] = {}
+        # 可选的 ServerHealthMonitor：记录拉取结果，熔断中的服务器不参与发现
+        self.health = health
+        # 本轮已按超时记过失败、后台仍在刷新的服务器，刷新失败时不再重复记录
+        self._timed_out: Set[str] = set()
+        self.discovery_stats: Dict[str, Dict[str, Any]] = {}
+        self._version = 0
+
+    def invalidate(self, server_name: Optional[str] = None) -> None:
+        """使指定服务器（或全部）的目录失效"""
+        if server_name is None:
+            self.cache.invalidate(self.NAMESPACE)
+            self._refreshing.clear()
+            self.cache.invalidate(self.PROMPT_NAMESPACE)
+            logger.info("[ToolCatalog] 全部工具目录已失效")
+            return
+        self._refreshing.pop(server_name, None)
+        if self.cache.discard(self.NAMESPACE, server_name):
+            logger.info(f"[ToolCatalog] 服务器 {server_name} 的工具目录已失效")
+
+    def watch(self, server) -> None:
+        """订阅服务器的 tools/list_changed 通知"""
+        server.on_tools_changed = self.invalidate
+
+    def _is_fresh(self, entry: CatalogEntry) -> bool:
+        return self.ttl <= 0 or time.monotonic() - entry.fetched_at < self.ttl
+
+    def peek(self, server_name: str) -> Optional[CatalogEntry]:
+        entry = self.cache.get(self.NAMESPACE, server_name)
+        if entry and self._is_fresh(entry):
+            return entry
+        return None
+
+    def _refresh_task(self, server) -> asyncio.Task:
+        """获取（或创建）服务器的刷新任务，同一服务器的并发请求共享一个任务"""
+        task = self._refreshing.get(server.name)
+        if task is None or task.done():
+            task = asyncio.create_task(self._refresh(server))
+            self._refreshing[server.name] = task
+        return task
+
+    async def _refresh(self, server) -> CatalogEntry:
+        name = server.name
+        started = time.perf_counter()
+        try:
+            if not getattr(server, '_initialized', False):
+                await server.initialize()
+            raw_tools = await server.list_tools()
+            if isinstance(raw_tools, dict) and "functions" in raw_tools:
+                raw_tools = raw_tools["functions"]
+            tools = []
+            for tool in raw_tools:
+                normalized = normalize_tool(name, tool)
+                if normalized:
+                    tools.append(normalized)
+            self._version += 1
+            entry = CatalogEntry(name, tools, self._version)
+            self.cache.set(self.NAMESPACE, name, entry)
+            self._record_latency(name, started, "ok")
+            self._timed_out.discard(name)
+            if self.health:
+                self.health.record_success(name, time.perf_counter() - started)
+            logger.info(f"[ToolCatalog] 服务器 {name} 工具目录已刷新，共 {len(tools)} 个工具")
+            return entry
+        except Exception as e:
+            self._record_latency(name, started, "error")
+            if self.health and name not in self._timed_out:
+                self.health.record_failure(name, f"list_tools: {e}", time.perf_counter() - started)
+            self._timed_out.discard(name)
+            raise
+        finally:
+            if self._refreshing.get(name) is asyncio.current_task():
+                del self._refreshing[name]
+
+    def _record_latency(self, server_name: str, started: float, status: str) -> None:
+        elapsed = time.perf_counter() - started
+        latency_ms = elapsed * 1000
+        TOOL_DISCOVERY_SECONDS.observe(elapsed, server=server_name, status=status)
+        self.discovery_stats[server_name] = {
+            "latency_ms": round(latency_ms, 1),
+            "status": status,
+            "at": time.time()
+        }
+        logger.info(f"[ToolCatalog] 服务器 {server_name} 工具发现耗时 {latency_ms:.1f}ms ({status})")
+
+    async def get_entry(self, server, refresh: bool = False, timeout: Optional[float] = None) -> CatalogEntry:
+        """获取服务器的目录条目，过期或缺失时重新拉取；超时后刷新任务继续在后台完成"""
+        entry = None if refresh else self.peek(server.name)
+        if entry:
+            return entry
+        task = self._refresh_task(server)
+        if timeout is None:
+            return await task
+        return await asyncio.wait_for(asyncio.shield(task), timeout=timeout)
+
+    async def discover(self, servers: Dict[str, Any]) -> DiscoveryResult:
+        """
+        并发获取所有服务器的目录条目。
+
+        单个服务器受 server_timeout 限制，整体受 global_timeout 限制；
+        超时或失败的服务器本轮标记为降级（有过期条目时仍使用过期条目）；
+        熔断中的服务器直接标记为 circuit_open，不发起请求也不使用过期条目。
+        """
+        result = DiscoveryResult()
+        if not servers:
+            return result
+        # 整体时限不超过当前轮次的剩余预算
+        deadline = time.monotonic() + turn_budget(self.global_timeout)
+
+        async def _discover_one(name, server):
+            started = time.perf_counter()
+            entry, reason = None, None
+            try:
+                timeout = max(0.0, min(self.server_timeout, deadline - time.monotonic()))
+                entry = await self.get_entry(server, timeout=timeout)
+            except asyncio.TimeoutError:
+                reason = "timeout"
+                if self.health and name not in self._timed_out:
+                    self._timed_out.add(name)
+                    self.health.record_failure(name, "list_tools: timeout", time.perf_counter() - started)
+            except Exception as e:
+                logger.error(f"获取服务器 {name} 的工具列表失败: {e}")
+                reason = f"error: {e}"
+            result.latencies[name] = round((time.perf_counter() - started) * 1000, 1)
+            return name, entry, reason
+
+        # 熔断中的服务器直接跳过，不等待连接超时
+        if self.health:
+            for name in servers:
+                if not self.health.allow(name):
+                    result.degraded[name] = "circuit_open"
+                    TOOL_DISCOVERY_DEGRADED.inc(server=name, reason="circuit_open")
+            servers = {n: s for n, s in servers.items() if n not in result.degraded}
+        outcomes = await asyncio.gather(*(_discover_one(n, s) for n, s in servers.items()))
+        for name, entry, reason in outcomes:
+            if reason is not None:
+                result.degraded[name] = reason
+                TOOL_DISCOVERY_DEGRADED.inc(server=name, reason=reason.split(":", 1)[0])
+                entry = self.cache.peek(self.NAMESPACE, name)
+            if entry is not None:
+                result.entries.append(entry)
+        if result.degraded:
+            logger.warning(f"[ToolCatalog] 本轮降级的服务器: {result.degraded}, 耗时: {result.latencies}")
+        return result
+
+    async def get_entries(self, servers: Dict[str, Any]) -> List[CatalogEntry]:
+        """并发获取目录条目，跳过超时或失败的服务器"""
+        return (await self.discover(servers)).entries
+
+    def render_system_message(self, entries: List[CatalogEntry], names: Optional[Set[str]] = None) -> dict:
+        """根据目录条目渲染系统消息，names 不为空时只列出其中的工具；相同的组合复用同一结果"""
+        key = stable_key([(e.server_name, e.version) for e in entries], sorted(names) if names is not None else None)
+        message = self.cache.get(self.PROMPT_NAMESPACE, key)
+        if message is None:
+            tool_names = '\n'.join(
+                line for e in entries for fn, line in zip(e.functions, e.prompt_lines)
+                if names is None or fn["name"] in names
+            )
+            message = {
+                "role": "system",
+                "content": SYSTEM_PROMPT_TEMPLATE.format(tool_names=tool_names)
+            }
+            self.cache.set(self.PROMPT_NAMESPACE, key, message)
+        return dict(message)
@@ -0,0 +1,62 @@
+import hashlib
+import json
+import logging
+from typing import Any, Dict, Optional
+
+from .cache import Cache, cache as default_cache
+
+logger = logging.getLogger(__name__)
+
+
+def canonical_arguments(arguments: Optional[dict]) -> str:
+    """参数规范化：键排序、紧凑分隔符，保证相同参数得到相同的 key"""
+    return json.dumps(arguments or {}, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class ToolResultCache:
+    """
+    幂等 MCP 工具的结果缓存（按需开启），存放在共享缓存引擎的 tool_results 命名空间。
+
+    只有在 servers 文档中配置了 TTL 的工具才会被缓存，例如：
+        "tool_cache": {"get_current_date": 60, "*": 30}
+        "non_idempotent_tools": ["write_file"]
+    "*" 为该服务器所有工具的默认 TTL；non_idempotent_tools 中的工具始终绕过缓存。
+    内存占用由缓存引擎统一限制，按 LRU 淘汰。
+    """
+
+    NAMESPACE = "tool_results"
+
+    def __init__(self, cache: Optional[Cache] = None):
+        self.cache = cache or default_cache
+
+    @staticmethod
+    def ttl_for(server_config: Dict[str, Any], tool_name: str) -> float:
+        """返回工具的缓存 TTL（秒），0 表示不缓存"""
+        if tool_name in (server_config.get("non_idempotent_tools") or []):
+            return 0
+        ttls = server_config.get("tool_cache") or {}
+        if not isinstance(ttls, dict):
+            return 0
+        try:
+            return float(ttls.get(tool_name, ttls.get("*", 0)) or 0)
+        except (TypeError, ValueError):
+            return 0
+
+    @staticmethod
+    def _key(server_name: str, tool_name: str, arguments: Optional[dict]) -> str:
+        # 以服务器名为前缀，便于按服务器整体失效
+        digest = hashlib.sha256(canonical_arguments(arguments).encode("utf-8")).hexdigest()
+        return f"{server_name}\x1f{tool_name}\x1f{digest}"
+
+    def get(self, server_name: str, tool_name: str, arguments: Optional[dict]) -> Optional[Any]:
+        return self.cache.get(self.NAMESPACE, self._key(server_name, tool_name, arguments))
+
+    def set(self, server_name: str, tool_name: str, arguments: Optional[dict], value: Any, ttl: float) -> None:
+        self.cache.set(self.NAMESPACE, self._key(server_name, tool_name, arguments), value, ttl=ttl)
+
+    def invalidate(self, server_name: Optional[str] = None) -> None:
+        """清除指定服务器（或全部）的缓存结果"""
+        self.cache.invalidate(self.NAMESPACE, "" if server_name is None else f"{server_name}\x1f")
+
+    def stats(self) -> Dict[str, int]:
+        return self.cache.stats(self.NAMESPACE)
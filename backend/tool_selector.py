@@ -0,0 +1,159 @@
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def tool_text(tool: Dict[str, Any]) -> str:
+    """用于嵌入的工具描述文本：名称、描述与参数名"""
+    params = ", ".join((tool.get("params") or {}).get("properties") or {})
+    return f"{tool['server']}.{tool['name']}: {tool.get('description') or ''} ({params})"
+
+
+class SelectionResult:
+    """一次工具选择的结果"""
+
+    def __init__(self, functions: List[dict], names: Optional[Set[str]], total: int, latency_ms: float,
+                 reason: str):
+        self.functions = functions
+        # None 表示未做筛选（发送全部工具）
+        self.names = names
+        self.total = total
+        self.latency_ms = latency_ms
+        self.reason = reason
+
+    def to_dict(self) -> dict:
+        return {
+            "selected": len(self.functions),
+            "total": self.total,
+            "latency_ms": self.latency_ms,
+            "reason": self.reason
+        }
+
+
+class _ServerIndex:
+    """单个服务器某一目录版本的工具向量（已归一化）"""
+
+    def __init__(self, names: List[str], functions: List[dict], matrix: np.ndarray):
+        self.names = names
+        self.functions = functions
+        self.matrix = matrix
+
+
+class ToolSelector:
+    """
+    语义 top-k 工具选择：工具描述按目录版本嵌入一次，请求时用最近几条对话做查询向量，
+    对预先堆叠的矩阵做一次矩阵-向量乘得到相似度，只发送 top-k 工具与常驻工具。
+
+    常驻工具来自 TOOL_PINNED（逗号分隔的 server.tool）、servers 文档的 pinned_tools，
+    以及本轮对话中已经调用过的工具。工具总数不超过 top_k 时不做筛选。
+    """
+
+    def __init__(self, embedding_service, top_k: Optional[int] = None, pinned: Optional[Iterable[str]] = None):
+        self.embedding_service = embedding_service
+        self.top_k = top_k if top_k is not None else int(os.getenv("TOOL_TOP_K", "8"))
+        pinned_env = os.getenv("TOOL_PINNED", "")
+        self.pinned: Set[str] = set(pinned) if pinned is not None else {p.strip() for p in pinned_env.split(",") if p.strip()}
+        self.query_messages = int(os.getenv("TOOL_SELECTION_QUERY_MESSAGES", "4"))
+        self.query_chars = int(os.getenv("TOOL_SELECTION_QUERY_CHARS", "2000"))
+        self.retry_after = float(os.getenv("TOOL_SELECTION_RETRY_AFTER", "60"))
+        self._server_indexes: Dict[Tuple[str, int], _ServerIndex] = {}
+        self._stacked_key: Optional[tuple] = None
+        self._stacked: Optional[Tuple[List[str], List[dict], np.ndarray]] = None
+        self._disabled_until = 0.0
+        self.last_selection: Optional[dict] = None
+
+    async def _server_index(self, entry) -> _ServerIndex:
+        key = (entry.server_name, entry.version)
+        index = self._server_indexes.get(key)
+        if index is None:
+            names = [fn["name"] for fn in entry.functions]
+            if entry.tools:
+                matrix = await self.embedding_service.embed_many([tool_text(t) for t in entry.tools])
+                norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+                matrix = matrix / np.where(norms == 0, 1, norms)
+            else:
+                matrix = np.zeros((0, 0), dtype=np.float32)
+            # 同一服务器只保留最新版本
+            for stale in [k for k in self._server_indexes if k[0] == entry.server_name]:
+                del self._server_indexes[stale]
+            index = self._server_indexes[key] = _ServerIndex(names, list(entry.functions), matrix)
+        return index
+
+    async def _stacked_index(self, entries) -> Tuple[List[str], List[dict], np.ndarray]:
+        key = tuple((e.server_name, e.version) for e in entries)
+        if key != self._stacked_key:
+            indexes = [await self._server_index(e) for e in entries]
+            names = [n for i in indexes for n in i.names]
+            functions = [f for i in indexes for f in i.functions]
+            matrices = [i.matrix for i in indexes if i.matrix.size]
+            matrix = np.vstack(matrices).astype(np.float32) if matrices else np.zeros((0, 0), np.float32)
+            self._stacked_key, self._stacked = key, (names, functions, matrix)
+        return self._stacked
+
+    def _query_text(self, messages: List[dict]) -> str:
+        parts = []
+        for message in reversed(messages):
+            if message.get("role") not in ("user", "assistant") or not isinstance(message.get("content"), str):
+                continue
+            parts.append(message["content"])
+            if len(parts) >= self.query_messages:
+                break
+        return "\n".join(reversed(parts))[-self.query_chars:]
+
+    @staticmethod
+    def _called_tools(messages: List[dict]) -> Set[str]:
+        called = set()
+        for message in messages:
+            for call in message.get("tool_calls") or []:
+                name = (call.get("function") or {}).get("name")
+                if name:
+                    called.add(name)
+        return called
+
+    async def select(self, entries, messages: List[dict], pinned: Iterable[str] = ()) -> SelectionResult:
+        """从目录条目中选出本轮要发送的 functions"""
+        started = time.perf_counter()
+        all_functions = [fn for e in entries for fn in e.functions]
+        total = len(all_functions)
+
+        def _all(reason: str) -> SelectionResult:
+            return SelectionResult(all_functions, None, total,
+                                   round((time.perf_counter() - started) * 1000, 2), reason)
+
+        if self.top_k <= 0 or total <= self.top_k:
+            return self._record(_all("under_limit"))
+        if time.monotonic() < self._disabled_until:
+            return self._record(_all("disabled"))
+        query = self._query_text(messages)
+        if not query:
+            return self._record(_all("empty_query"))
+        try:
+            names, functions, matrix = await self._stacked_index(entries)
+            query_vector = np.asarray(await self.embedding_service.embed_vector(query), dtype=np.float32)
+        except Exception as e:
+            # 嵌入接口不可用时退回发送全部工具，一段时间内不再尝试
+            logger.warning(f"[ToolSelector] 工具嵌入失败，{self.retry_after:.0f}s 内发送全部工具: {e}")
+            self._disabled_until = time.monotonic() + self.retry_after
+            return self._record(_all("embedding_error"))
+
+        norm = np.linalg.norm(query_vector)
+        scores = matrix @ (query_vector / norm if norm else query_vector)
+        k = min(self.top_k, len(names))
+        top = np.argpartition(-scores, k - 1)[:k]
+        selected = {names[i] for i in top}
+        selected |= (self.pinned | set(pinned) | self._called_tools(messages)) & set(names)
+        chosen = [fn for fn in functions if fn["name"] in selected]
+        result = SelectionResult(chosen, selected, total, round((time.perf_counter() - started) * 1000, 2), "top_k")
+        logger.info(f"[ToolSelector] 选择 {len(chosen)}/{total} 个工具，耗时 {result.latency_ms}ms: "
+                    f"{json.dumps(sorted(selected), ensure_ascii=False)}")
+        return self._record(result)
+
+    def _record(self, result: SelectionResult) -> SelectionResult:
+        self.last_selection = result.to_dict()
+        return result
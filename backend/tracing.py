@@ -0,0 +1,323 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# OTLP 状态码
+STATUS_UNSET, STATUS_OK, STATUS_ERROR = 0, 1, 2
+
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("mcp_current_span", default=None)
+
+
+def payload_size(obj: Any) -> int:
+    """估算负载的 JSON 字节数"""
+    if isinstance(obj, (bytes, bytearray)):
+        return len(obj)
+    if not isinstance(obj, str):
+        obj = json.dumps(obj, ensure_ascii=False, default=str)
+    return len(obj.encode("utf-8"))
+
+
+class Span:
+    """一个计时区间，字段与 OpenTelemetry Span 对应"""
+
+    recording = True
+
+    def __init__(self, tracer: "Tracer", name: str, trace_id: str, parent_id: Optional[str],
+                 attributes: Optional[Dict[str, Any]] = None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes: Dict[str, Any] = dict(attributes or {})
+        self.status = STATUS_UNSET
+        self.status_message = ""
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def set_attributes(self, attributes: Dict[str, Any]) -> None:
+        self.attributes.update(attributes)
+
+    def set_status(self, status: int, message: str = "") -> None:
+        self.status = status
+        self.status_message = message
+
+    def record_exception(self, exc: BaseException) -> None:
+        self.set_status(STATUS_ERROR, str(exc))
+        self.attributes["exception.type"] = type(exc).__name__
+        self.attributes["exception.message"] = str(exc)
+
+    def end(self) -> None:
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        self.tracer._on_end(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "name": self.name,
+            "start_time_unix_nano": self.start_ns,
+            "end_time_unix_nano": self.end_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "attributes": self.attributes,
+            "status": {"code": self.status, "message": self.status_message}
+        }
+
+
+class _NoopSpan:
+    """未启用或未采样时使用，所有操作为空"""
+
+    recording = False
+    trace_id = None
+    span_id = None
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, attributes):
+        pass
+
+    def set_status(self, status, message=""):
+        pass
+
+    def record_exception(self, exc):
+        pass
+
+    def end(self):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class FileExporter:
+    """每个 span 一行 JSON 追加写入本地文件"""
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def _write(self, lines: List[str]) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("".join(lines))
+
+    async def export(self, spans: List[Span]) -> None:
+        lines = [json.dumps(s.to_dict(), ensure_ascii=False, default=str) + "\n" for s in spans]
+        await asyncio.to_thread(self._write, lines)
+
+    async def close(self) -> None:
+        pass
+
+
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [_otlp_value(v) for v in value]}}
+    return {"stringValue": str(value)}
+
+
+class OTLPHttpExporter:
+    """以 OTLP/HTTP JSON 编码发送到 collector 的 /v1/traces"""
+
+    def __init__(self, endpoint: str, service_name: str, headers: Optional[Dict[str, str]] = None):
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        self.service_name = service_name
+        self.client = httpx.AsyncClient(timeout=httpx.Timeout(5.0), headers=headers or {})
+
+    def encode(self, spans: List[Span]) -> dict:
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+                "scopeSpans": [{
+                    "scope": {"name": "mcp_agent"},
+                    "spans": [{
+                        "traceId": s.trace_id,
+                        "spanId": s.span_id,
+                        "parentSpanId": s.parent_id or "",
+                        "name": s.name,
+                        "kind": 1,
+                        "startTimeUnixNano": str(s.start_ns),
+                        "endTimeUnixNano": str(s.end_ns),
+                        "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in s.attributes.items()],
+                        "status": {"code": s.status, "message": s.status_message}
+                    } for s in spans]
+                }]
+            }]
+        }
+
+    async def export(self, spans: List[Span]) -> None:
+        response = await self.client.post(self.url, json=self.encode(spans))
+        response.raise_for_status()
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+def _parse_headers(raw: str) -> Dict[str, str]:
+    headers = {}
+    for item in raw.split(","):
+        key, sep, value = item.partition("=")
+        if sep and key.strip():
+            headers[key.strip()] = value.strip()
+    return headers
+
+
+def create_exporter():
+    """根据 TRACE_EXPORTER（none/file/otlp）创建导出器"""
+    kind = os.getenv("TRACE_EXPORTER", "none").lower()
+    if kind == "file":
+        return FileExporter(os.getenv("TRACE_FILE", ".cache/traces.jsonl"))
+    if kind == "otlp":
+        return OTLPHttpExporter(
+            os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318"),
+            os.getenv("OTEL_SERVICE_NAME", "mcp-agent"),
+            _parse_headers(os.getenv("OTEL_EXPORTER_OTLP_HEADERS", ""))
+        )
+    return None
+
+
+class Tracer:
+    """
+    基于 contextvars 的轻量追踪：当前 span 随协程上下文传递，create_task 创建的任务自动继承父 span。
+
+    结束的 span 先放入缓冲区，攒满 batch_size 或每隔 export_interval 秒由后台任务批量导出；
+    未配置导出器时所有 span 都是空操作。根 span 按 TRACE_SAMPLE_RATE 采样，子 span 跟随父 span。
+    """
+
+    def __init__(self, exporter=None, sample_rate: Optional[float] = None, batch_size: Optional[int] = None,
+                 export_interval: Optional[float] = None, max_queue: Optional[int] = None):
+        self.exporter = exporter
+        self.sample_rate = sample_rate if sample_rate is not None else float(os.getenv("TRACE_SAMPLE_RATE", "1"))
+        self.batch_size = batch_size or int(os.getenv("TRACE_BATCH_SIZE", "256"))
+        self.export_interval = export_interval if export_interval is not None else float(
+            os.getenv("TRACE_EXPORT_INTERVAL", "2"))
+        self.max_queue = max_queue or int(os.getenv("TRACE_MAX_QUEUE", "10000"))
+        self._buffer: List[Span] = []
+        self._export_task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self.dropped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None
+
+    @staticmethod
+    def current_span():
+        return _current_span.get()
+
+    def start_span(self, name: str, attributes: Optional[Dict[str, Any]] = None, root: bool = False):
+        """创建 span（不设为当前 span），父 span 默认取当前上下文"""
+        if not self.enabled:
+            return NOOP_SPAN
+        parent = None if root else _current_span.get()
+        if parent is None:
+            if self.sample_rate < 1 and random.random() >= self.sample_rate:
+                return NOOP_SPAN
+            return Span(self, name, f"{random.getrandbits(128):032x}", None, attributes)
+        if not parent.recording:
+            return NOOP_SPAN
+        return Span(self, name, parent.trace_id, parent.span_id, attributes)
+
+    @contextmanager
+    def activate(self, span, end: bool = False):
+        """将 span 设为当前 span；end=True 时退出后结束 span，异常会记录在 span 上"""
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            if not isinstance(e, (GeneratorExit, asyncio.CancelledError)):
+                span.record_exception(e)
+            elif span.recording:
+                span.set_attribute("cancelled", True)
+            raise
+        finally:
+            try:
+                _current_span.reset(token)
+            except ValueError:
+                # 异步生成器在其他上下文中被关闭（如 aclose 由事件循环回收）时无法 reset，忽略即可
+                pass
+            if end:
+                span.end()
+
+    @contextmanager
+    def span(self, name: str, attributes: Optional[Dict[str, Any]] = None, root: bool = False):
+        """创建并激活 span，退出时结束"""
+        with self.activate(self.start_span(name, attributes, root), end=True) as span:
+            yield span
+
+    @staticmethod
+    def detach() -> None:
+        """清除当前上下文的 span，用于后台循环任务避免挂到创建时的请求上"""
+        _current_span.set(None)
+
+    def _on_end(self, span: Span) -> None:
+        if len(self._buffer) >= self.max_queue:
+            self.dropped += 1
+            return
+        self._buffer.append(span)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._export_task is None or self._export_task.done():
+            self._wakeup = asyncio.Event()
+            self._export_task = loop.create_task(self._export_loop())
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _export_loop(self) -> None:
+        self.detach()
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.export_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                await self.flush()
+        except asyncio.CancelledError:
+            pass
+
+    async def flush(self) -> None:
+        """导出缓冲区中已结束的 span"""
+        while self._buffer and self.exporter is not None:
+            batch, self._buffer = self._buffer[:self.batch_size], self._buffer[self.batch_size:]
+            try:
+                await self.exporter.export(batch)
+            except Exception as e:
+                self.dropped += len(batch)
+                logger.warning(f"[Tracing] 导出 {len(batch)} 个 span 失败: {e}")
+
+    async def shutdown(self) -> None:
+        """停止后台导出并写出剩余 span"""
+        if self._export_task is not None:
+            self._export_task.cancel()
+            self._export_task = None
+        await self.flush()
+        if self.exporter is not None:
+            await self.exporter.close()
+
+
+tracer = Tracer(create_exporter())
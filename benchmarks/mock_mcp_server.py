@@ -0,0 +1,37 @@
+"""
+基准测试用的模拟 MCP Server，提供一个 echo 工具，可通过 --delay 模拟工具耗时。
+
+用法:
+    python benchmarks/mock_mcp_server.py --transport stdio
+    python benchmarks/mock_mcp_server.py --transport sse --port 18002
+"""
+import argparse
+import asyncio
+
+from mcp.server.fastmcp import FastMCP
+
+
+def build_server(name: str, delay: float, port: int = 8000) -> FastMCP:
+    mcp = FastMCP(name, host="127.0.0.1", port=port, log_level="WARNING")
+
+    @mcp.tool()
+    async def echo(text: str) -> str:
+        """原样返回输入文本"""
+        if delay:
+            await asyncio.sleep(delay)
+        return text
+
+    return mcp
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--transport", choices=("stdio", "sse"), default="stdio")
+    parser.add_argument("--port", type=int, default=18002)
+    parser.add_argument("--delay", type=float, default=0.0)
+    args = parser.parse_args()
+    build_server(f"bench-{args.transport}", args.delay, args.port).run(transport=args.transport)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+OpenAI 兼容的模拟补全服务，供基准测试使用。
+
+- 请求带 functions 且最后一条是用户消息时，流式输出一次 FunctionCall 标记，调用所有 *.echo 工具
+- 其他情况流式输出 MOCK_TOKENS 个 token，每个 token 间隔 MOCK_TOKEN_DELAY 秒
+- stream=false（如摘要）直接返回完整回复
+
+用法: python benchmarks/mock_openai.py --port 18001 --tokens 64 --token-delay 0.002
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+app = FastAPI()
+
+TOKENS = int(os.getenv("MOCK_TOKENS", "64"))
+TOKEN_DELAY = float(os.getenv("MOCK_TOKEN_DELAY", "0.002"))
+CHUNK_CHARS = 16
+
+
+def _chunk(completion_id: str, model: str, content: str = None, finish_reason: str = None) -> str:
+    delta = {"content": content} if content is not None else {}
+    payload = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    }
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def _function_call_text(functions: list, messages: list) -> str:
+    question = next((m.get("content") for m in reversed(messages) if m.get("role") == "user"), "")
+    calls = [
+        {"name": fn["name"], "parameters": {"text": str(question)[:64]}, "id": f"fc_{uuid.uuid4().hex[:12]}"}
+        for fn in functions if fn["name"].endswith(".echo")
+    ]
+    return f"<|FunctionCallBegin|>{json.dumps(calls, ensure_ascii=False)}<|FunctionCallEnd|>" if calls else ""
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model") or "mock"
+    messages = body.get("messages", [])
+    functions = body.get("functions") or []
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    call_text = _function_call_text(functions, messages) if messages and messages[-1].get("role") == "user" else ""
+
+    if not body.get("stream"):
+        return JSONResponse({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "mock summary"},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 2, "total_tokens": 2}
+        })
+
+    async def stream():
+        if call_text:
+            for i in range(0, len(call_text), CHUNK_CHARS):
+                yield _chunk(completion_id, model, call_text[i:i + CHUNK_CHARS])
+        else:
+            for i in range(TOKENS):
+                if TOKEN_DELAY:
+                    await asyncio.sleep(TOKEN_DELAY)
+                yield _chunk(completion_id, model, f"tok{i} ")
+        yield _chunk(completion_id, model, finish_reason="stop")
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+def main():
+    global TOKENS, TOKEN_DELAY
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=18001)
+    parser.add_argument("--tokens", type=int, default=TOKENS)
+    parser.add_argument("--token-delay", type=float, default=TOKEN_DELAY)
+    args = parser.parse_args()
+    TOKENS, TOKEN_DELAY = args.tokens, args.token_delay
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+"""
+端到端基准测试：在本进程内启动 FastAPI app，连接模拟的 OpenAI 流式接口、SSE/stdio MCP Server 与本地 mongod，
+测量首 token 延迟（TTFT）、tokens/s、工具调用往返耗时、N 个并发会话下的 turns/s 以及每轮的 MongoDB 操作数。
+结果以 JSON 输出，便于在不同提交之间对比。
+
+用法:
+    python benchmarks/run.py --mongod $(which mongod) --output bench.json
+    python benchmarks/run.py --mongo-uri mongodb://localhost:27017/mcp_bench --concurrency 1,8,32
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+from pymongo import MongoClient, monitoring
+
+ROOT = Path(__file__).resolve().parent.parent
+BENCH_DIR = Path(__file__).resolve().parent
+
+# 连接握手与心跳不计入业务操作
+IGNORED_COMMANDS = {"hello", "ismaster", "isMaster", "ping", "endSessions", "saslStart", "saslContinue",
+                    "buildInfo", "getMore", "killCursors"}
+
+
+class CommandCounter(monitoring.CommandListener):
+    """统计 MongoDB 命令数（按命令名），所有 pymongo/Motor 客户端共享"""
+
+    def __init__(self):
+        self.counts: Counter = Counter()
+
+    def started(self, event):
+        if event.command_name not in IGNORED_COMMANDS:
+            self.counts[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def snapshot(self) -> Counter:
+        return Counter(self.counts)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_port(port: int, timeout: float = 20.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"端口 {port} 在 {timeout}s 内未就绪")
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return round(ordered[index], 3)
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        "count": len(values),
+        "mean": round(statistics.fmean(values), 3) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "max": round(max(values), 3) if values else None
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+class Processes:
+    """管理基准依赖的子进程，退出时统一结束"""
+
+    def __init__(self):
+        self.procs: List[subprocess.Popen] = []
+        self.tmpdirs: List[str] = []
+
+    def spawn(self, args: List[str], **kwargs) -> subprocess.Popen:
+        proc = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **kwargs)
+        self.procs.append(proc)
+        return proc
+
+    def close(self):
+        for proc in reversed(self.procs):
+            proc.terminate()
+        for proc in self.procs:
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        for tmp in self.tmpdirs:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+def start_mongod(procs: Processes, mongod: str) -> str:
+    dbpath = tempfile.mkdtemp(prefix="mcp-bench-db-")
+    procs.tmpdirs.append(dbpath)
+    port = free_port()
+    procs.spawn([mongod, "--dbpath", dbpath, "--port", str(port), "--bind_ip", "127.0.0.1", "--quiet"])
+    wait_port(port, timeout=30)
+    return f"mongodb://127.0.0.1:{port}/mcp_bench"
+
+
+def prepare_import_path() -> None:
+    """后端以 mcp_agent 包名部署；未安装时通过软链接把 backend 暴露为 mcp_agent"""
+    try:
+        import mcp_agent  # noqa: F401
+        return
+    except ImportError:
+        pass
+    shim = Path(tempfile.mkdtemp(prefix="mcp-bench-path-"))
+    (shim / "mcp_agent").symlink_to(ROOT / "backend", target_is_directory=True)
+    sys.path.insert(0, str(shim))
+
+
+async def read_turn(client: httpx.AsyncClient, session_id: str, message: str) -> dict:
+    """发送一轮消息并解析 SSE 事件，返回本轮的时间指标"""
+    started = time.perf_counter()
+    first_token = None
+    last_token = None
+    tokens = 0
+    tool_latencies: List[float] = []
+    errors: List[str] = []
+    async with client.stream("POST", f"/chat/{session_id}/session/completion", json={"message": message}) as resp:
+        resp.raise_for_status()
+        async for line in resp.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = json.loads(line[5:])
+            now = time.perf_counter()
+            if "response" in data:
+                tokens += 1
+                first_token = first_token or now
+                last_token = now
+            elif "tool_result" in data:
+                # function_call/tool_result 在调用完成后成对下发，往返耗时取服务端记录的 latency_ms（如有）
+                latency = data["tool_result"].get("latency_ms")
+                if latency is not None:
+                    tool_latencies.append(latency)
+            elif "error" in data:
+                errors.append(str(data["error"]))
+            elif data.get("finish"):
+                break
+    finished = time.perf_counter()
+    stream_time = (last_token - first_token) if first_token and last_token and last_token > first_token else None
+    return {
+        "ttft_ms": (first_token - started) * 1000 if first_token else None,
+        "tokens": tokens,
+        "tokens_per_s": tokens / stream_time if stream_time else None,
+        "tool_latencies_ms": tool_latencies,
+        "turn_ms": (finished - started) * 1000,
+        "errors": errors
+    }
+
+
+async def create_session(client: httpx.AsyncClient) -> str:
+    resp = await client.post("/session/create")
+    resp.raise_for_status()
+    return resp.json()["_id"]
+
+
+def aggregate(turns: List[dict]) -> dict:
+    return {
+        "ttft_ms": summarize([t["ttft_ms"] for t in turns if t["ttft_ms"] is not None]),
+        "tokens_per_s": summarize([t["tokens_per_s"] for t in turns if t["tokens_per_s"]]),
+        "tool_roundtrip_ms": summarize([lat for t in turns for lat in t["tool_latencies_ms"]]),
+        "turn_ms": summarize([t["turn_ms"] for t in turns]),
+        "errors": sum(len(t["errors"]) for t in turns)
+    }
+
+
+async def run_sequential(client: httpx.AsyncClient, counter: CommandCounter, turns: int) -> dict:
+    """单会话顺序执行，逐轮统计 MongoDB 操作数"""
+    session_id = await create_session(client)
+    results, ops_per_turn, by_command = [], [], Counter()
+    for i in range(turns):
+        before = counter.snapshot()
+        results.append(await read_turn(client, session_id, f"bench turn {i}"))
+        # 等待后台写入（write-behind、生成状态）完成后再统计
+        await asyncio.sleep(0.05)
+        delta = counter.snapshot() - before
+        ops_per_turn.append(sum(delta.values()))
+        by_command.update(delta)
+    report = aggregate(results)
+    report["mongo_ops_per_turn"] = {
+        **summarize(ops_per_turn),
+        "by_command": {name: round(count / turns, 2) for name, count in sorted(by_command.items())}
+    }
+    return report
+
+
+async def run_concurrent(client: httpx.AsyncClient, sessions: int, turns_per_session: int) -> dict:
+    session_ids = await asyncio.gather(*(create_session(client) for _ in range(sessions)))
+
+    async def _session(session_id: str) -> List[dict]:
+        return [await read_turn(client, session_id, f"bench turn {i}") for i in range(turns_per_session)]
+
+    started = time.perf_counter()
+    per_session = await asyncio.gather(*(_session(s) for s in session_ids))
+    elapsed = time.perf_counter() - started
+    turns = [t for session_turns in per_session for t in session_turns]
+    report = aggregate(turns)
+    report.update({
+        "sessions": sessions,
+        "turns": len(turns),
+        "elapsed_s": round(elapsed, 3),
+        "turns_per_s": round(len(turns) / elapsed, 2)
+    })
+    return report
+
+
+async def run_benchmark(args, mongo_uri: str, mock_openai_port: int, sse_port: int) -> dict:
+    counter = CommandCounter()
+    # 必须在创建任何 MongoClient 之前注册
+    monitoring.register(counter)
+
+    os.environ.update({
+        "MONGO_URI": mongo_uri,
+        "API_KEY": "bench",
+        "BASE_URL": f"http://127.0.0.1:{mock_openai_port}/v1",
+        "MODEL": "mock-model",
+        "EMBEDDING_PROVIDER": "hashing",
+        "EMBEDDING_STORE_DIR": tempfile.mkdtemp(prefix="mcp-bench-vectors-"),
+        "CACHE_DIR": tempfile.mkdtemp(prefix="mcp-bench-cache-"),
+    })
+    with MongoClient(mongo_uri) as mongo:
+        db = mongo.get_default_database()
+        mongo.drop_database(db.name)
+        db.servers.insert_many([
+            {"name": "bench_sse", "mode": "sse", "url": f"http://127.0.0.1:{sse_port}/sse", "enabled": True},
+            {"name": "bench_stdio", "mode": "stdio", "command": sys.executable,
+             "args": [str(BENCH_DIR / "mock_mcp_server.py"), "--transport", "stdio", "--delay", str(args.tool_delay)],
+             "enabled": True},
+        ])
+
+    prepare_import_path()
+    import uvicorn
+    from mcp_agent.main import app
+    # 应用日志默认输出到 stdout，基准期间降低级别，避免影响计时与 JSON 输出
+    logging.getLogger().setLevel(args.log_level)
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        if server_task.done():
+            server_task.result()
+        await asyncio.sleep(0.05)
+
+    limits = httpx.Limits(max_connections=max(args.concurrency) * 2 + 10)
+    report = {}
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=120, limits=limits) as client:
+            # 预热：建立 MCP 连接、加载工具目录
+            warm = await create_session(client)
+            for _ in range(args.warmup):
+                await read_turn(client, warm, "warmup")
+            report["sequential"] = await run_sequential(client, counter, args.turns)
+            report["concurrency"] = [
+                await run_concurrent(client, n, args.turns_per_session) for n in args.concurrency
+            ]
+    finally:
+        server.should_exit = True
+        await server_task
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="mcp-agent 端到端基准测试")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--mongo-uri", help="已有 MongoDB 的连接串（数据库会被清空）")
+    group.add_argument("--mongod", help="mongod 可执行文件路径，使用临时目录启动")
+    parser.add_argument("--turns", type=int, default=20, help="顺序阶段的轮数")
+    parser.add_argument("--turns-per-session", type=int, default=5, help="并发阶段每个会话的轮数")
+    parser.add_argument("--concurrency", default="1,4,16", help="并发会话数列表，逗号分隔")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--tokens", type=int, default=64, help="模拟模型每次回复的 token 数")
+    parser.add_argument("--token-delay", type=float, default=0.002, help="模拟 token 间隔（秒）")
+    parser.add_argument("--tool-delay", type=float, default=0.01, help="模拟工具耗时（秒）")
+    parser.add_argument("--log-level", default="WARNING", help="应用日志级别")
+    parser.add_argument("--output", help="结果 JSON 文件，默认输出到 stdout")
+    args = parser.parse_args()
+    args.concurrency = [int(n) for n in args.concurrency.split(",") if n.strip()]
+
+    procs = Processes()
+    try:
+        mongo_uri = args.mongo_uri or start_mongod(procs, args.mongod)
+        mock_openai_port, sse_port = free_port(), free_port()
+        procs.spawn([sys.executable, str(BENCH_DIR / "mock_openai.py"), "--port", str(mock_openai_port),
+                     "--tokens", str(args.tokens), "--token-delay", str(args.token_delay)])
+        procs.spawn([sys.executable, str(BENCH_DIR / "mock_mcp_server.py"), "--transport", "sse",
+                     "--port", str(sse_port), "--delay", str(args.tool_delay)])
+        wait_port(mock_openai_port)
+        wait_port(sse_port)
+        # 应用的 print 与日志写 stdout，运行期间转到 stderr，stdout 只输出结果 JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            results = asyncio.run(run_benchmark(args, mongo_uri, mock_openai_port, sse_port))
+    finally:
+        procs.close()
+
+    output = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": {k: v for k, v in vars(args).items() if k != "output"}
+        },
+        "results": results
+    }
+    text = json.dumps(output, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -26,9 +26,16 @@ export async function deleteSession(sessionId) {
   return res.data
 }
 
-export async function loadMessages(sessionId) {
-  const res = await http.get(`/chat/${sessionId}/messages`)
-  return res.data || []
+// 分页加载历史消息，before 为上一页返回的 next_cursor
+export async function loadMessages(sessionId, before = null) {
+  const res = await http.get(`/chat/${sessionId}/messages`, { params: before ? { before } : {} })
+  return res.data || { messages: [], next_cursor: null }
+}
+
+// 获取单条完整消息（被截断的工具结果）
+export async function loadMessage(sessionId, messageId) {
+  const res = await http.get(`/chat/${sessionId}/messages/${messageId}`)
+  return res.data
 }
 
 // MCP Server 管理相关API
@@ -64,6 +71,12 @@ export async function getSessionCompletion(sessionId, message = '') {
   }
 }
 
+// 取消会话正在进行的AI回复生成，已生成的部分会保存
+export async function cancelSessionCompletion(sessionId) {
+  const res = await http.post(`/chat/${sessionId}/session/cancel`)
+  return res.data
+}
+
 // 获取指定MCP Server能力列表
 export async function getServerAbilities(id) {
   const res = await http.get(`/server/${encodeURIComponent(id)}/abilities`)
@@ -0,0 +1,22 @@
+"""
+测试公共配置：后端以 mcp_agent 包名部署，未安装时通过软链接把 backend 暴露为 mcp_agent。
+"""
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def _prepare_import_path() -> None:
+    try:
+        import mcp_agent  # noqa: F401
+        return
+    except ImportError:
+        pass
+    shim = Path(tempfile.mkdtemp(prefix="mcp-test-path-"))
+    (shim / "mcp_agent").symlink_to(ROOT / "backend", target_is_directory=True)
+    sys.path.insert(0, str(shim))
+
+
+_prepare_import_path()
@@ -0,0 +1,96 @@
+"""
+AdmissionController 的准入、排队与拒绝（429 队列已满 / 503 排队超时）测试。
+
+    python -m pytest -q tests/test_admission.py
+"""
+import asyncio
+
+import pytest
+
+from mcp_agent.admission import QUEUE_FULL, QUEUE_TIMEOUT, AdmissionController, AdmissionRejected
+
+
+def test_queue_full_is_429():
+    async def main():
+        controller = AdmissionController(max_active=1, max_queue=1, queue_timeout=5)
+        ticket = await controller.acquire()
+        waiter = asyncio.create_task(controller.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as info:
+            await controller.acquire()
+        assert info.value.status_code == 429
+        assert info.value.reason == QUEUE_FULL
+        assert info.value.retry_after >= 1
+        assert controller.rejected[QUEUE_FULL] == 1
+
+        ticket.release()
+        second = await waiter
+        assert controller.active == 1 and controller.queued == 0
+        second.release()
+        assert controller.active == 0
+
+    asyncio.run(main())
+
+
+def test_queue_timeout_is_503():
+    async def main():
+        controller = AdmissionController(max_active=1, max_queue=4, queue_timeout=0.05)
+        ticket = await controller.acquire()
+        with pytest.raises(AdmissionRejected) as info:
+            await controller.acquire()
+        assert info.value.status_code == 503
+        assert info.value.reason == QUEUE_TIMEOUT
+        assert controller.queued == 0
+        ticket.release()
+        assert controller.active == 0
+
+    asyncio.run(main())
+
+
+def test_waiters_are_admitted_in_order():
+    async def main():
+        controller = AdmissionController(max_active=1, max_queue=4, queue_timeout=5)
+        order = []
+
+        async def generate(label):
+            ticket = await controller.acquire()
+            order.append(label)
+            await asyncio.sleep(0)
+            ticket.release()
+
+        ticket = await controller.acquire()
+        tasks = [asyncio.create_task(generate(i)) for i in range(3)]
+        await asyncio.sleep(0)
+        ticket.release()
+        await asyncio.gather(*tasks)
+        assert order == [0, 1, 2]
+        assert controller.admitted == 4
+
+    asyncio.run(main())
+
+
+def test_release_is_idempotent_and_cancel_frees_queue():
+    async def main():
+        controller = AdmissionController(max_active=1, max_queue=4, queue_timeout=5)
+        ticket = await controller.acquire()
+        waiter = asyncio.create_task(controller.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert controller.queued == 0
+        ticket.release()
+        ticket.release()
+        assert controller.active == 0
+
+    asyncio.run(main())
+
+
+def test_retry_after_tracks_recent_durations():
+    controller = AdmissionController(max_active=2, max_queue=4, queue_timeout=5)
+    controller.avg_duration = 10
+    assert controller.retry_after() == 5
+    controller.active = 1
+    controller._release(20)
+    assert controller.avg_duration == pytest.approx(12)
+    assert controller.retry_after() == 6
@@ -0,0 +1,114 @@
+"""
+Cache 内存层的 LRU / 字节上限淘汰与 TTL 过期测试，以及磁盘层的写入、回填与删除。
+
+    python -m pytest -q tests/test_cache.py
+"""
+import asyncio
+import time
+
+from mcp_agent.cache import Cache, _estimate_size
+
+
+def make_cache(tmp_path, **kwargs):
+    kwargs.setdefault("max_entries", 3)
+    kwargs.setdefault("max_bytes", 1024 * 1024)
+    return Cache(cache_dir=str(tmp_path), expiry_interval=3600, **kwargs)
+
+
+def test_lru_evicts_least_recently_used(tmp_path):
+    cache = make_cache(tmp_path)
+    for key in ("a", "b", "c"):
+        cache.set("ns", key, key.upper())
+    # 访问 a 后 b 成为最久未使用
+    assert cache.get("ns", "a") == "A"
+    cache.set("ns", "d", "D")
+    assert cache.peek("ns", "b") is None
+    assert [cache.peek("ns", k) for k in ("a", "c", "d")] == ["A", "C", "D"]
+    stats = cache.stats("ns")
+    assert stats["evictions"] == 1
+    assert stats["entries"] == 3
+
+
+def test_byte_limit_evicts_oldest(tmp_path):
+    value = "x" * 1000
+    cache = make_cache(tmp_path, max_entries=100, max_bytes=_estimate_size(value) * 2)
+    for key in ("a", "b", "c"):
+        cache.set("ns", key, value)
+    assert cache.peek("ns", "a") is None
+    assert cache.stats()["bytes"] <= cache.max_bytes
+
+
+def test_oversized_entry_is_kept_alone(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=100)
+    cache.set("ns", "small", "s")
+    cache.set("ns", "big", "x" * 1000)
+    assert cache.peek("ns", "small") is None
+    assert cache.peek("ns", "big") is not None
+
+
+def test_ttl_expires_on_read(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.set("ns", "k", "v", ttl=0.05)
+    assert cache.get("ns", "k") == "v"
+    time.sleep(0.06)
+    assert cache.get("ns", "k") is None
+    stats = cache.stats("ns")
+    assert stats["expirations"] == 1
+    assert stats["hits"] == 1 and stats["misses"] == 1
+
+
+def test_expire_sweeps_only_expired_entries(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.set("ns", "short", 1, ttl=0.01)
+    cache.set("ns", "forever", 2)
+    time.sleep(0.02)
+    assert cache.expire() == 1
+    assert cache.peek("ns", "short") is None
+    assert cache.peek("ns", "forever") == 2
+
+
+def test_invalidate_by_prefix(tmp_path):
+    cache = make_cache(tmp_path, max_entries=10)
+    cache.set("ns", "srv1:a", 1)
+    cache.set("ns", "srv1:b", 2)
+    cache.set("ns", "srv2:a", 3)
+    cache.set("other", "srv1:a", 4)
+    assert cache.invalidate("ns", "srv1:") == 2
+    assert cache.peek("ns", "srv2:a") == 3
+    assert cache.peek("other", "srv1:a") == 4
+
+
+def test_disk_tier_roundtrip_and_delete(tmp_path):
+    async def main():
+        cache = make_cache(tmp_path)
+        try:
+            cache.set("ns", "k", {"v": [1, 2]}, persist=True)
+            cache.discard("ns", "k")
+            await cache._wait_disk_writes()
+            assert await cache.aget("ns", "k") == {"v": [1, 2]}
+            assert cache.stats("ns")["disk_hits"] == 1
+            # 已回填内存层
+            assert cache.peek("ns", "k") == {"v": [1, 2]}
+
+            await cache.delete("ns", "k")
+            assert await cache.aget("ns", "k") is None
+            assert not list(tmp_path.rglob("*.tmp"))
+        finally:
+            await cache.close()
+
+    asyncio.run(main())
+
+
+def test_disk_tier_respects_ttl(tmp_path):
+    async def main():
+        cache = make_cache(tmp_path)
+        try:
+            await cache.aset("ns", "k", "v", ttl=0.05, persist=True)
+            cache.discard("ns", "k")
+            await asyncio.sleep(0.06)
+            assert await cache.aget("ns", "k") is None
+            assert not list(tmp_path.rglob("*.zjson"))
+        finally:
+            await cache.close()
+
+    asyncio.run(main())
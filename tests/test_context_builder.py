@@ -0,0 +1,109 @@
+"""
+ContextBuilder 的分组、超限摘要与摘要失败时的回退测试（LLM 与会话存储均为内存替身）。
+
+    python -m pytest -q tests/test_context_builder.py
+"""
+import asyncio
+
+from mcp_agent.context_builder import SUMMARY_PREFIX, ContextBuilder, group_units, message_tokens
+
+
+class FakeLLM:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.calls = []
+
+    async def summarize(self, previous, messages):
+        self.calls.append((previous, [m["content"] for m in messages]))
+        if self.fail:
+            raise RuntimeError("llm down")
+        return (previous + "|" if previous else "") + ",".join(m["content"] for m in messages)
+
+
+class FakeSessions:
+    def __init__(self):
+        self.summaries = {}
+
+    async def update_session_summary(self, session_id, summary):
+        self.summaries[session_id] = summary
+
+
+def history(count):
+    messages = []
+    for i in range(count):
+        messages.append({"role": "user" if i % 2 == 0 else "assistant", "content": f"m{i} " + "x" * 40,
+                         "timestamp": f"2026-01-01T00:00:{i:02d}"})
+    return messages
+
+
+def test_group_units_keeps_tool_results_with_call():
+    messages = [
+        {"role": "user", "content": "q"},
+        {"role": "assistant", "content": "", "tool_calls": [{"id": "1"}]},
+        {"role": "tool", "content": "r1"},
+        {"role": "assistant", "content": "", "tool_calls": [{"id": "2"}]},
+        {"role": "tool", "content": "r2"},
+        {"role": "tool", "content": "r3"},
+        {"role": "assistant", "content": "a"},
+    ]
+    units = group_units(messages)
+    assert [[m["role"] for m in unit] for unit in units] == [
+        ["user"], ["assistant", "tool"], ["assistant", "tool", "tool"], ["assistant"]]
+
+
+def test_under_limit_returns_messages_unchanged():
+    llm, sessions = FakeLLM(), FakeSessions()
+    builder = ContextBuilder(llm, sessions, max_tokens=10000, recent_tokens=5000)
+    messages = history(4)
+    assert asyncio.run(builder.build("s", messages)) == messages
+    assert llm.calls == []
+
+
+def test_overflow_is_summarized_and_persisted():
+    llm, sessions = FakeLLM(), FakeSessions()
+    messages = history(10)
+    per_message = message_tokens(messages[0])
+    builder = ContextBuilder(llm, sessions, max_tokens=per_message * 6, recent_tokens=per_message * 3)
+    context = asyncio.run(builder.build("s", messages))
+
+    assert context[0]["role"] == "system" and context[0]["content"].startswith(SUMMARY_PREFIX)
+    assert context[1:] == messages[-3:]
+    summary = sessions.summaries["s"]
+    assert summary["until"] == messages[6]["timestamp"]
+    assert summary["message_count"] == 7
+
+    # 下一轮只把新滑出窗口的消息并入已有摘要
+    messages += history(12)[10:]
+    context = asyncio.run(builder.build("s", messages, summary))
+    assert llm.calls[-1][0] == summary["content"]
+    assert len(llm.calls[-1][1]) == 2
+    assert sessions.summaries["s"]["message_count"] == 9
+    assert context[1:] == messages[-3:]
+
+
+def test_tool_unit_is_not_split():
+    llm, sessions = FakeLLM(), FakeSessions()
+    messages = history(4) + [
+        {"role": "assistant", "content": "", "tool_calls": [{"id": "1"}], "timestamp": "2026-01-01T00:01:00"},
+        {"role": "tool", "content": "r" * 40, "timestamp": "2026-01-01T00:01:01"},
+        {"role": "assistant", "content": "done", "timestamp": "2026-01-01T00:01:02"},
+    ]
+    # 窗口放得下最后的回答与 tool 结果，但放不下整个 tool 单元，单元不可拆分，因此整体并入摘要
+    recent = message_tokens(messages[-1]) + message_tokens(messages[-2]) + 1
+    builder = ContextBuilder(llm, sessions, max_tokens=recent, recent_tokens=recent)
+    context = asyncio.run(builder.build("s", messages))
+    assert context[1:] == messages[-1:]
+    assert llm.calls[0][1][-2:] == ["", "r" * 40]
+
+
+def test_summary_failure_keeps_old_summary_and_recent_window():
+    llm, sessions = FakeLLM(fail=True), FakeSessions()
+    messages = history(10)
+    per_message = message_tokens(messages[0])
+    builder = ContextBuilder(llm, sessions, max_tokens=per_message * 6, recent_tokens=per_message * 3)
+    previous = {"content": "旧摘要", "until": "", "message_count": 0}
+    context = asyncio.run(builder.build("s", messages, previous))
+
+    assert context[0]["content"] == SUMMARY_PREFIX + "旧摘要"
+    assert context[1:] == messages[-3:]
+    assert sessions.summaries == {}
@@ -0,0 +1,75 @@
+"""
+Deadline / turn_budget / deadline_scope 与工具时限、重试退避的测试。
+
+    python -m pytest -q tests/test_deadline.py
+"""
+import asyncio
+import time
+
+import pytest
+
+from mcp_agent.deadline import (TOOL_CALL_TIMEOUT, Deadline, backoff_delay, current_deadline, deadline_scope,
+                                tool_timeout, turn_budget)
+
+
+def test_budget_excludes_final_answer_reserve():
+    deadline = Deadline(30, reserve=10)
+    assert deadline.remaining() == pytest.approx(30, abs=0.5)
+    assert deadline.budget() == pytest.approx(20, abs=0.5)
+    assert not deadline.exhausted
+
+
+def test_reserve_is_capped_at_half_timeout():
+    deadline = Deadline(4, reserve=10)
+    assert deadline.reserve == 2
+    assert deadline.budget() == pytest.approx(2, abs=0.5)
+
+
+def test_exhausted_after_budget_elapses():
+    deadline = Deadline(0.1, reserve=0.05)
+    time.sleep(0.06)
+    assert deadline.exhausted
+    assert deadline.budget() == 0
+    assert deadline.remaining() > 0
+
+
+def test_turn_budget_outside_scope_passes_through():
+    assert current_deadline() is None
+    assert turn_budget(7) == 7
+    assert turn_budget() is None
+
+
+def test_turn_budget_caps_timeout_inside_scope():
+    with deadline_scope(Deadline(30, reserve=10)) as deadline:
+        assert current_deadline() is deadline
+        assert turn_budget(5) == 5
+        assert turn_budget(60) == pytest.approx(20, abs=0.5)
+        assert turn_budget() == pytest.approx(20, abs=0.5)
+    assert current_deadline() is None
+
+
+def test_scope_is_inherited_by_child_tasks():
+    async def main():
+        with deadline_scope(Deadline(30)) as deadline:
+            seen = await asyncio.create_task(_read_deadline())
+        assert seen is deadline
+        assert current_deadline() is None
+
+    async def _read_deadline():
+        return current_deadline()
+
+    asyncio.run(main())
+
+
+def test_tool_timeout_precedence():
+    assert tool_timeout({"tool_timeouts": {"slow": 90, "*": 20}, "timeout": 10}, "slow") == 90
+    assert tool_timeout({"tool_timeouts": {"slow": 90, "*": 20}, "timeout": 10}, "fast") == 20
+    assert tool_timeout({"tool_timeouts": {"slow": 90}, "timeout": 10}, "fast") == 10
+    assert tool_timeout({}, "any") == TOOL_CALL_TIMEOUT
+    assert tool_timeout({"timeout": "bad"}, "any") == TOOL_CALL_TIMEOUT
+
+
+def test_backoff_delay_grows_and_is_capped():
+    for attempt, expected in ((0, 0.5), (1, 1.0), (3, 4.0), (10, 8.0)):
+        delay = backoff_delay(attempt)
+        assert expected * 0.8 <= delay <= expected * 1.2
@@ -0,0 +1,143 @@
+"""
+MongoGenerationState（capped collection + tailable cursor）的跨 worker 测试。
+
+需要可连接的 mongod（mongomock 不支持 capped collection 与 tailable cursor 的真实语义），
+通过 MONGO_TEST_URI 指定，默认 mongodb://127.0.0.1:27017；连接不上时跳过。
+每次运行使用独立的数据库，结束后删除。
+
+    python -m pytest -q tests/test_generation_state_mongo.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import uuid
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+MONGO_TEST_URI = os.getenv("MONGO_TEST_URI", "mongodb://127.0.0.1:27017")
+
+
+def _prepare_import_path() -> None:
+    """后端以 mcp_agent 包名部署；未安装时通过软链接把 backend 暴露为 mcp_agent"""
+    try:
+        import mcp_agent  # noqa: F401
+        return
+    except ImportError:
+        pass
+    shim = Path(tempfile.mkdtemp(prefix="mcp-test-path-"))
+    (shim / "mcp_agent").symlink_to(ROOT / "backend", target_is_directory=True)
+    sys.path.insert(0, str(shim))
+
+
+_prepare_import_path()
+
+from motor.motor_asyncio import AsyncIOMotorClient  # noqa: E402
+
+from mcp_agent.generation_state import MongoGenerationState  # noqa: E402
+
+
+def _mongod_reachable() -> bool:
+    async def ping():
+        client = AsyncIOMotorClient(MONGO_TEST_URI, serverSelectionTimeoutMS=1000)
+        try:
+            await client.admin.command("ping")
+            return True
+        except Exception:
+            return False
+        finally:
+            client.close()
+    return asyncio.run(ping())
+
+
+pytestmark = pytest.mark.skipif(not _mongod_reachable(), reason=f"mongod 不可达: {MONGO_TEST_URI}")
+
+
+def run_with_workers(scenario):
+    """在同一个临时数据库上创建两个 worker 的生成状态（owner 发起生成，other 模拟另一个 worker）"""
+    async def main():
+        client = AsyncIOMotorClient(MONGO_TEST_URI)
+        db = client[f"mcp_test_{uuid.uuid4().hex[:8]}"]
+        try:
+            owner = MongoGenerationState(db, flush_interval=0.01, stale_after=5)
+            other = MongoGenerationState(db, flush_interval=0.01, stale_after=5)
+            owner.worker_id, other.worker_id = "worker-a", "worker-b"
+            owner.cancel_poll_interval = other.cancel_poll_interval = 0.05
+            await owner.init()
+            await other.init()
+            await scenario(owner, other)
+        finally:
+            await client.drop_database(db.name)
+            client.close()
+    asyncio.run(main())
+
+
+def test_remote_subscriber_receives_snapshot_and_deltas():
+    async def scenario(owner, other):
+        channel = await owner.start("chat-1")
+        channel.publish("你好")
+        await channel.flush()
+
+        events = []
+
+        async def follow():
+            async for event in other.subscribe("chat-1"):
+                events.append(event)
+
+        follower = asyncio.create_task(follow())
+        await asyncio.sleep(0.2)
+        for delta in ("，", "世界"):
+            channel.publish(delta)
+        await owner.finish("chat-1", channel)
+        await asyncio.wait_for(follower, timeout=5)
+
+        assert events[0] == {"type": "snapshot", "seq": 1, "content": "你好"}
+        assert all(e["type"] == "delta" for e in events[1:])
+        assert [e["seq"] for e in events] == sorted(e["seq"] for e in events)
+        assert events[0]["content"] + "".join(e["delta"] for e in events[1:]) == "你好，世界"
+        assert not await other.is_generating("chat-1")
+
+    run_with_workers(scenario)
+
+
+def test_subscribe_after_finish_yields_nothing():
+    async def scenario(owner, other):
+        channel = await owner.start("chat-2")
+        channel.publish("done")
+        await owner.finish("chat-2", channel)
+        assert [e async for e in other.subscribe("chat-2")] == []
+
+    run_with_workers(scenario)
+
+
+def test_remote_cancel_reaches_owner():
+    async def scenario(owner, other):
+        channel = await owner.start("chat-3")
+        cancelled = asyncio.Event()
+        channel.on_cancel = cancelled.set
+        assert await other.cancel("chat-3")
+        await asyncio.wait_for(cancelled.wait(), timeout=5)
+        assert channel.cancel_requested
+        await owner.finish("chat-3", channel)
+        assert not await other.cancel("chat-3")
+
+    run_with_workers(scenario)
+
+
+def test_remote_watchers_count_as_subscribers():
+    async def scenario(owner, other):
+        channel = await owner.start("chat-4")
+        assert not await owner.has_subscribers("chat-4")
+
+        subscription = other.subscribe("chat-4")
+        snapshot = await subscription.__anext__()
+        assert snapshot["type"] == "snapshot"
+        assert await owner.has_subscribers("chat-4")
+
+        await subscription.aclose()
+        assert not await owner.has_subscribers("chat-4")
+        await owner.finish("chat-4", channel)
+
+    run_with_workers(scenario)
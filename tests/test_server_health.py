@@ -0,0 +1,117 @@
+"""
+ServerHealthMonitor 的熔断状态转换测试：closed -> open -> half_open -> closed。
+
+    python -m pytest -q tests/test_server_health.py
+"""
+import asyncio
+
+from mcp_agent.server_health import CLOSED, HALF_OPEN, OPEN, ServerHealthMonitor
+
+
+def make_monitor(probe=None):
+    monitor = ServerHealthMonitor(probe=probe)
+    monitor.failure_threshold = 3
+    monitor.min_calls = 5
+    monitor.min_success_rate = 0.5
+    monitor.probe_interval = 0.01
+    monitor.probe_max_interval = 0.05
+    monitor.probe_timeout = 1
+    return monitor
+
+
+def test_consecutive_failures_open_circuit():
+    monitor = make_monitor()
+    monitor.record_failure("srv", "boom")
+    monitor.record_failure("srv", "boom")
+    assert monitor.allow("srv")
+    monitor.record_failure("srv", "boom")
+    assert not monitor.allow("srv")
+    snapshot = monitor.snapshot("srv")
+    assert snapshot["state"] == OPEN
+    assert snapshot["consecutive_failures"] == 3
+    assert snapshot["last_error"] == "boom"
+
+
+def test_success_resets_consecutive_failures():
+    monitor = make_monitor()
+    # 只验证连续失败计数，样本数不足以触发成功率判断
+    monitor.min_calls = 10
+    for _ in range(2):
+        monitor.record_failure("srv", "boom")
+    monitor.record_success("srv", 0.1)
+    for _ in range(2):
+        monitor.record_failure("srv", "boom")
+    assert monitor.allow("srv")
+
+
+def test_low_success_rate_opens_circuit():
+    monitor = make_monitor()
+    # 成功与失败交替，连续失败从未达到阈值，但窗口内成功率低于 0.5
+    for ok in (False, True, False, False, True, False):
+        if ok:
+            monitor.record_success("srv", 0.1)
+        else:
+            monitor.record_failure("srv", "flaky")
+        if not monitor.allow("srv"):
+            break
+    assert monitor.snapshot("srv")["state"] == OPEN
+
+
+def test_unknown_server_is_allowed():
+    monitor = make_monitor()
+    assert monitor.allow("srv")
+    assert monitor.snapshot("srv") == {"state": CLOSED, "score": None, "samples": 0}
+
+
+def test_probe_closes_circuit_after_failure_backoff():
+    async def main():
+        attempts = []
+        states = []
+
+        async def probe(name):
+            states.append(monitor.snapshot(name)["state"])
+            attempts.append(name)
+            if len(attempts) < 3:
+                raise ConnectionError("still down")
+
+        monitor = make_monitor(probe)
+        for _ in range(3):
+            monitor.record_failure("srv", "boom")
+        assert not monitor.allow("srv")
+        task = monitor._servers["srv"].probe_task
+        await asyncio.wait_for(task, timeout=2)
+        assert attempts == ["srv"] * 3
+        assert states == [HALF_OPEN] * 3
+        assert monitor.allow("srv")
+        # 恢复后样本清空，旧的失败不会立即再次触发熔断
+        snapshot = monitor.snapshot("srv")
+        assert snapshot["samples"] == 0 and snapshot["consecutive_failures"] == 0
+
+    asyncio.run(main())
+
+
+def test_forget_cancels_probe():
+    async def main():
+        async def probe(name):
+            raise ConnectionError("down")
+
+        monitor = make_monitor(probe)
+        for _ in range(3):
+            monitor.record_failure("srv", "boom")
+        task = monitor._servers["srv"].probe_task
+        monitor.forget("srv")
+        await asyncio.sleep(0)
+        assert task.cancelled() or task.done()
+        assert monitor.allow("srv")
+
+    asyncio.run(main())
+
+
+def test_score_penalizes_slow_servers():
+    monitor = make_monitor()
+    monitor.latency_target = 1
+    for _ in range(4):
+        monitor.record_success("fast", 0.2)
+        monitor.record_success("slow", 4.0)
+    assert monitor.snapshot("fast")["score"] == 1.0
+    assert monitor.snapshot("slow")["score"] == 0.25
@@ -0,0 +1,112 @@
+"""
+ServerGate / ServerLimiter 的并发上限、有界队列与 flow 间轮转测试。
+
+    python -m pytest -q tests/test_server_limits.py
+"""
+import asyncio
+
+import pytest
+
+from mcp_agent.server_limits import ServerBusyError, ServerGate, ServerLimiter
+
+
+def test_round_robin_between_flows():
+    async def main():
+        gate = ServerGate("srv", max_concurrency=1, max_queue=10)
+        order = []
+
+        async def call(flow, label):
+            await gate.acquire(flow)
+            order.append(label)
+            await asyncio.sleep(0)
+            gate.release()
+
+        await gate.acquire("holder")
+        # flow a 一次排入 3 个调用，随后 b、c 各 1 个
+        tasks = [asyncio.create_task(call("a", f"a{i}")) for i in range(3)]
+        tasks += [asyncio.create_task(call("b", "b0")), asyncio.create_task(call("c", "c0"))]
+        await asyncio.sleep(0)
+        assert gate.queued == 5
+        gate.release()
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(main()) == ["a0", "b0", "c0", "a1", "a2"]
+
+
+def test_queue_full_raises_busy():
+    async def main():
+        gate = ServerGate("srv", max_concurrency=1, max_queue=1)
+        await gate.acquire()
+        waiter = asyncio.create_task(gate.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(ServerBusyError) as info:
+            await gate.acquire()
+        assert (info.value.active, info.value.queued) == (1, 1)
+        assert gate.snapshot()["rejected"] == 1
+        gate.release()
+        await waiter
+        assert gate.active == 1 and gate.queued == 0
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_leaves_queue():
+    async def main():
+        gate = ServerGate("srv", max_concurrency=1, max_queue=5)
+        await gate.acquire()
+        waiter = asyncio.create_task(gate.acquire("a"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert gate.queued == 0
+        gate.release()
+        assert gate.active == 0
+
+    asyncio.run(main())
+
+
+def test_cancel_after_grant_returns_slot():
+    async def main():
+        gate = ServerGate("srv", max_concurrency=1, max_queue=5)
+        await gate.acquire()
+        first = asyncio.create_task(gate.acquire("a"))
+        second = asyncio.create_task(gate.acquire("b"))
+        await asyncio.sleep(0)
+        # 名额已分配给 first，但它在恢复执行前被取消，名额应转给 second
+        gate.release()
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        await second
+        assert gate.active == 1 and gate.queued == 0
+
+    asyncio.run(main())
+
+
+def test_zero_concurrency_is_unlimited():
+    async def main():
+        gate = ServerGate("srv", max_concurrency=0, max_queue=0)
+        for _ in range(50):
+            assert await gate.acquire() == 0.0
+        assert gate.active == 50
+
+    asyncio.run(main())
+
+
+def test_limiter_uses_server_config_and_releases():
+    async def main():
+        limiter = ServerLimiter()
+        config = {"max_concurrency": 2, "max_queue": 0}
+        async with limiter.slot("srv", config):
+            async with limiter.slot("srv", config):
+                assert limiter.snapshot("srv")["active"] == 2
+                with pytest.raises(ServerBusyError):
+                    async with limiter.slot("srv", config):
+                        pass
+        assert limiter.snapshot("srv")["active"] == 0
+        limiter.forget("srv")
+        assert limiter.snapshot("srv") is None
+
+    asyncio.run(main())
@@ -0,0 +1,82 @@
+"""
+FunctionCallStreamParser 的增量解析测试：标记被任意切分到多个 delta 中时结果不变。
+
+    python -m pytest -q tests/test_stream_parser.py
+"""
+from mcp_agent.stream_parser import (FUNCTION_CALL, FUNCTION_CALL_BEGIN, FUNCTION_CALL_END, INNER_THOUGHT,
+                                     INNER_THOUGHT_BEGIN, INNER_THOUGHT_END, TEXT, FunctionCallStreamParser)
+
+CALL = '{"name": "weather.get", "parameters": {"city": "北京"}, "id": "fc_1"}'
+STREAM = (f"先查一下<{INNER_THOUGHT_BEGIN}需要天气{INNER_THOUGHT_END}"
+          f"{FUNCTION_CALL_BEGIN}{CALL}{FUNCTION_CALL_END}稍等")
+
+
+def parse(chunks):
+    parser = FunctionCallStreamParser()
+    events = []
+    for chunk in chunks:
+        events.extend(parser.feed(chunk))
+    events.extend(parser.close())
+    # 相邻文本事件合并后比较，文本的切分方式不影响语义
+    merged = []
+    for event in events:
+        if merged and event.kind == TEXT and merged[-1][0] == TEXT:
+            merged[-1] = (TEXT, merged[-1][1] + event.text, None)
+        else:
+            merged.append((event.kind, event.body, event.calls))
+    return merged
+
+
+EXPECTED = [
+    (TEXT, "先查一下<", None),
+    (INNER_THOUGHT, "需要天气", None),
+    (FUNCTION_CALL, CALL, [{"name": "weather.get", "parameters": {"city": "北京"}, "id": "fc_1"}]),
+    (TEXT, "稍等", None),
+]
+
+
+def test_whole_stream():
+    assert parse([STREAM]) == EXPECTED
+
+
+def test_every_split_point():
+    for i in range(1, len(STREAM)):
+        assert parse([STREAM[:i], STREAM[i:]]) == EXPECTED, i
+
+
+def test_single_character_chunks():
+    assert parse(list(STREAM)) == EXPECTED
+
+
+def test_partial_marker_is_held_back():
+    parser = FunctionCallStreamParser()
+    events = parser.feed("答案<|Function")
+    assert [(e.kind, e.text) for e in events] == [(TEXT, "答案")]
+    assert parser.feed("Call") == []
+    events = parser.feed("Begin|>")
+    assert events == []
+
+
+def test_lookalike_marker_is_flushed_as_text():
+    parser = FunctionCallStreamParser()
+    events = parser.feed("a<|Func") + parser.feed("tion|>b")
+    assert "".join(e.text for e in events if e.kind == TEXT) == "a<|Function|>b"
+
+
+def test_unclosed_block_falls_back_to_text():
+    parser = FunctionCallStreamParser()
+    events = parser.feed(f"x{FUNCTION_CALL_BEGIN}" + '{"name": ')
+    events += parser.close()
+    assert [e.kind for e in events] == [TEXT, TEXT]
+    assert "".join(e.text for e in events) == f"x{FUNCTION_CALL_BEGIN}" + '{"name": '
+
+
+def test_invalid_json_yields_no_calls():
+    events = parse([f"{FUNCTION_CALL_BEGIN}not json{FUNCTION_CALL_END}"])
+    assert events == [(FUNCTION_CALL, "not json", None)]
+
+
+def test_list_of_calls():
+    body = '[{"name": "a.b", "parameters": {}}, {"name": "c.d", "parameters": {}}]'
+    events = parse([FUNCTION_CALL_BEGIN, body[:10], body[10:], FUNCTION_CALL_END])
+    assert [c["name"] for c in events[0][2]] == ["a.b", "c.d"]
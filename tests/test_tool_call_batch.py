@@ -0,0 +1,105 @@
+"""
+ToolCallBatch 的并发执行与结果顺序测试：事件按完成顺序下发，写入 messages 的顺序与调用顺序一致。
+
+    python -m pytest -q tests/test_tool_call_batch.py
+"""
+import asyncio
+import json
+
+from mcp_agent.llm_service import LLMService, ToolCallBatch
+
+
+class FakeService(LLMService):
+    """只保留 ToolCallBatch 用到的方法，call_mcp_tool 按参数中的 delay 延迟返回"""
+
+    def __init__(self):
+        self.active = 0
+        self.max_active = 0
+        self.calls = []
+
+    async def call_mcp_tool(self, server_name, tool_name, arguments, flow=None):
+        self.calls.append((server_name, tool_name, flow))
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(arguments["delay"])
+            if arguments.get("fail"):
+                raise RuntimeError("tool failed")
+            return {"value": f"r{arguments['value']}"}
+        finally:
+            self.active -= 1
+
+
+def call(index, delay, **extra):
+    return {"name": f"srv.tool{index}", "parameters": {"delay": delay, "value": index, **extra}, "id": f"fc_{index}"}
+
+
+def run_batch(calls):
+    async def main():
+        service = FakeService()
+        batch = ToolCallBatch(service)
+        submitted = [batch.submit(c) for c in calls]
+        messages, events = [], []
+        async for event in batch.drain(messages):
+            events.append(event)
+        return service, batch, submitted, messages, events
+
+    return asyncio.run(main())
+
+
+def test_messages_follow_call_order_events_follow_completion():
+    service, batch, submitted, messages, events = run_batch([call(0, 0.06), call(1, 0.0), call(2, 0.03)])
+    assert submitted == [True, True, True]
+    assert len(batch) == 3
+
+    # 事件按完成顺序成对下发：1、2、0
+    pairs = list(zip(events[::2], events[1::2]))
+    assert [p[0]["function_call"]["tool_calls"][0]["id"] for p in pairs] == ["fc_1", "fc_2", "fc_0"]
+    assert all(p[1]["tool_result"]["tool_call_id"] == p[0]["function_call"]["tool_calls"][0]["id"] for p in pairs)
+    assert all(p[1]["tool_result"]["latency_ms"] >= 0 for p in pairs)
+
+    # messages 按原始调用顺序，assistant(tool_calls) 与 tool 结果交替
+    assert [m["role"] for m in messages] == ["assistant", "tool"] * 3
+    assert [m["tool_call_id"] for m in messages[1::2]] == ["fc_0", "fc_1", "fc_2"]
+    assert [json.loads(m["content"])["value"] for m in messages[1::2]] == ["r0", "r1", "r2"]
+    # 持久化专用字段不进入发送给 LLM 的消息
+    assert all("latency_ms" not in m and "call" not in m for m in messages)
+
+    # 同一批次的调用共享排队 flow
+    assert {flow for _, _, flow in service.calls} == {batch}
+
+
+def test_concurrency_is_limited(monkeypatch):
+    monkeypatch.setenv("TOOL_CALL_CONCURRENCY", "2")
+    service, _, _, messages, _ = run_batch([call(i, 0.02) for i in range(5)])
+    assert service.max_active == 2
+    assert [m["tool_call_id"] for m in messages[1::2]] == [f"fc_{i}" for i in range(5)]
+
+
+def test_failure_becomes_error_result_in_place():
+    _, _, _, messages, _ = run_batch([call(0, 0.0), call(1, 0.01, fail=True), call(2, 0.0)])
+    contents = [json.loads(m["content"]) for m in messages[1::2]]
+    assert contents[0] == {"value": "r0"}
+    assert contents[1] == {"error": "tool failed"}
+    assert contents[2] == {"value": "r2"}
+
+
+def test_invalid_call_is_not_submitted():
+    _, batch, submitted, messages, events = run_batch([{"name": "no_server_prefix", "parameters": {}}, call(0, 0.0)])
+    assert submitted == [False, True]
+    assert len(batch) == 1
+    assert len(events) == 2 and len(messages) == 2
+
+
+def test_cancel_stops_pending_calls():
+    async def main():
+        service = FakeService()
+        batch = ToolCallBatch(service)
+        batch.submit(call(0, 10))
+        await asyncio.sleep(0)
+        batch.cancel()
+        await asyncio.gather(*batch._tasks, return_exceptions=True)
+        return batch
+
+    batch = asyncio.run(main())
+    assert all(task.cancelled() for task in batch._tasks)